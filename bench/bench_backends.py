@@ -0,0 +1,72 @@
+"""
+Benchmark of the per-file overhead of each rclone backend: one rclone call
+per file and one rclone rcd server per run. Syncs small files to a local
+directory used as the remote, so it needs rclone but no network
+"""
+
+import sys
+from argparse import ArgumentParser
+from contextlib import closing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from db_ops import Crud, connect_db, get_count_or_setup_db  # noqa: E402
+from dir_ops import get_modified_files  # noqa: E402
+from helpers import VariableStorer  # noqa: E402
+from rclone_ops import rclone_backend, sync  # noqa: E402
+
+
+def time_backend(tmp: Path, files: int, use_rcd: bool, upload_workers: int) -> float:
+    """
+    Syncs files new files to an empty remote and returns the seconds per file
+    """
+    name = "rcd" if use_rcd else "subprocess"
+    tree = tmp / f"tree_{name}_{upload_workers}"
+    remote = tmp / f"remote_{name}_{upload_workers}"
+    tree.mkdir()
+    remote.mkdir()
+    for i in range(files):
+        (tree / f"file_{i}.txt").write_text(str(i))
+
+    var_storer = VariableStorer(False, tree)
+    var_storer.LOCAL_DIR = str(tree)
+    var_storer.REMOTE_DIR = str(remote)
+    var_storer.run_log = tmp / "run.log"
+    var_storer.err_log = tmp / "error.log"
+    var_storer.db_file = tmp / f"bench_{name}_{upload_workers}.db"
+    var_storer.upload_workers = upload_workers
+
+    with (
+        closing(connect_db(var_storer.db_file)) as var_storer.db_conn,
+        rclone_backend(var_storer, use_rcd),
+    ):
+        if use_rcd and var_storer.rcd is None:
+            raise RuntimeError("rclone rcd didn't start")
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        get_modified_files(var_storer, tree)
+
+        start = perf_counter()
+        sync(var_storer)
+        return (perf_counter() - start) / files
+
+
+def main():
+    parser = ArgumentParser(prog="bench_backends")
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--upload-workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        for upload_workers in args.upload_workers:
+            for use_rcd in (False, True):
+                seconds = time_backend(Path(tmp_dir), args.files, use_rcd, upload_workers)
+                name = "rcd" if use_rcd else "subprocess"
+                print(f"{name:>10}, {upload_workers} workers: {seconds * 1000:8.1f} ms per file")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of diff_ops.diff_files on single directories of growing size.
+Checks the events against a straightforward set based comparison and
+prints the time per entry, which should stay flat as the directory grows.
+Exits with 1 if the events don't match or the time per entry grows more than --max-growth
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from diff_ops import Change, diff_files  # noqa: E402
+from helpers import FileEntry  # noqa: E402
+
+
+def make_sides(size: int, churn: float, seed: int) -> tuple[list[FileEntry], list[FileEntry]]:
+    """
+    Creates a stored directory of size files and a local copy of it
+    where churn of the files were added, removed or modified
+    """
+    rand = Random(seed)
+    stored = [FileEntry(Path(f"/tree/dir/file_{i}"), i, i, i, False) for i in range(size)]
+    local = []
+    for entry in stored:
+        roll = rand.random()
+        if roll < churn / 3:
+            continue  # removed
+        if roll < churn * 2 / 3:
+            entry = entry._replace(mod_time=entry.mod_time + 1)
+        local.append(entry)
+    local.extend(
+        FileEntry(Path(f"/tree/dir/new_{i}"), i, i, i, False)
+        for i in range(int(size * churn / 3))
+    )
+    rand.shuffle(local)
+    return local, stored
+
+
+def reference_diff(local: list[FileEntry], stored: list[FileEntry]) -> dict[Change, set[Path]]:
+    """
+    The expected result, computed with plain set operations
+    """
+    local_times = {entry.path: entry.mod_time for entry in local}
+    stored_times = {entry.path: entry.mod_time for entry in stored}
+    return {
+        Change.ADDED: local_times.keys() - stored_times.keys(),
+        Change.REMOVED: stored_times.keys() - local_times.keys(),
+        Change.MODIFIED: {
+            path
+            for path in local_times.keys() & stored_times.keys()
+            if local_times[path] != stored_times[path]
+        },
+    }
+
+
+def time_diff(size: int, churn: float, repeat: int = 3) -> tuple[float, bool]:
+    """
+    Diffs a directory of size files, returning the best seconds per file
+    of repeat runs and whether the events match reference_diff()
+    """
+    local, stored = make_sides(size, churn, size)
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        events = list(diff_files(local, stored))
+        best = min(best, perf_counter() - start)
+
+    found: dict[Change, set[Path]] = {change: set() for change in Change}
+    for event in events:
+        found[event.change].add(event.entry.path)
+    return best / size, found == reference_diff(local, stored)
+
+
+def main():
+    parser = ArgumentParser(prog="bench_diff")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 4_000, 16_000, 64_000])
+    parser.add_argument("--churn", type=float, default=0.1)
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=10.0,
+        help="Times the time per file of the smallest size the others may take. "
+        "Cache misses alone grow it a few times, a quadratic diff grows it with the size",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    first = None
+    for size in args.sizes:
+        per_file, ok = time_diff(size, args.churn)
+        first = first or per_file
+        status = "ok" if ok else "MISMATCH"
+        if per_file > first * args.max_growth:
+            status += " SUPERLINEAR"
+        failed = failed or status != "ok"
+        print(f"{size:>7} files: {per_file * size * 1000:8.2f} ms  {per_file * 1e9:7.0f} ns/file  {status}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark comparing the serial and threaded directory walks of get_modified_files.
+Scans a synthetic tree, or the tree given with --tree, once to fill a fresh
+database and then times a second scan for each worker count
+"""
+
+import sys
+from argparse import ArgumentParser
+from contextlib import closing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from db_ops import Crud, connect_db, get_count_or_setup_db  # noqa: E402
+from dir_ops import get_modified_files  # noqa: E402
+from helpers import VariableStorer  # noqa: E402
+from synth_tree import make_tree  # noqa: E402
+
+
+def time_scan(tree: Path, tmp: Path, workers: int) -> tuple[float, int]:
+    """
+    Fills a new database with one scan and times a second one
+    """
+    var_storer = VariableStorer(False, tree)
+    var_storer.LOCAL_DIR = str(tree)
+    var_storer.run_log = tmp / f"run_{workers}.log"
+    var_storer.db_file = tmp / f"bench_{workers}.db"
+    var_storer.scan_workers = workers
+
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        get_modified_files(var_storer, tree)
+        var_storer.db_conn.commit()
+
+        var_storer.mod_times = []
+        start = perf_counter()
+        get_modified_files(var_storer, tree)
+        return perf_counter() - start, len(var_storer.mod_times)
+
+
+def main():
+    parser = ArgumentParser(prog="bench_scan_workers")
+    parser.add_argument("--tree", type=Path, help="Existing tree to scan instead of a synthetic one")
+    parser.add_argument("--files", type=int, default=30000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        tree = args.tree
+        if tree is None:
+            tree = tmp / "tree"
+            tree.mkdir()
+            make_tree(tree, args.files, args.depth, args.fan_out, seed=args.seed)
+
+        for workers in args.workers:
+            seconds, modified = time_scan(tree, tmp, workers)
+            print(f"{workers:>3} workers: {seconds:8.3f} s  ({modified} modified)")
+
+
+if __name__ == "__main__":
+    main()
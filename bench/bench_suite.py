@@ -0,0 +1,245 @@
+"""
+End to end benchmark of a run on a synthetic tree, with the fake rclone in
+bench/fake_rclone instead of the real one. Generates a tree, fills a database
+with a first scan, churns the tree and then times each phase of a run on a copy
+of that database: the scan and diff (get_modified_files), queueing and scheduling,
+writing the modified files to the database and syncing them.
+Results are saved as JSON along with the commit they were measured on, and
+--compare checks them against the results of another commit
+"""
+
+import os
+import platform
+import sqlite3
+import sys
+from argparse import ArgumentParser, Namespace
+from contextlib import closing, redirect_stdout
+from io import StringIO
+from json import dump, load
+from pathlib import Path
+from shutil import copyfile
+from statistics import median
+from subprocess import CalledProcessError, run
+from tempfile import TemporaryDirectory
+from time import perf_counter, time_ns
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "src"))
+
+from db_ops import Crud, connect_db, get_count_or_setup_db, write_db_mod_files  # noqa: E402
+from dir_ops import get_modified_files  # noqa: E402
+from helpers import VariableStorer  # noqa: E402
+from rclone_ops import sync  # noqa: E402
+from sched_ops import schedule  # noqa: E402
+from synth_tree import churn, make_tree  # noqa: E402
+
+PHASES = ("scan", "queue", "write", "sync", "total")
+# Differences below this are timer noise, not regressions
+NOISE_SECONDS = 0.01
+
+
+def __var_storer(args: Namespace, tree: Path, tmp: Path, db_file: Path) -> VariableStorer:
+    """
+    Creates a VariableStorer for tree, writing the database and logs to tmp
+    """
+    var_storer = VariableStorer(False, tree)
+    var_storer.LOCAL_DIR = str(tree)
+    var_storer.REMOTE_DIR = "bench:"
+    var_storer.run_log = tmp / "run.log"
+    var_storer.err_log = tmp / "error.log"
+    var_storer.db_file = db_file
+    var_storer.scan_workers = args.scan_workers
+    var_storer.merge_scan = args.merge_scan
+    var_storer.batch_size = args.batch_size
+    var_storer.upload_workers = args.upload_workers
+    return var_storer
+
+
+def time_run(args: Namespace, tree: Path, tmp: Path, db_file: Path) -> tuple[dict, dict]:
+    """
+    Times each phase of one run against db_file.
+    Returns the seconds per phase and the number of files in each outcome
+    """
+    var_storer = __var_storer(args, tree, tmp, db_file)
+    times = {}
+
+    with closing(connect_db(db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        run_start = perf_counter()
+
+        start = perf_counter()
+        get_modified_files(var_storer, tree)
+        times["scan"] = perf_counter() - start
+
+        start = perf_counter()
+        var_storer.crud.queue_files(var_storer.mod_times, time_ns())
+        queue = var_storer.crud.get_queue()
+        var_storer.mod_times = schedule(var_storer, queue)
+        times["queue"] = perf_counter() - start
+
+        start = perf_counter()
+        write_db_mod_files(var_storer)
+        times["write"] = perf_counter() - start
+
+        start = perf_counter()
+        # sync prints failed files even when STDOUT is off
+        with redirect_stdout(StringIO()):
+            sync(var_storer)
+        var_storer.db_conn.commit()
+        times["sync"] = perf_counter() - start
+
+        times["total"] = perf_counter() - run_start
+        failed = var_storer.db_conn.execute(
+            "SELECT COUNT(*) FROM SyncState WHERE synced = 0"
+        ).fetchone()[0]
+
+    counts = {"modified": len(var_storer.mod_times), "failed": failed}
+    return times, counts
+
+
+def __git(*args: str) -> str | None:
+    """
+    Output of a git command in the repository, None outside of one
+    """
+    try:
+        return run(
+            ["git", *args], cwd=BENCH_DIR, check=True, capture_output=True, encoding="utf-8"
+        ).stdout.strip()
+    except (OSError, CalledProcessError):
+        return None
+
+
+def run_suite(args: Namespace) -> dict:
+    """
+    Builds the tree and baseline database once and times args.repeat runs on copies of it
+    """
+    os.environ["PATH"] = f"{BENCH_DIR / 'fake_rclone'}{os.pathsep}{os.environ['PATH']}"
+    os.environ["FAKE_RCLONE_LATENCY"] = str(args.latency)
+    os.environ["FAKE_RCLONE_BANDWIDTH"] = str(args.bandwidth)
+    os.environ["FAKE_RCLONE_FAIL_RATE"] = str(args.fail_rate)
+    os.environ["FAKE_RCLONE_SEED"] = str(args.seed)
+
+    with TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        tree = tmp / "tree"
+        tree.mkdir()
+        make_tree(tree, args.files, args.depth, args.fan_out, args.sizes, args.seed)
+
+        baseline = tmp / "baseline.db"
+        var_storer = __var_storer(args, tree, tmp, baseline)
+        with closing(connect_db(baseline)) as var_storer.db_conn:
+            var_storer.crud = Crud(var_storer.db_conn)
+            get_count_or_setup_db(var_storer)
+            get_modified_files(var_storer, tree)
+            var_storer.db_conn.commit()
+
+        changes = churn(tree, args.churn, args.sizes, args.seed + 1)
+
+        runs = []
+        for i in range(args.repeat):
+            db_file = tmp / f"run_{i}.db"
+            copyfile(baseline, db_file)
+            times, counts = time_run(args, tree, tmp, db_file)
+            runs.append(times)
+            if args.verbose:
+                phases = ", ".join(f"{phase} {times[phase]:.3f} s" for phase in PHASES)
+                print(f"run {i + 1}: {phases}")
+
+        db_size = db_file.stat().st_size
+
+    return {
+        "commit": __git("rev-parse", "HEAD"),
+        "dirty": bool(__git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "params": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "threshold", "verbose")
+        },
+        "changes": changes,
+        "counts": counts,
+        "db_size": db_size,
+        "runs": runs,
+        "median": {phase: median(times[phase] for times in runs) for phase in PHASES},
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Prints the median of each phase against the baseline's.
+    Returns False if a phase got slower by more than threshold times,
+    ignoring phases within NOISE_SECONDS of the baseline
+    """
+    if results["params"] != baseline["params"]:
+        print("Warning: the baseline was measured with different parameters")
+
+    ok = True
+    print(f"{'phase':>6} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for phase in PHASES:
+        old = baseline["median"].get(phase)
+        new = results["median"][phase]
+        if not old:
+            continue
+        ratio = new / old
+        regressed = ratio > threshold and new - old > NOISE_SECONDS
+        ok = ok and not regressed
+        print(f"{phase:>6} {old:10.3f} {new:10.3f} {ratio:7.2f}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = ArgumentParser(prog="bench_suite")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=8)
+    parser.add_argument(
+        "--sizes",
+        default="lognormal:65536:2",
+        help="fixed:BYTES, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA",
+    )
+    parser.add_argument(
+        "--churn", type=float, default=2, help="Percent of files changed between the scans"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="Seconds each fake rclone call takes"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="Fake upload bytes per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--fail-rate", type=float, default=0, help="Probability of each fake upload failing"
+    )
+    parser.add_argument("-w", "--scan-workers", type=int, default=1)
+    parser.add_argument("-m", "--merge-scan", action="store_true")
+    parser.add_argument("-b", "--batch-size", type=int, default=0)
+    parser.add_argument("-u", "--upload-workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_suite.json"))
+    parser.add_argument("--compare", type=Path, help="Results of another commit to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=1.2, help="Slowdown counted as a regression"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    with open(args.output, "w", encoding="utf-8") as output:
+        dump(results, output, indent=2)
+
+    print(f"{results['counts']['modified']} modified, {results['counts']['failed']} failed")
+    for phase in PHASES:
+        print(f"{phase:>6}: {results['median'][phase]:8.3f} s")
+    print(f"Saved to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as baseline:
+            if not compare(results, load(baseline), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
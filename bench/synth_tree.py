@@ -0,0 +1,122 @@
+"""
+Generates reproducible synthetic trees for the benchmarks: a set number of files spread
+over directories of a set depth and fan-out, with sizes drawn from a distribution,
+and churn which modifies, deletes and adds a percentage of the files afterwards.
+Files are sparse, so large trees are quick to make and take no disk space
+"""
+
+import os
+from argparse import ArgumentParser
+from math import log
+from pathlib import Path
+from random import Random
+
+
+def parse_sizes(spec: str):
+    """
+    Returns a function drawing a file size from a Random, given as
+    fixed:BYTES, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA
+    """
+    kind, *values = spec.split(":")
+    try:
+        numbers = [float(value) for value in values]
+    except ValueError:
+        raise ValueError(f"Invalid size distribution {spec}") from None
+
+    if kind == "fixed" and len(numbers) == 1:
+        return lambda rand: int(numbers[0])
+    if kind == "uniform" and len(numbers) == 2:
+        return lambda rand: rand.randint(int(numbers[0]), int(numbers[1]))
+    if kind == "lognormal" and len(numbers) == 2:
+        return lambda rand: int(rand.lognormvariate(log(numbers[0]), numbers[1]))
+    raise ValueError(f"Invalid size distribution {spec}")
+
+
+def __write_file(path: Path, size: int):
+    """
+    Writes a sparse file of size bytes
+    """
+    with open(path, "wb") as file:
+        file.truncate(size)
+
+
+def make_tree(
+    root: Path, files: int, depth: int, fan_out: int, sizes: str = "fixed:1024", seed: int = 0
+) -> list[Path]:
+    """
+    Creates depth levels of fan_out subdirectories below root and spreads files
+    over all of them at random. Returns the directories, root first
+    """
+    rand = Random(seed)
+    size_of = parse_sizes(sizes)
+
+    dirs = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for cwd in level:
+            for i in range(fan_out):
+                sub = cwd / f"dir_{i}"
+                sub.mkdir()
+                next_level.append(sub)
+        dirs.extend(next_level)
+        level = next_level
+
+    for i in range(files):
+        __write_file(rand.choice(dirs) / f"file_{i}.dat", size_of(rand))
+
+    return dirs
+
+
+def churn(root: Path, percent: float, sizes: str = "fixed:1024", seed: int = 0) -> dict[str, int]:
+    """
+    Modifies, deletes and adds percent of the files below root, a third each.
+    Modified files get a new size and a modification time an hour later.
+    Returns how many files had each change
+    """
+    rand = Random(seed)
+    size_of = parse_sizes(sizes)
+
+    files = sorted(path for path in root.rglob("*") if path.is_file())
+    dirs = sorted({path.parent for path in files} | {root})
+    picked = rand.sample(files, round(len(files) * percent / 100))
+    third = len(picked) // 3
+
+    for path in picked[:third]:
+        mod_time = path.stat().st_mtime_ns + 3600 * 1_000_000_000
+        __write_file(path, size_of(rand))
+        os.utime(path, ns=(mod_time, mod_time))
+
+    for path in picked[third : 2 * third]:
+        path.unlink()
+
+    added = len(picked) - 2 * third
+    for i in range(added):
+        __write_file(rand.choice(dirs) / f"new_{seed}_{i}.dat", size_of(rand))
+
+    return {"modified": third, "deleted": third, "added": added}
+
+
+def main():
+    parser = ArgumentParser(prog="synth_tree")
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fan-out", type=int, default=8)
+    parser.add_argument("--sizes", default="lognormal:65536:2")
+    parser.add_argument(
+        "--churn", type=float, default=0, help="Percent of files to change afterwards"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    args.root.mkdir(parents=True)
+    dirs = make_tree(args.root, args.files, args.depth, args.fan_out, args.sizes, args.seed)
+    print(f"{args.files} files in {len(dirs)} directories")
+    if args.churn:
+        changes = churn(args.root, args.churn, args.sizes, args.seed + 1)
+        print(", ".join(f"{count} {change}" for change, count in changes.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,34 +2,24 @@
 echo "All logged files:"
 echo "date|file_path|synced"
 sqlite3 src/RCloneBackupScript.db <<EOF
-SELECT * FROM Log;
+SELECT l.date, p.file_path, l.synced
+FROM Log AS l
+JOIN FilePaths AS p ON p.file_id = l.file_id
+ORDER BY l.date;
 EOF
 
 echo "\nFiles which did not sync:"
-echo "date|file_path|synced"
+echo "file_path|attempts|last_error"
 sqlite3 src/RCloneBackupScript.db <<EOF
-SELECT *
-FROM Log AS l1
-WHERE l1.synced = 0
-AND NOT EXISTS (
-    SELECT 1
-    FROM Log AS l2
-    WHERE l2.file_path = l1.file_path
-    AND l2.synced = 1
-    AND l2.date > l1.date
-);
+SELECT p.file_path, s.attempts, s.last_error
+FROM SyncState AS s
+JOIN FilePaths AS p ON p.file_id = s.file_id
+WHERE s.synced = 0;
 EOF
 
 echo "\nCount of files which did not sync:"
 sqlite3 src/RCloneBackupScript.db <<EOF
-SELECT COUNT(DISTINCT file_path)
-FROM Log AS l1
-WHERE l1.synced = 0
-AND NOT EXISTS (
-    SELECT 1
-    FROM Log AS l2
-    WHERE l2.file_path = l1.file_path
-    AND l2.synced = 1
-    AND l2.date > l1.date
-);
+SELECT COUNT(*)
+FROM SyncState
+WHERE synced = 0;
 EOF
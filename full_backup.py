@@ -1,59 +1,169 @@
 """
-Script for backing up the entire PDrive folder
+Script for backing up the entire PDrive folder.
+The folder is split into shards of about the same size, which are synced by up to
+--workers rclone calls at once. Each finished shard is recorded in the database,
+so a full backup which is interrupted or has shards failing continues with only
+the unfinished shards the next time it's run
 """
 
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from pathlib import Path
-from subprocess import CalledProcessError, run
+from subprocess import CalledProcessError, TimeoutExpired, run
+from tempfile import TemporaryDirectory
 
-SOURCE = "/home/kr9sis/PDrive"
-DESTINATION = "PDrive:"
-FILTER_FILE = (
-    "/home/kr9sis/PDrive/Code/Py/rclone_backup_script/repo/rclone_sync_filter.txt"
-)
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
 
+from db_ops import (  # noqa: E402
+    Crud,
+    connect_db,
+    finish_full_backup_shard,
+    get_count_or_setup_db,
+    get_full_backup,
+    start_full_backup,
+)
+from filter_ops import FILTER_FILE  # noqa: E402
+from helpers import VariableStorer  # noqa: E402
+from lock_ops import RunLock, progress_text  # noqa: E402
+from shard_ops import plan_shards, size_tree_from_db, size_tree_from_scan  # noqa: E402
 
-def sync_subdir(path: Path):
-    """
-    If path is directory, sync each individual subdirectories
-    """
-    if path.is_dir():
-        for sub_path in path.iterdir():
-            sync_dir(sub_path)
-    else:
-        print(path)
+# Seconds a single shard may take to sync
+TIMEOUT = 25200
 
 
-def sync_dir(path: Path):
+def sync_shard(var_storer: VariableStorer, filter_file: Path) -> str | None:
     """
-    Sync given directory
+    Syncs the paths included by filter_file. Returns the error if it failed
     """
-    rel_path = path.relative_to(SOURCE)
     command = [
         "rclone",
         "sync",
-        SOURCE,
-        DESTINATION,
+        var_storer.LOCAL_DIR,
+        var_storer.REMOTE_DIR,
         "--filter-from",
-        FILTER_FILE,
-        "--filter",
-        f"+ {rel_path}",
+        str(filter_file),
     ]
 
-    print(" ".join(command), "\n")
+    try:
+        run(command, capture_output=True, encoding="utf-8", timeout=TIMEOUT, check=True)
+    except CalledProcessError as e:
+        errors = e.stderr.strip().splitlines()
+        return errors[-1] if errors else str(e)
+    except (OSError, TimeoutExpired) as e:
+        return str(e)
+    return None
+
+
+def get_shards(
+    var_storer: VariableStorer, shards: int, scan: bool, restart: bool
+) -> tuple[int, list[tuple[int, int, str]]]:
+    """
+    Gets the id and the unfinished shards of the interrupted full backup,
+    or plans a new one from the sizes in the database, or a scan if there are none
+    """
+    resumed = None if restart else get_full_backup(var_storer)
+    if resumed is not None:
+        print(f"Resuming the full backup, {len(resumed[1])} shards left")
+        return resumed
+
+    root = Path(var_storer.LOCAL_DIR)
+    tree = None if scan else size_tree_from_db(var_storer, root)
+    if tree is None:
+        print("Scanning for the sizes of the shards")
+        tree = size_tree_from_scan(var_storer, root)
+
+    plan = plan_shards(tree, shards)
+    backup_id = start_full_backup(var_storer, plan)
+    print(f"Split {tree.size / 1e9:.1f} GB into {len(plan)} shards")
+    return backup_id, [(shard, size, rules) for shard, (size, rules) in enumerate(plan)]
+
 
+def full_backup(workers: int, shards: int, scan: bool, restart: bool, wait: bool) -> bool:
+    """
+    Syncs every unfinished shard of the full backup. Returns whether all of them synced
+    """
+    var_storer = VariableStorer(False, Path("/home/kr9sis/PDrive"))
+
+    # Shares the lock of the regular runs, as they use the same database
+    lock = RunLock(var_storer)
+    if not lock.acquire(wait, "full"):
+        holder = lock.holder() or {}
+        print(f"PID {holder.get('pid', '?')} is running, {progress_text(holder)}")
+        return False
     try:
-        run(command, capture_output=False, timeout=25200, check=True)
+        return __sync_shards(var_storer, workers, shards, scan, restart)
+    finally:
+        lock.release()
 
-    except (TimeoutError, CalledProcessError) as e:
-        print(e)
-        sync_subdir(path)
+
+def __sync_shards(var_storer: VariableStorer, workers: int, shards: int, scan: bool, restart: bool) -> bool:
+    """
+    Syncs the unfinished shards while holding the lock
+    """
+    failed = 0
+
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        backup_id, todo = get_shards(var_storer, shards, scan, restart)
+        shared_rules = FILTER_FILE.read_text(encoding="utf-8")
+
+        with TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            for shard, size, rules in todo:
+                # The shared rules come first, then the shard's paths and nothing else
+                filter_file = Path(tmp_dir) / f"shard_{shard}.txt"
+                filter_file.write_text(f"{shared_rules}\n{rules}\n- **\n", encoding="utf-8")
+                running[pool.submit(sync_shard, var_storer, filter_file)] = (shard, size)
+
+            # Only this thread writes to the database
+            for future in as_completed(running):
+                shard, size = running[future]
+                error = future.result()
+                finish_full_backup_shard(var_storer, backup_id, shard, error is None)
+                if error is None:
+                    print(f"Synced shard {shard} ({size / 1e9:.2f} GB)")
+                else:
+                    failed += 1
+                    print(f"Shard {shard} ({size / 1e9:.2f} GB) failed: {error}")
+
+    if failed:
+        print(f"{failed} shards failed, run again to retry them")
+    return not failed
 
 
 def main():
     """
-    Start syncing SOURCE to DESTINATION
+    Start syncing LOCAL_DIR to REMOTE_DIR
     """
-    sync_dir(Path("/home/kr9sis/PDrive"))
+    parser = ArgumentParser(prog="full_backup")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=4, help="Shards synced at once"
+    )
+    parser.add_argument(
+        "-s", "--shards", type=int, default=16, help="Shards the folder is split into"
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="Size the shards by scanning the folder instead of from the database",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Plan a new full backup instead of continuing an unfinished one",
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for a running backup to finish instead of quitting",
+    )
+    args = parser.parse_args()
+
+    if not full_backup(args.workers, args.shards, args.scan, args.restart, args.wait):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,9 +2,1324 @@
 Operations pertaining to the sqlite database
 """
 
+from contextlib import contextmanager
+from datetime import datetime
+from heapq import heappop, heappush
 from pathlib import Path
-from sqlite3 import OperationalError
-from helpers import VariableStorer
+from sqlite3 import Connection, Cursor, OperationalError, connect
+from time import perf_counter, time_ns
+from typing import Iterable, Iterator
+from helpers import FileEntry, VariableStorer, get_file_entry
+
+
+# Rebuilds the SyncState rows of the files in Log matching {where} from their Log rows.
+# Log rows written after a file last synced are the attempts which didn't sync it
+SYNC_STATE_FROM_LOG = """
+    INSERT OR REPLACE INTO SyncState (file_id, synced, attempts, last_error)
+    SELECT l.file_id,
+        COUNT(*) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, '')) = 0,
+        COUNT(*) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, '')),
+        MAX(l.date) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, ''))
+    FROM Log AS l
+    JOIN (
+        SELECT file_id, MAX(date) FILTER (WHERE synced = 1) AS synced_date
+        FROM Log
+        WHERE {where}
+        GROUP BY file_id
+    ) AS s ON s.file_id = l.file_id
+    GROUP BY l.file_id;
+"""
+
+
+def __stat_time_to_ns(stat_time) -> int:
+    """
+    Converts a timestamp written by the old 'stat -c "%n %y"' scanner,
+    e.g. '2024-10-29 00:05:12.123456789' in local time, to integer nanoseconds.
+    Values which can't be parsed become 0 so the file is treated as modified once
+    """
+    if isinstance(stat_time, int):
+        return stat_time
+
+    try:
+        seconds, _, fraction = str(stat_time).partition(".")
+        whole = datetime.strptime(seconds, "%Y-%m-%d %H:%M:%S")
+        return int(whole.timestamp()) * 1_000_000_000 + int(fraction.ljust(9, "0")[:9])
+    except ValueError:
+        return 0
+
+
+def __migrate_ns_times(db_conn: Connection):
+    """
+    Version 1: store modification times as integer nanoseconds
+    and keep the size and inode of each file next to it
+    """
+    db_conn.create_function("stat_time_to_ns", 1, __stat_time_to_ns)
+    db_conn.execute(
+        """
+        CREATE TABLE Times_new (
+            parent_path TEXT,
+            file_path TEXT PRIMARY KEY,
+            modification_time INTEGER NOT NULL,
+            size INTEGER,
+            inode INTEGER,
+            FOREIGN KEY (parent_path) REFERENCES Folders (folder_path)
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        INSERT INTO Times_new (parent_path, file_path, modification_time)
+        SELECT parent_path, file_path, stat_time_to_ns(modification_time)
+        FROM Times;
+        """
+    )
+    db_conn.execute("DROP TABLE Times;")
+    db_conn.execute("ALTER TABLE Times_new RENAME TO Times;")
+
+
+def __migrate_watch_journal(db_conn: Connection):
+    """
+    Version 2: dirty directory journal filled by the watch daemon
+    and a single row describing the state of that daemon
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE Dirty (
+            dir_path TEXT PRIMARY KEY,
+            recursive INTEGER NOT NULL CHECK (recursive IN (0, 1)),
+            time INTEGER NOT NULL
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE WatchState (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pid INTEGER NOT NULL,
+            started INTEGER NOT NULL,
+            heartbeat INTEGER NOT NULL,
+            full_scan_after INTEGER
+        );
+        """
+    )
+
+
+def __migrate_parent_path_index(db_conn: Connection):
+    """
+    Version 3: index the per directory lookups of Times by parent_path
+    """
+    db_conn.execute(
+        """
+        CREATE INDEX idx_times_parent_path
+        ON Times(parent_path);
+        """
+    )
+
+
+def __migrate_content_hash(db_conn: Connection):
+    """
+    Version 4: content hash of each file as it was when last synced
+    """
+    db_conn.execute(
+        """
+        ALTER TABLE Times
+        ADD COLUMN content_hash TEXT;
+        """
+    )
+
+
+def __migrate_queue(db_conn: Connection):
+    """
+    Version 5: durable queue of every file waiting to be synced,
+    and the amount each run synced to estimate future runs with
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE Queue (
+            file_path TEXT PRIMARY KEY,
+            modification_time INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            is_dir INTEGER NOT NULL CHECK (is_dir IN (0, 1)),
+            queued INTEGER NOT NULL
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE Runs (
+            date TEXT PRIMARY KEY,
+            files_synced INTEGER NOT NULL,
+            bytes_synced INTEGER NOT NULL,
+            sync_seconds REAL NOT NULL
+        );
+        """
+    )
+
+
+def __migrate_scan_checkpoint(db_conn: Connection):
+    """
+    Version 6: directories finished by a scan which didn't complete,
+    so the next run can resume it
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE ScanState (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            root TEXT NOT NULL,
+            started INTEGER NOT NULL,
+            saved INTEGER NOT NULL
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE ScanDone (
+            dir_path TEXT PRIMARY KEY
+        );
+        """
+    )
+
+
+def __migrate_moves(db_conn: Connection):
+    """
+    Version 7: files and folders moved locally which still have to be moved on the remote
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE Moves (
+            old_path TEXT PRIMARY KEY,
+            new_path TEXT NOT NULL,
+            is_dir INTEGER NOT NULL CHECK (is_dir IN (0, 1)),
+            attempts INTEGER NOT NULL
+        );
+        """
+    )
+
+
+def __migrate_sync_state(db_conn: Connection):
+    """
+    Version 8: latest sync status of every file, so failed syncs
+    are found without going through the whole Log table
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE SyncState (
+            file_path TEXT PRIMARY KEY,
+            synced INTEGER NOT NULL CHECK (synced IN (0, 1)),
+            attempts INTEGER NOT NULL,
+            last_error TEXT
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE INDEX idx_sync_state_pending ON SyncState (file_path) WHERE synced = 0;
+        """
+    )
+    # Log rows written after a file last synced are the attempts which didn't sync it
+    db_conn.execute(
+        """
+        INSERT INTO SyncState (file_path, synced, attempts, last_error)
+        SELECT l.file_path,
+            COUNT(*) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, '')) = 0,
+            COUNT(*) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, '')),
+            MAX(l.date) FILTER (WHERE l.synced = 0 AND l.date > COALESCE(s.synced_date, ''))
+        FROM Log AS l
+        JOIN (
+            SELECT file_path, MAX(date) FILTER (WHERE synced = 1) AS synced_date
+            FROM Log
+            WHERE file_path NOT LIKE 'Start Time, PID: %'
+                AND file_path NOT LIKE 'End Time, Duration %'
+            GROUP BY file_path
+        ) AS s ON s.file_path = l.file_path
+        GROUP BY l.file_path;
+        """
+    )
+
+
+def __migrate_path_ids(db_conn: Connection):
+    """
+    Version 9: store every path once. Folders form a tree of ids with their parent's id
+    and name, Files hold a folder id and a name, and Times, Log and SyncState refer to
+    a file id instead of repeating the whole path. Start and end times move to RunTimes
+    """
+    for table in ("Folders", "Times", "Log", "SyncState"):
+        db_conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    for index in ("idx_times_parent_path", "idx_log_file_path_synced_date", "idx_sync_state_pending"):
+        db_conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+    db_conn.execute(
+        """
+        CREATE TABLE Folders (
+            folder_id INTEGER PRIMARY KEY,
+            parent_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            UNIQUE (parent_id, name)
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE Files (
+            file_id INTEGER PRIMARY KEY,
+            folder_id INTEGER NOT NULL REFERENCES Folders (folder_id),
+            name TEXT NOT NULL,
+            UNIQUE (folder_id, name)
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE Times (
+            file_id INTEGER PRIMARY KEY REFERENCES Files (file_id),
+            modification_time INTEGER NOT NULL,
+            size INTEGER,
+            inode INTEGER,
+            content_hash TEXT,
+            is_dir INTEGER NOT NULL CHECK (is_dir IN (0, 1))
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE Log (
+            date TEXT,
+            file_id INTEGER,
+            synced INTEGER CHECK (synced IN (0, 1)),
+            PRIMARY KEY (date, file_id),
+            FOREIGN KEY (date) REFERENCES Dates (date),
+            FOREIGN KEY (file_id) REFERENCES Files (file_id)
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE INDEX idx_log_file_id_synced_date ON Log (file_id, synced, date);
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE SyncState (
+            file_id INTEGER PRIMARY KEY REFERENCES Files (file_id),
+            synced INTEGER NOT NULL CHECK (synced IN (0, 1)),
+            attempts INTEGER NOT NULL,
+            last_error TEXT
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE INDEX idx_sync_state_pending ON SyncState (file_id) WHERE synced = 0;
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE RunTimes (
+            date TEXT,
+            message TEXT,
+            PRIMARY KEY (date, message)
+        );
+        """
+    )
+    # Whole paths for looking at the database by hand, e.g. in check_logs.sh
+    db_conn.execute(
+        """
+        CREATE VIEW FilePaths (file_id, file_path) AS
+        WITH RECURSIVE folder_paths (folder_id, folder_path) AS (
+            SELECT folder_id, name FROM Folders WHERE parent_id = 0
+            UNION ALL
+            SELECT f.folder_id, p.folder_path || '/' || f.name
+            FROM Folders AS f
+            JOIN folder_paths AS p ON f.parent_id = p.folder_id
+        )
+        SELECT fi.file_id, p.folder_path || '/' || fi.name
+        FROM Files AS fi
+        JOIN folder_paths AS p ON p.folder_id = fi.folder_id;
+        """
+    )
+
+    crud = Crud(db_conn)
+    db_conn.executemany(
+        """
+        INSERT INTO Times (file_id, modification_time, size, inode, content_hash, is_dir)
+        VALUES (?, ?, ?, ?, ?, ?);
+        """,
+        (
+            (crud.file_id(Path(file_path), create=True), mod_time, size, inode, content_hash, is_dir)
+            for file_path, mod_time, size, inode, content_hash, is_dir in db_conn.execute(
+                """
+                SELECT t.file_path, t.modification_time, t.size, t.inode, t.content_hash,
+                    f.folder_path IS NOT NULL
+                FROM Times_old AS t
+                LEFT JOIN Folders_old AS f ON f.folder_path = t.file_path;
+                """
+            ).fetchall()
+        ),
+    )
+    for (folder_path,) in db_conn.execute("SELECT folder_path FROM Folders_old").fetchall():
+        crud.folder_id(Path(folder_path), create=True)
+
+    log = db_conn.execute("SELECT date, file_path, synced FROM Log_old").fetchall()
+    db_conn.executemany(
+        """
+        INSERT INTO RunTimes (date, message) VALUES (?, ?);
+        """,
+        [(date, file_path) for date, file_path, _ in log if not file_path.startswith("/")],
+    )
+    db_conn.executemany(
+        """
+        INSERT INTO Log (date, file_id, synced) VALUES (?, ?, ?);
+        """,
+        [
+            (date, crud.file_id(Path(file_path), create=True), synced)
+            for date, file_path, synced in log
+            if file_path.startswith("/")
+        ],
+    )
+    db_conn.executemany(
+        """
+        INSERT INTO SyncState (file_id, synced, attempts, last_error) VALUES (?, ?, ?, ?);
+        """,
+        [
+            (crud.file_id(Path(file_path), create=True), synced, attempts, last_error)
+            for file_path, synced, attempts, last_error in db_conn.execute(
+                "SELECT file_path, synced, attempts, last_error FROM SyncState_old"
+            ).fetchall()
+        ],
+    )
+
+    for table in ("SyncState", "Log", "Times", "Folders"):
+        db_conn.execute(f"DROP TABLE {table}_old")
+
+
+def __migrate_metrics(db_conn: Connection):
+    """
+    Version 10: metrics of every run, e.g. how long each phase took
+    and how many files were scanned and uploaded
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE Metrics (
+            date TEXT,
+            name TEXT,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (date, name, labels)
+        );
+        """
+    )
+
+
+def __migrate_full_backup(db_conn: Connection):
+    """
+    Version 11: the shards of full backups and which of them finished,
+    so an interrupted full backup only syncs the rest
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE FullBackups (
+            backup_id INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            started INTEGER NOT NULL,
+            finished INTEGER
+        );
+        """
+    )
+    db_conn.execute(
+        """
+        CREATE TABLE FullBackupShards (
+            backup_id INTEGER,
+            shard INTEGER,
+            rules TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER,
+            PRIMARY KEY (backup_id, shard)
+        );
+        """
+    )
+
+
+def __migrate_connectivity(db_conn: Connection):
+    """
+    Version 12: whether the remote could be reached, so runs during an outage back off
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE Connectivity (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            failures INTEGER NOT NULL,
+            last_check INTEGER NOT NULL,
+            retry_after INTEGER NOT NULL
+        );
+        """
+    )
+
+
+def __migrate_upload_timeouts(db_conn: Connection):
+    """
+    Version 13: how many times in a row each file's upload timed out
+    """
+    db_conn.execute(
+        """
+        CREATE TABLE UploadTimeouts (
+            file_id INTEGER PRIMARY KEY REFERENCES Files (file_id),
+            timeouts INTEGER NOT NULL
+        );
+        """
+    )
+
+
+# Index i upgrades the database from user_version i to i + 1
+__MIGRATIONS = [
+    __migrate_ns_times,
+    __migrate_watch_journal,
+    __migrate_parent_path_index,
+    __migrate_content_hash,
+    __migrate_queue,
+    __migrate_scan_checkpoint,
+    __migrate_moves,
+    __migrate_sync_state,
+    __migrate_path_ids,
+    __migrate_metrics,
+    __migrate_full_backup,
+    __migrate_connectivity,
+    __migrate_upload_timeouts,
+]
+
+
+def migrate_db(var_storer: VariableStorer):
+    """
+    Brings the database schema up to date by running every migration
+    newer than the PRAGMA user_version stored in the database
+    """
+    version = var_storer.db_conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(__MIGRATIONS[version:], start=version + 1):
+        if var_storer.STDOUT:
+            print(f"Migrating database to version {number}")
+        var_storer.db_conn.execute("BEGIN")
+        migration(var_storer.db_conn)
+        var_storer.db_conn.execute(f"PRAGMA user_version = {number}")
+        var_storer.db_conn.commit()
+
+    if version < len(__MIGRATIONS):
+        # Give the space of rewritten tables back to the filesystem
+        var_storer.db_conn.execute("VACUUM")
+
+
+class TimedCursor(Cursor):
+    """
+    Cursor adding the time spent in each of its SQLite calls, including each row read
+    by iterating over it, to its connection's db_seconds
+    """
+
+    def execute(self, *args):
+        start = perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+    def executemany(self, *args):
+        start = perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+    def fetchone(self):
+        start = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+    def fetchall(self):
+        start = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+    def fetchmany(self, *args):
+        start = perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+    def __next__(self):
+        # Rows read by iterating over the cursor
+        start = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self.connection.db_seconds += perf_counter() - start
+
+
+class TimedConnection(Connection):
+    """
+    Connection keeping the total time spent in SQLite calls in db_seconds
+    """
+
+    db_seconds = 0.0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.db_seconds += perf_counter() - start
+
+
+def connect_db(db_file: Path) -> TimedConnection:
+    """
+    Opens the database in WAL mode with synchronous=NORMAL, so commits don't
+    wait for an fsync and the watch daemon can write while a run reads.
+    A commit can only be lost on power failure, never leave the database corrupt
+    """
+    db_conn = connect(db_file, timeout=30, cached_statements=256, factory=TimedConnection)
+    db_conn.execute("PRAGMA journal_mode = WAL;")
+    db_conn.execute("PRAGMA synchronous = NORMAL;")
+    return db_conn
+
+
+class Crud:
+    """
+    Create, Read, Update and Delete operations on the Times, Folders, Files and Log tables.
+    Paths are stored once, as a tree of folder ids and the names within them, and the
+    ids looked up are cached for the life of the instance.
+    The SQL of each method is a fixed string so sqlite3's statement cache
+    keeps it prepared, and rows are written in batches with executemany.
+    The scan phase is one transaction, committed by write_db_mod_files or a
+    scan checkpoint, so a run which stops before syncing leaves the database untouched
+    """
+
+    # Synced files buffered before their Log and Times rows are updated
+    BATCH_SIZE = 100
+
+    def __init__(self, db_conn: Connection) -> None:
+        self.db_conn = db_conn
+        self.synced: list[tuple[str, FileEntry]] = []
+        self.failed: list[tuple[str, FileEntry, bool]] = []
+        # Content hashes of modified files, stored once they have synced
+        self.hashes: dict[Path, str] = {}
+        # Whether added and removed files are kept for move detection
+        self.track_moves = False
+        self.added: list[FileEntry] = []
+        self.removed: list[FileEntry] = []
+        # Rows of everything removed, with its content hash, by path
+        self.removed_rows: dict[Path, tuple[FileEntry, str | None]] = {}
+        self.folder_ids: dict[Path, int] = {}
+        self.folder_paths: dict[int, Path] = {}
+        self.file_ids: dict[Path, int] = {}
+        # Whether rows were removed since the ids were last pruned
+        self.prune_due = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits everything written within the block, or rolls it back on an exception
+        """
+        try:
+            yield self
+            self.db_conn.commit()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def rollback(self):
+        """
+        Rolls back everything written since the last commit
+        """
+        self.db_conn.rollback()
+        # Ids inserted since are gone
+        self.folder_ids.clear()
+        self.folder_paths.clear()
+        self.file_ids.clear()
+
+    def folder_id(self, path: Path, create: bool = False) -> int | None:
+        """
+        Gets the id of a folder, adding it and the folders above it if create is set.
+        Returns None if it isn't in the database
+        """
+        folder_id = self.folder_ids.get(path)
+        if folder_id is not None:
+            return folder_id
+
+        if path == path.parent:
+            parent_id, name = 0, ""
+        else:
+            parent_id = self.folder_id(path.parent, create)
+            if parent_id is None:
+                return None
+            name = path.name
+
+        row = self.db_conn.execute(
+            """
+            SELECT folder_id FROM Folders
+            WHERE parent_id = ? AND name = ?;
+            """,
+            (parent_id, name),
+        ).fetchone()
+        if row is not None:
+            folder_id = row[0]
+        elif create:
+            folder_id = self.db_conn.execute(
+                """
+                INSERT INTO Folders (parent_id, name) VALUES (?, ?);
+                """,
+                (parent_id, name),
+            ).lastrowid
+        else:
+            return None
+
+        self.folder_ids[path] = folder_id
+        self.folder_paths[folder_id] = path
+        return folder_id
+
+    def folder_path(self, folder_id: int) -> Path:
+        """
+        Gets the path of a folder from its id
+        """
+        path = self.folder_paths.get(folder_id)
+        if path is not None:
+            return path
+
+        parent_id, name = self.db_conn.execute(
+            """
+            SELECT parent_id, name FROM Folders
+            WHERE folder_id = ?;
+            """,
+            (folder_id,),
+        ).fetchone()
+        path = Path("/") if parent_id == 0 else self.folder_path(parent_id) / name
+
+        self.folder_ids[path] = folder_id
+        self.folder_paths[folder_id] = path
+        return path
+
+    def file_id(self, path: Path, create: bool = False) -> int | None:
+        """
+        Gets the id of a file or folder's entry in its parent folder,
+        adding it if create is set. Returns None if it isn't in the database
+        """
+        file_id = self.file_ids.get(path)
+        if file_id is not None:
+            return file_id
+
+        folder_id = self.folder_id(path.parent, create)
+        if folder_id is None:
+            return None
+
+        row = self.db_conn.execute(
+            """
+            SELECT file_id FROM Files
+            WHERE folder_id = ? AND name = ?;
+            """,
+            (folder_id, path.name),
+        ).fetchone()
+        if row is not None:
+            file_id = row[0]
+        elif create:
+            file_id = self.db_conn.execute(
+                """
+                INSERT INTO Files (folder_id, name) VALUES (?, ?);
+                """,
+                (folder_id, path.name),
+            ).lastrowid
+        else:
+            return None
+
+        self.file_ids[path] = file_id
+        return file_id
+
+    def path_of(self, file_id: int) -> Path:
+        """
+        Gets the path of a file from its id
+        """
+        folder_id, name = self.db_conn.execute(
+            """
+            SELECT folder_id, name FROM Files
+            WHERE file_id = ?;
+            """,
+            (file_id,),
+        ).fetchone()
+        return self.folder_path(folder_id) / name
+
+    def __file_ids(self, files: Iterable[FileEntry]) -> list[tuple[int, FileEntry]]:
+        """
+        Gets the ids of files, adding the ones which aren't in the database yet
+        """
+        return [(self.file_id(file.path, create=True), file) for file in files]
+
+    def files_in_dir(self, cwd: Path) -> list[FileEntry]:
+        """
+        Gets the files directly within cwd
+        """
+        folder_id = self.folder_id(cwd)
+        if folder_id is None:
+            return []
+
+        db_files = self.db_conn.execute(
+            """
+            SELECT f.name, t.modification_time, t.size, t.inode, t.is_dir
+            FROM Files AS f
+            JOIN Times AS t ON t.file_id = f.file_id
+            WHERE f.folder_id = ?;
+            """,
+            (folder_id,),
+        ).fetchall()
+
+        return [
+            FileEntry(cwd / name, mod_time, size or 0, inode or 0, bool(is_dir))
+            for name, mod_time, size, inode, is_dir in db_files
+        ]
+
+    def files_below(self, root: Path) -> Iterator[FileEntry]:
+        """
+        Yields every file below root sorted by its full path string, reading
+        each folder once it's reached, so memory only holds the folders pending
+        """
+        pending: list[tuple[str, FileEntry]] = []
+        for file in self.files_in_dir(root):
+            heappush(pending, (str(file.path), file))
+
+        while pending:
+            _, file = heappop(pending)
+            if file.is_dir:
+                for sub_file in self.files_in_dir(file.path):
+                    heappush(pending, (str(sub_file.path), sub_file))
+            yield file
+
+    def add_files(self, added: Iterable[FileEntry]):
+        """
+        Inserts newly created files and folders
+        """
+        added = list(added)
+        if self.track_moves:
+            self.added.extend(added)
+        for entry in added:
+            if entry.is_dir:
+                self.folder_id(entry.path, create=True)
+        self.db_conn.executemany(
+            """
+            INSERT INTO Times (file_id, modification_time, size, inode, is_dir)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            [
+                (file_id, entry.mod_time, entry.size, entry.inode, int(entry.is_dir))
+                for file_id, entry in self.__file_ids(added)
+            ],
+        )
+
+    def remove_files(self, removed: Iterable[FileEntry]):
+        """
+        Deletes removed files, and removed folders along with everything below them.
+        Entries below a removed folder are covered by its deletion, so each removed
+        subtree is one delete over the folders below it. Folders and Files rows
+        are left to prune_ids(), as the Log rows of removed files still point to them
+        """
+        removed = list(removed)
+        self.prune_due = self.prune_due or bool(removed)
+        if self.track_moves:
+            self.removed.extend(removed)
+
+        roots: list[FileEntry] = []
+        for entry in sorted(removed, key=lambda entry: entry.path.parts):
+            if not roots or not entry.path.is_relative_to(roots[-1].path):
+                roots.append(entry)
+
+        # Files have no folder below them, which matches no rows in the subtree
+        subtrees = [
+            (self.folder_id(root.path) if root.is_dir else None, self.file_id(root.path))
+            for root in roots
+        ]
+        if self.track_moves:
+            for subtree in subtrees:
+                self.__keep_removed_rows(*subtree)
+
+        self.db_conn.executemany(
+            """
+            WITH RECURSIVE subtree (folder_id) AS (
+                SELECT ?
+                UNION ALL
+                SELECT f.folder_id FROM Folders AS f
+                JOIN subtree AS s ON f.parent_id = s.folder_id
+            )
+            DELETE FROM Times
+            WHERE file_id = ?
+                OR file_id IN (SELECT file_id FROM Files WHERE folder_id IN subtree);
+            """,
+            subtrees,
+        )
+
+    def __keep_removed_rows(self, folder_id: int | None, file_id: int):
+        """
+        Keeps the rows of a removed file, or a removed folder and everything below it,
+        before they're deleted
+        """
+        rows = self.db_conn.execute(
+            """
+            WITH RECURSIVE subtree (folder_id) AS (
+                SELECT ?
+                UNION ALL
+                SELECT f.folder_id FROM Folders AS f
+                JOIN subtree AS s ON f.parent_id = s.folder_id
+            )
+            SELECT f.folder_id, f.name, t.modification_time, t.size, t.inode,
+                t.is_dir, t.content_hash
+            FROM Files AS f
+            JOIN Times AS t ON t.file_id = f.file_id
+            WHERE f.file_id = ? OR f.folder_id IN subtree;
+            """,
+            (folder_id, file_id),
+        ).fetchall()
+
+        for folder_id, name, mod_time, size, inode, is_dir, content_hash in rows:
+            file_path = self.folder_path(folder_id) / name
+            self.removed_rows[file_path] = (
+                FileEntry(file_path, mod_time, size or 0, inode or 0, bool(is_dir)),
+                content_hash,
+            )
+
+    def prune_ids(self):
+        """
+        Deletes the Files rows no Times, Log, SyncState or UploadTimeouts row refers to,
+        and then the Folders rows which hold no file and aren't an existing folder,
+        unless a folder below them is kept. Only runs if rows were removed since
+        the last time, and clears the cached ids as deleted ones may be reused
+        """
+        if not self.prune_due:
+            return
+
+        self.db_conn.execute(
+            """
+            DELETE FROM Files
+            WHERE NOT EXISTS (SELECT 1 FROM Times AS t WHERE t.file_id = Files.file_id)
+                AND NOT EXISTS (SELECT 1 FROM Log AS l WHERE l.file_id = Files.file_id)
+                AND NOT EXISTS (SELECT 1 FROM SyncState AS s WHERE s.file_id = Files.file_id)
+                AND NOT EXISTS (SELECT 1 FROM UploadTimeouts AS u WHERE u.file_id = Files.file_id);
+            """
+        )
+        # A folder's own entry is the Files row with its parent's id and its name
+        self.db_conn.execute(
+            """
+            WITH RECURSIVE kept (folder_id) AS (
+                SELECT f.folder_id FROM Folders AS f
+                WHERE f.parent_id = 0
+                    OR EXISTS (SELECT 1 FROM Files AS fi WHERE fi.folder_id = f.folder_id)
+                    OR EXISTS (
+                        SELECT 1 FROM Files AS fi
+                        JOIN Times AS t ON t.file_id = fi.file_id
+                        WHERE fi.folder_id = f.parent_id AND fi.name = f.name
+                    )
+                UNION
+                SELECT f.parent_id FROM Folders AS f
+                JOIN kept AS k ON k.folder_id = f.folder_id
+            )
+            DELETE FROM Folders
+            WHERE folder_id NOT IN kept;
+            """
+        )
+        self.folder_ids.clear()
+        self.folder_paths.clear()
+        self.file_ids.clear()
+        self.prune_due = False
+
+    def get_hashes(
+        self, files: Iterable[FileEntry]
+    ) -> dict[Path, tuple[int, int, int, str | None]]:
+        """
+        Gets the stored inode, size, modification time and content hash of files
+        """
+        ret = {}
+        for file in files:
+            row = self.db_conn.execute(
+                """
+                SELECT inode, size, modification_time, content_hash
+                FROM Times
+                WHERE file_id = ?;
+                """,
+                (self.file_id(file.path),),
+            ).fetchone()
+            if row is not None:
+                ret[file.path] = row
+        return ret
+
+    def mark_unchanged(self, files: Iterable[FileEntry]):
+        """
+        Updates the modification time and inode of files whose contents
+        are the same as when they were last synced
+        """
+        self.db_conn.executemany(
+            """
+            UPDATE Times
+            SET modification_time = ?, inode = ?
+            WHERE file_id = ?;
+            """,
+            [(file.mod_time, file.inode, self.file_id(file.path)) for file in files],
+        )
+
+    def log_files(self, date: str, files: Iterable[FileEntry]):
+        """
+        Logs files as not yet synced for the run started at date
+        """
+        self.db_conn.execute(
+            """
+            INSERT OR IGNORE INTO Dates (date) VALUES (?);
+            """,
+            (date,),
+        )
+        file_ids = [file_id for file_id, _ in self.__file_ids(files)]
+        self.db_conn.executemany(
+            """
+            INSERT INTO Log (date, file_id, synced) VALUES (?, ?, 0);
+            """,
+            [(date, file_id) for file_id in file_ids],
+        )
+        # Attempts count the runs since the file last synced
+        self.db_conn.executemany(
+            """
+            INSERT INTO SyncState (file_id, synced, attempts, last_error)
+            VALUES (?, 0, 1, NULL)
+            ON CONFLICT (file_id) DO UPDATE
+            SET attempts = CASE WHEN synced = 1 THEN 1 ELSE attempts + 1 END,
+                synced = 0;
+            """,
+            [(file_id,) for file_id in file_ids],
+        )
+
+    def mark_synced(self, date: str, file: FileEntry):
+        """
+        Buffers a file which synced, writing the buffer once it's full
+        """
+        self.synced.append((date, file))
+        if len(self.synced) >= self.BATCH_SIZE:
+            self.flush()
+
+    def mark_failed(self, date: str, file: FileEntry, timed_out: bool = False):
+        """
+        Buffers a file which failed to sync, written along with the synced files.
+        Timeouts in a row are counted, any other outcome ends the streak
+        """
+        self.failed.append((date, file, timed_out))
+
+    def flush(self):
+        """
+        Writes the buffered synced and failed files in one transaction. If the program
+        dies before this, the files are still logged as not synced and retried
+        """
+        if not self.synced and not self.failed:
+            return
+
+        with self.transaction():
+            synced = [(date, self.file_id(file.path, create=True), file) for date, file in self.synced]
+            self.db_conn.executemany(
+                """
+                UPDATE SyncState
+                SET last_error = ?
+                WHERE file_id = ?;
+                """,
+                [(date, self.file_id(file.path, create=True)) for date, file, _ in self.failed],
+            )
+            self.db_conn.executemany(
+                """
+                INSERT INTO UploadTimeouts (file_id, timeouts) VALUES (?, 1)
+                ON CONFLICT (file_id) DO UPDATE
+                SET timeouts = timeouts + 1;
+                """,
+                [(self.file_id(file.path),) for _, file, timed_out in self.failed if timed_out],
+            )
+            self.db_conn.executemany(
+                """
+                DELETE FROM UploadTimeouts
+                WHERE file_id = ?;
+                """,
+                [(file_id,) for _, file_id, _ in synced]
+                + [(self.file_id(file.path),) for _, file, timed_out in self.failed if not timed_out],
+            )
+            self.db_conn.executemany(
+                """
+                UPDATE SyncState
+                SET synced = 1, attempts = 0, last_error = NULL
+                WHERE file_id = ?;
+                """,
+                [(file_id,) for _, file_id, _ in synced],
+            )
+            self.db_conn.executemany(
+                """
+                UPDATE Log
+                SET synced = 1
+                WHERE date = ? AND file_id = ?;
+                """,
+                [(date, file_id) for date, file_id, _ in synced],
+            )
+            self.db_conn.executemany(
+                """
+                UPDATE Times
+                SET modification_time = ?, size = ?, inode = ?, content_hash = ?
+                WHERE file_id = ?;
+                """,
+                # Without a hash from this run the stored one is outdated
+                [
+                    (file.mod_time, file.size, file.inode, self.hashes.get(file.path), file_id)
+                    for _, file_id, file in synced
+                ],
+            )
+            self.db_conn.executemany(
+                """
+                DELETE FROM Queue
+                WHERE file_path = ? AND modification_time = ?;
+                """,
+                [(str(file.path), file.mod_time) for _, file in self.synced],
+            )
+        self.synced = []
+        self.failed = []
+
+    def queue_files(self, files: Iterable[FileEntry], now: int):
+        """
+        Adds files to the sync queue, or updates them if they changed again
+        while queued, keeping the time their first change was seen
+        """
+        self.db_conn.executemany(
+            """
+            INSERT INTO Queue (file_path, modification_time, size, inode, is_dir, queued)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (file_path) DO UPDATE
+            SET modification_time = excluded.modification_time,
+                size = excluded.size,
+                inode = excluded.inode,
+                is_dir = excluded.is_dir;
+            """,
+            [
+                (str(file.path), file.mod_time, file.size, file.inode, int(file.is_dir), now)
+                for file in files
+            ],
+        )
+
+    def get_queue(self) -> list[tuple[FileEntry, int]]:
+        """
+        Gets every queued file along with the time it was queued
+        """
+        queue = self.db_conn.execute(
+            """
+            SELECT file_path, modification_time, size, inode, is_dir, queued
+            FROM Queue;
+            """
+        ).fetchall()
+
+        return [
+            (FileEntry(Path(file_path), mod_time, size, inode, bool(is_dir)), queued)
+            for file_path, mod_time, size, inode, is_dir, queued in queue
+        ]
+
+    def unlog_files(self, date: str, files: Iterable[FileEntry]):
+        """
+        Removes files which were logged but never attempted this run.
+        They stay queued for the next one
+        """
+        file_ids = [(file_id,) for file_id, _ in self.__file_ids(files)]
+        self.prune_due = self.prune_due or bool(file_ids)
+        with self.transaction():
+            self.db_conn.executemany(
+                """
+                DELETE FROM Log
+                WHERE date = ? AND file_id = ? AND synced = 0;
+                """,
+                [(date, file_id) for (file_id,) in file_ids],
+            )
+            self.db_conn.executemany(
+                """
+                DELETE FROM SyncState
+                WHERE file_id = ?;
+                """,
+                file_ids,
+            )
+            self.db_conn.executemany(SYNC_STATE_FROM_LOG.format(where="file_id = ?"), file_ids)
+
+    def get_timeout_streaks(self) -> dict[Path, int]:
+        """
+        Gets how many times in a row the upload of each file which timed out last did so
+        """
+        rows = self.db_conn.execute(
+            """
+            SELECT file_id, timeouts
+            FROM UploadTimeouts;
+            """
+        ).fetchall()
+        return {self.path_of(file_id): timeouts for file_id, timeouts in rows}
+
+    def record_run(self, date: str, files: int, size: int, seconds: float):
+        """
+        Records how much a run synced and how long it took
+        """
+        with self.transaction():
+            self.db_conn.execute(
+                """
+                INSERT OR REPLACE INTO Runs (date, files_synced, bytes_synced, sync_seconds)
+                VALUES (?, ?, ?, ?);
+                """,
+                (date, files, size, seconds),
+            )
+
+    def unqueue_files(self, files: Iterable[FileEntry]):
+        """
+        Removes files from the sync queue
+        """
+        self.db_conn.executemany(
+            """
+            DELETE FROM Queue
+            WHERE file_path = ?;
+            """,
+            [(str(file.path),) for file in files],
+        )
+
+    def set_hashes(self, hashes: dict[Path, str]):
+        """
+        Stores the content hashes of files which are already synced
+        """
+        self.db_conn.executemany(
+            """
+            UPDATE Times
+            SET content_hash = ?
+            WHERE file_id = ?;
+            """,
+            [(content_hash, self.file_id(path)) for path, content_hash in hashes.items()],
+        )
+
+    def add_moves(self, moves: Iterable[tuple[FileEntry, FileEntry]]):
+        """
+        Records moves to be made on the remote. Files below the old path which
+        are still waiting to be synced or retried are moved to the new path
+        """
+        moves = list(moves)
+        self.db_conn.executemany(
+            """
+            INSERT OR REPLACE INTO Moves (old_path, new_path, is_dir, attempts)
+            VALUES (?, ?, ?, 0);
+            """,
+            [(str(old.path), str(new.path), int(old.is_dir)) for old, new in moves],
+        )
+
+        renames = [
+            (str(new.path), len(str(old.path)) + 1, str(old.path), f"{old.path}/", f"{old.path}0")
+            for old, new in moves
+        ]
+        file_renames = []
+        for old, new in moves:
+            pending = self.db_conn.execute(
+                """
+                WITH RECURSIVE subtree (folder_id) AS (
+                    SELECT ?
+                    UNION ALL
+                    SELECT f.folder_id FROM Folders AS f
+                    JOIN subtree AS s ON f.parent_id = s.folder_id
+                )
+                SELECT DISTINCT file_id FROM Log
+                WHERE synced = 0 AND (
+                    file_id = ?
+                    OR file_id IN (SELECT file_id FROM Files WHERE folder_id IN subtree)
+                );
+                """,
+                (self.folder_id(old.path) if old.is_dir else None, self.file_id(old.path)),
+            ).fetchall()
+            file_renames.extend(
+                (self.file_id(new.path / self.path_of(file_id).relative_to(old.path), create=True), file_id)
+                for (file_id,) in pending
+            )
+
+        self.db_conn.executemany(
+            """
+            UPDATE OR IGNORE Log
+            SET file_id = ?
+            WHERE synced = 0 AND file_id = ?;
+            """,
+            file_renames,
+        )
+        self.db_conn.executemany(
+            """
+            UPDATE OR REPLACE SyncState
+            SET file_id = ?
+            WHERE synced = 0 AND file_id = ?;
+            """,
+            file_renames,
+        )
+        self.db_conn.executemany(
+            """
+            UPDATE OR REPLACE Queue
+            SET file_path = ? || substr(file_path, ?)
+            WHERE file_path = ? OR (file_path > ? AND file_path < ?);
+            """,
+            renames,
+        )
+
+    def get_moves(self) -> list[tuple[Path, Path, bool, int]]:
+        """
+        Gets the moves waiting to be made on the remote, in the order they were made locally
+        """
+        moves = self.db_conn.execute(
+            """
+            SELECT old_path, new_path, is_dir, attempts
+            FROM Moves
+            ORDER BY rowid;
+            """
+        ).fetchall()
+
+        return [
+            (Path(old_path), Path(new_path), bool(is_dir), attempts)
+            for old_path, new_path, is_dir, attempts in moves
+        ]
+
+    def finish_move(self, old_path: Path, moved: bool):
+        """
+        Removes a move which was made, or counts a failed attempt at it
+        """
+        with self.transaction():
+            if moved:
+                self.db_conn.execute(
+                    """
+                    DELETE FROM Moves
+                    WHERE old_path = ?;
+                    """,
+                    (str(old_path),),
+                )
+            else:
+                self.db_conn.execute(
+                    """
+                    UPDATE Moves
+                    SET attempts = attempts + 1
+                    WHERE old_path = ?;
+                    """,
+                    (str(old_path),),
+                )
+
+    def get_run_history(self, runs: int) -> list[tuple[int, int, float]]:
+        """
+        Gets the files and bytes synced and seconds taken by the latest runs
+        """
+        return self.db_conn.execute(
+            """
+            SELECT files_synced, bytes_synced, sync_seconds
+            FROM Runs
+            WHERE files_synced > 0
+            ORDER BY date DESC
+            LIMIT ?;
+            """,
+            (runs,),
+        ).fetchall()
 
 
 def get_count_or_setup_db(var_storer: VariableStorer) -> bool:
@@ -15,10 +1330,8 @@ def get_count_or_setup_db(var_storer: VariableStorer) -> bool:
     try:
         # Check if database is already set up
         var_storer.file_count = var_storer.db_conn.execute(
-            "SELECT COUNT(file_path) FROM Times"
+            "SELECT COUNT(*) FROM Times"
         ).fetchone()[0]
-        return False
-
     except OperationalError:
         # If not, then set it up
         var_storer.db_conn.execute("PRAGMA foreign_keys = ON;")
@@ -80,6 +1393,7 @@ def get_count_or_setup_db(var_storer: VariableStorer) -> bool:
         )
 
         var_storer.db_conn.commit()
+        migrate_db(var_storer)
 
         with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
             print(
@@ -89,6 +1403,10 @@ def get_count_or_setup_db(var_storer: VariableStorer) -> bool:
 
         return True
 
+    # Outside the try, so an error while migrating isn't taken for a missing database
+    migrate_db(var_storer)
+    return False
+
 
 def log_start_end_times_db(var_storer: VariableStorer, time: str, msg: str):
     """
@@ -96,112 +1414,389 @@ def log_start_end_times_db(var_storer: VariableStorer, time: str, msg: str):
     """
     var_storer.db_conn.execute(
         """
-        INSERT INTO Log (date, file_path, synced) VALUES (?, ?, 1)
+        INSERT INTO RunTimes (date, message) VALUES (?, ?)
         """,
         (time, msg),
     )
 
 
+def record_metrics(var_storer: VariableStorer, date: str, rows: list[tuple[str, str, float]]):
+    """
+    Writes the metrics of the run started at date
+    """
+    var_storer.db_conn.executemany(
+        """
+        INSERT OR REPLACE INTO Metrics (date, name, labels, value) VALUES (?, ?, ?, ?)
+        """,
+        [(date, name, labels, value) for name, labels, value in rows],
+    )
+
+
 def write_db_mod_files(var_storer: VariableStorer):
     """
     Writes mod files to database to keep track of which files were modified
-    and writes the number of modified files to the run log
+    and writes the number of modified files to the run log.
+    Commits the scan phase's transaction
     """
-    file_data = [
-        (var_storer.now, str(file_path[0]), 0) for file_path in var_storer.mod_times
-    ]
-
     if var_storer.STDOUT:
         print("\nModified files:")
-        _ = [print(file_path[0]) for file_path in var_storer.mod_times]
+        _ = [print(file.path) for file in var_storer.mod_times]
         print()
 
-    var_storer.db_conn.execute(
+    with var_storer.crud.transaction():
+        var_storer.crud.log_files(var_storer.now, var_storer.mod_times)
+
+    write_num_mod_files(var_storer)
+
+
+def write_num_mod_files(var_storer: VariableStorer):
+    """
+    Writes the number of modified files to the run log
+    """
+    with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+        mod_nums = f"# Files {len(var_storer.mod_times)} "
+        if len(mod_nums) < 13:
+            str_diff = 13 - len(mod_nums)
+            mod_nums += " " * str_diff
+        print(mod_nums, file=log_file, end="")
+
+
+def update_db_mod_file(var_storer: VariableStorer, file: FileEntry):
+    """
+    Function which updates the sync status, modification_time, size and inode for a specific file.
+    The update is buffered, call var_storer.crud.flush() once syncing is done
+    """
+    var_storer.crud.mark_synced(var_storer.now, file)
+
+
+def get_num_synced_files(var_storer: VariableStorer) -> int:
+    """
+    Counts the number of files which synced this run and returns it
+    :return: The number of files which successfully synced this time around
+    """
+    ret = var_storer.db_conn.execute(
         """
-        INSERT OR IGNORE INTO Dates (date) VALUES (?)
+        SELECT COUNT(*) FROM Log
+        WHERE date = ? AND synced = 1
         """,
         (var_storer.now,),
+    ).fetchone()[0]
+
+    return ret if ret else 0
+
+
+def get_fails(var_storer: VariableStorer) -> list[FileEntry]:
+    """
+    Gets all failed syncs from db and returns them with their current
+    modification times so a successful retry records what was uploaded
+    """
+    ret = var_storer.db_conn.execute(
+        """
+        SELECT file_id
+        FROM SyncState
+        WHERE synced = 0
+        """
+    ).fetchall()
+
+    return [get_file_entry(var_storer.crud.path_of(file_id)) for (file_id,) in ret]
+
+
+def get_journal(var_storer: VariableStorer) -> list[tuple[Path, bool]] | None:
+    """
+    Gets the directories journaled by the watch daemon as (path, recursive) tuples.
+    Returns None when the journal can't be trusted and a full scan is needed,
+    i.e. no daemon has written a heartbeat within var_storer.watch_timeout seconds,
+    or it was restarted or overflowed since the last full scan
+    """
+    state = var_storer.db_conn.execute(
+        """
+        SELECT heartbeat, full_scan_after
+        FROM WatchState
+        WHERE id = 1
+        """
+    ).fetchone()
+
+    if (
+        state is None
+        or state[1] is not None
+        or state[0] < time_ns() - var_storer.watch_timeout * 1_000_000_000
+    ):
+        return None
+
+    dirty = var_storer.db_conn.execute(
+        """
+        SELECT dir_path, recursive
+        FROM Dirty
+        ORDER BY dir_path
+        """
+    ).fetchall()
+
+    return [(Path(dir_path), bool(recursive)) for dir_path, recursive in dirty]
+
+
+def clear_journal(var_storer: VariableStorer, scan_start: int, full_scan: bool):
+    """
+    Removes journal entries which were written before the scan started.
+    A full scan also clears a pending full scan request made before it started.
+    Runs in the same transaction as the scan's own changes
+    """
+    var_storer.db_conn.execute(
+        """
+        DELETE FROM Dirty
+        WHERE time < ?
+        """,
+        (scan_start,),
     )
 
+    if full_scan:
+        var_storer.db_conn.execute(
+            """
+            UPDATE WatchState
+            SET full_scan_after = NULL
+            WHERE full_scan_after < ?
+            """,
+            (scan_start,),
+        )
+
+
+def journal_dirs(
+    var_storer: VariableStorer, dirs: dict[Path, bool], full_scan: bool = False
+):
+    """
+    Writes dirty directories, as path: recursive, and the daemon's heartbeat to the database.
+    full_scan asks the next run to scan the whole tree instead of the journal
+    """
+    now = time_ns()
     var_storer.db_conn.executemany(
         """
-        INSERT INTO Log (date, file_path, synced) VALUES (?, ?, ?)
+        INSERT INTO Dirty (dir_path, recursive, time) VALUES (?, ?, ?)
+        ON CONFLICT (dir_path) DO UPDATE
+        SET recursive = MAX(recursive, excluded.recursive), time = excluded.time
+        """,
+        [(str(dir_path), int(recursive), now) for dir_path, recursive in dirs.items()],
+    )
+
+    var_storer.db_conn.execute(
+        """
+        UPDATE WatchState
+        SET heartbeat = ?, full_scan_after = COALESCE(?, full_scan_after)
+        WHERE id = 1
         """,
-        file_data,
+        (now, now if full_scan else None),
     )
+    var_storer.db_conn.commit()
 
+
+def start_watch_state(var_storer: VariableStorer, pid: int):
+    """
+    Registers a newly started watch daemon. Changes made while no daemon
+    was running are unknown, so the next run has to do a full scan
+    """
+    now = time_ns()
+    var_storer.db_conn.execute(
+        """
+        INSERT OR REPLACE INTO WatchState (id, pid, started, heartbeat, full_scan_after)
+        VALUES (1, ?, ?, ?, ?)
+        """,
+        (pid, now, now, now),
+    )
     var_storer.db_conn.commit()
 
-    with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
-        mod_nums = f"# Files {len(var_storer.mod_times)} "
-        if len(mod_nums) < 13:
-            str_diff = 13 - len(mod_nums)
-            mod_nums += " " * str_diff
-        print(mod_nums, file=log_file, end="")
+
+def get_scan_checkpoint(var_storer: VariableStorer, root: Path) -> tuple[int, set[Path]] | None:
+    """
+    Gets the start time and finished directories of an unfinished scan of root.
+    Returns None if there is none, or if it was started more than
+    var_storer.checkpoint_age seconds ago, in which case it's discarded
+    """
+    state = var_storer.db_conn.execute(
+        """
+        SELECT root, started
+        FROM ScanState
+        WHERE id = 1
+        """
+    ).fetchone()
+
+    if state is None:
+        return None
+    if (
+        state[0] != str(root)
+        or state[1] < time_ns() - var_storer.checkpoint_age * 1_000_000_000
+    ):
+        clear_scan_checkpoint(var_storer)
+        return None
+
+    done = var_storer.db_conn.execute(
+        """
+        SELECT dir_path
+        FROM ScanDone
+        """
+    ).fetchall()
+
+    return state[1], {Path(dir_path) for (dir_path,) in done}
 
 
-def update_db_mod_file(
-    var_storer: VariableStorer, file_path: str, modification_time: str
+def save_scan_checkpoint(
+    var_storer: VariableStorer,
+    root: Path,
+    started: int,
+    done: list[Path],
+    changes: list[FileEntry],
 ):
     """
-    Function which updates the sync status and modification_time for a specific file path
+    Queues the changes found in the newly finished directories and records them as done.
+    Commits the scan's transaction up to this point
     """
-    var_storer.db_conn.execute(
+    var_storer.crud.queue_files(changes, started)
+    var_storer.db_conn.executemany(
         """
-        UPDATE Log
-        SET synced = ?
-        WHERE date = ? AND file_path = ?
+        INSERT OR IGNORE INTO ScanDone (dir_path) VALUES (?)
         """,
-        (1, var_storer.now, file_path),
+        [(str(cwd),) for cwd in done],
     )
-
     var_storer.db_conn.execute(
         """
-        UPDATE Times
-        SET modification_time = ?
-        WHERE file_path = ?
+        INSERT OR REPLACE INTO ScanState (id, root, started, saved)
+        VALUES (1, ?, ?, ?)
         """,
-        (modification_time, file_path),
+        (str(root), started, time_ns()),
     )
     var_storer.db_conn.commit()
 
 
-def get_num_synced_files(var_storer: VariableStorer) -> int:
+def clear_scan_checkpoint(var_storer: VariableStorer):
     """
-    Counts the number of files which synced this run and returns it
-    :return: The number of files which successfully synced this time around
+    Removes the checkpoint of a scan. Runs in the same transaction as the scan's own changes
     """
-    ret = var_storer.db_conn.execute(
+    var_storer.db_conn.execute(
+        """
+        DELETE FROM ScanDone
+        """
+    )
+    var_storer.db_conn.execute(
         """
-        SELECT COUNT(file_path) FROM Log
-        WHERE date = ?
-            AND synced = 1
-            AND file_path NOT LIKE 'Start Time, PID: %'
-            AND file_path NOT LIKE 'End Time, Duration %'
+        DELETE FROM ScanState
+        """
+    )
+
+
+def get_full_backup(var_storer: VariableStorer) -> tuple[int, list[tuple[int, int, str]]] | None:
+    """
+    Gets the id and the unfinished shards, as (shard, bytes, rules), of the
+    unfinished full backup of LOCAL_DIR to REMOTE_DIR. Returns None if there is none
+    """
+    backup = var_storer.db_conn.execute(
+        """
+        SELECT backup_id
+        FROM FullBackups
+        WHERE source = ? AND destination = ? AND finished IS NULL
+        ORDER BY backup_id DESC
         """,
-        (var_storer.now,),
-    ).fetchone()[0]
+        (var_storer.LOCAL_DIR, var_storer.REMOTE_DIR),
+    ).fetchone()
 
-    return ret if ret else 0
+    if backup is None:
+        return None
+
+    shards = var_storer.db_conn.execute(
+        """
+        SELECT shard, bytes, rules
+        FROM FullBackupShards
+        WHERE backup_id = ? AND finished IS NULL
+        ORDER BY shard
+        """,
+        backup,
+    ).fetchall()
+    return backup[0], shards
 
 
-def get_fails(var_storer: VariableStorer) -> list[tuple[Path, str]]:
+def start_full_backup(var_storer: VariableStorer, plan: list[tuple[int, str]]) -> int:
     """
-    Gets all failed syncs from db and tries to returns them
+    Records a new full backup and its shards, given as (bytes, rules).
+    Unfinished full backups of the same directories are dropped. Returns its id
     """
-    ret = var_storer.db_conn.execute(
+    var_storer.db_conn.execute(
         """
-        SELECT MAX(date), file_path
-        FROM LOG AS l1 WHERE l1.synced = 0
-        AND NOT EXISTS (
-            SELECT 1
-            FROM Log AS l2
-            WHERE l1.file_path = l2.file_path
-            AND l2.synced = 1
-            AND l1.date < l2.date
+        DELETE FROM FullBackupShards
+        WHERE backup_id IN (
+            SELECT backup_id FROM FullBackups
+            WHERE source = ? AND destination = ? AND finished IS NULL
         )
-        GROUP BY file_path
+        """,
+        (var_storer.LOCAL_DIR, var_storer.REMOTE_DIR),
+    )
+    var_storer.db_conn.execute(
         """
-    ).fetchall()
+        DELETE FROM FullBackups
+        WHERE source = ? AND destination = ? AND finished IS NULL
+        """,
+        (var_storer.LOCAL_DIR, var_storer.REMOTE_DIR),
+    )
+    backup_id = var_storer.db_conn.execute(
+        """
+        INSERT INTO FullBackups (source, destination, started) VALUES (?, ?, ?)
+        """,
+        (var_storer.LOCAL_DIR, var_storer.REMOTE_DIR, time_ns()),
+    ).lastrowid
+    var_storer.db_conn.executemany(
+        """
+        INSERT INTO FullBackupShards (backup_id, shard, rules, bytes) VALUES (?, ?, ?, ?)
+        """,
+        [(backup_id, shard, rules, size) for shard, (size, rules) in enumerate(plan)],
+    )
+    var_storer.db_conn.commit()
+    return backup_id
+
+
+def finish_full_backup_shard(var_storer: VariableStorer, backup_id: int, shard: int, synced: bool):
+    """
+    Records an attempt at syncing a shard, and marks it finished if it synced.
+    The full backup is finished with its last shard
+    """
+    var_storer.db_conn.execute(
+        """
+        UPDATE FullBackupShards
+        SET attempts = attempts + 1, finished = CASE WHEN ? THEN ? END
+        WHERE backup_id = ? AND shard = ?
+        """,
+        (synced, time_ns(), backup_id, shard),
+    )
+    var_storer.db_conn.execute(
+        """
+        UPDATE FullBackups
+        SET finished = ?
+        WHERE backup_id = ? AND NOT EXISTS (
+            SELECT 1 FROM FullBackupShards
+            WHERE backup_id = ? AND finished IS NULL
+        )
+        """,
+        (time_ns(), backup_id, backup_id),
+    )
+    var_storer.db_conn.commit()
+
+
+def get_connectivity(var_storer: VariableStorer) -> tuple[int, int] | None:
+    """
+    Gets how many connection checks in a row failed and when, in nanoseconds,
+    the remote should be checked again. Returns None if it was never checked
+    """
+    return var_storer.db_conn.execute(
+        """
+        SELECT failures, retry_after
+        FROM Connectivity
+        WHERE id = 1
+        """
+    ).fetchone()
+
 
-    return [(Path(file_path), mod_time) for mod_time, file_path in ret]
+def set_connectivity(var_storer: VariableStorer, failures: int, retry_after: int):
+    """
+    Records the result of a connection check
+    """
+    var_storer.db_conn.execute(
+        """
+        INSERT OR REPLACE INTO Connectivity (id, failures, last_check, retry_after)
+        VALUES (1, ?, ?, ?)
+        """,
+        (failures, time_ns(), retry_after),
+    )
@@ -0,0 +1,131 @@
+"""
+Diff engine comparing the files found locally with the files stored in the database
+"""
+
+from enum import Enum
+from typing import Iterable, Iterator, NamedTuple
+
+from helpers import FileEntry
+
+
+class Change(Enum):
+    """
+    The ways a file can differ between the local directory and the database
+    """
+
+    ADDED = "added"
+    REMOVED = "removed"
+    MODIFIED = "modified"
+
+
+class DiffEvent(NamedTuple):
+    """
+    A single difference. entry is the local file, or the stored one if it was removed,
+    old is the stored file for modified entries
+    """
+
+    change: Change
+    entry: FileEntry
+    old: FileEntry | None = None
+
+
+def diff_files(
+    local: Iterable[FileEntry], stored: Iterable[FileEntry]
+) -> Iterator[DiffEvent]:
+    """
+    Compares two sets of files in one pass over each side, using a path index
+    of the stored files. Added and modified files are yielded in the order
+    of local, removed files afterwards in the order of stored
+    """
+    index = {entry.path: entry for entry in stored}
+
+    for entry in local:
+        old = index.pop(entry.path, None)
+        if old is None:
+            yield DiffEvent(Change.ADDED, entry)
+        elif old.mod_time != entry.mod_time:
+            yield DiffEvent(Change.MODIFIED, entry, old)
+
+    for old in index.values():
+        yield DiffEvent(Change.REMOVED, old)
+
+
+def merge_files(
+    local: Iterable[FileEntry], stored: Iterable[FileEntry]
+) -> Iterator[DiffEvent]:
+    """
+    Compares two streams of files which are both sorted by their path string,
+    reading each side once and holding only the current entry of each in memory
+    """
+    local_iter = iter(local)
+    stored_iter = iter(stored)
+    entry = next(local_iter, None)
+    old = next(stored_iter, None)
+    entry_key = str(entry.path) if entry else None
+    old_key = str(old.path) if old else None
+
+    while entry is not None or old is not None:
+        if old is None or (entry is not None and entry_key < old_key):
+            yield DiffEvent(Change.ADDED, entry)
+            entry = next(local_iter, None)
+            entry_key = str(entry.path) if entry else None
+
+        elif entry is None or old_key < entry_key:
+            yield DiffEvent(Change.REMOVED, old)
+            old = next(stored_iter, None)
+            old_key = str(old.path) if old else None
+
+        else:
+            if old.mod_time != entry.mod_time:
+                yield DiffEvent(Change.MODIFIED, entry, old)
+            entry = next(local_iter, None)
+            entry_key = str(entry.path) if entry else None
+            old = next(stored_iter, None)
+            old_key = str(old.path) if old else None
+
+
+def __move_key(entry: FileEntry) -> tuple:
+    """
+    What stays the same when a file or directory is renamed on the same filesystem.
+    A directory's size and modification time change along with its contents
+    """
+    if entry.is_dir:
+        return entry.inode, True
+    return entry.inode, False, entry.size, entry.mod_time
+
+
+def pair_moves(
+    removed: Iterable[FileEntry], added: Iterable[FileEntry]
+) -> list[tuple[FileEntry, FileEntry]]:
+    """
+    Pairs removed entries with added entries which have the same inode, and for files
+    the same size and modification time, as (old, new) moves. Entries whose key matches
+    more than one entry on the other side, e.g. hard links, aren't paired.
+    Entries within a directory which was moved are left to their directory's move
+    """
+    added_by_key: dict[tuple, list[FileEntry]] = {}
+    for entry in added:
+        added_by_key.setdefault(__move_key(entry), []).append(entry)
+
+    removed_by_key: dict[tuple, list[FileEntry]] = {}
+    for entry in removed:
+        removed_by_key.setdefault(__move_key(entry), []).append(entry)
+
+    moves = []
+    moved_dirs: list[str] = []
+    # Directories first, so the files within a moved directory are recognised as such
+    for key, (old, *others) in sorted(
+        removed_by_key.items(), key=lambda item: (not item[1][0].is_dir, str(item[1][0].path))
+    ):
+        new_entries = added_by_key.get(key, [])
+        if others or len(new_entries) != 1 or not key[0]:
+            continue
+
+        new = new_entries[0]
+        if any(str(new.path).startswith(f"{new_dir}/") for new_dir in moved_dirs):
+            continue
+        if new.is_dir:
+            moved_dirs.append(str(new.path))
+        moves.append((old, new))
+
+    return moves
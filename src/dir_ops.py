@@ -3,173 +3,163 @@ Class to recursively go through every file in a directory and all it's subdirect
 extracting their modification times.
 """
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from heapq import heappop, heappush
+from os import scandir
 from pathlib import Path
-from subprocess import CalledProcessError, TimeoutExpired, run
+from queue import SimpleQueue
 from textwrap import dedent
+from time import monotonic
+from typing import Iterator
 
-from helpers import VariableStorer
+from db_ops import clear_scan_checkpoint, get_scan_checkpoint, save_scan_checkpoint
+from diff_ops import Change, diff_files, merge_files
+from helpers import FileEntry, VariableStorer, is_excluded
 
 
-def __get_files_in_cwd(var_storer, cwd: Path) -> list[tuple[str, str]]:
+# Seconds between saving the checkpoint of a scan
+CHECKPOINT_INTERVAL = 60
+
+
+class ScanCheckpoint:
     """
-    Function to get all files within the current working directory
-    and their modification time and return a str containing that
-    information sorted with most recent modification first
+    Saves the directories a full scan has finished, along with the changes found
+    in them, every CHECKPOINT_INTERVAL seconds. If the run dies before the scan
+    completes, the next one skips the finished directories, whose changes are
+    already queued, instead of starting over
     """
-    ret = []
-    for file in cwd.iterdir():
-        if (
-            file.name.startswith(".")
-            or file.is_symlink()
-            or any(excluded in str(file) for excluded in var_storer.excluded_paths)
-        ):
-            # Get rid of all dotfiles, symlinks and explicitly excluded files defined in main.py
-            continue
 
-        stat_cmd = ["stat", "-c", "%n %y", str(file)]
-        try:
-            stat_out = run(stat_cmd, check=True, timeout=10, capture_output=True)
-            stat_out = stat_out.stdout.decode("utf-8")
-            mod_time = stat_out[-36:-7]
-            filename = stat_out[:-37]
-            ret.append((filename, mod_time))
-
-        except (CalledProcessError, TimeoutExpired) as e:
-            with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
-                now = datetime.now().strftime("%Y-%m-%d %H:%M")
-                print(
-                    dedent(
-                        f"""
-                        \n{now}\nError occured with stat command
-                        \nCurrent working Directory:\n{cwd}
-                        \nCommand:\n{stat_cmd}\nError:\n{e}
-                        """
-                    ),
-                    file=log_file,
-                )
-    return ret
+    def __init__(self, var_storer: VariableStorer, root: Path, scan_start: int) -> None:
+        self.var_storer = var_storer
+        self.root = root
+        self.started = scan_start
+        self.finished: set[Path] = set()
+        self.done: list[Path] = []
+        self.changes: list[FileEntry] = []
+        self.last_save = monotonic()
 
+        checkpoint = get_scan_checkpoint(var_storer, root)
+        if checkpoint is not None:
+            self.started, self.finished = checkpoint
+            if var_storer.STDOUT:
+                print(f"Resuming scan, skipping {len(self.finished)} finished directories")
 
-def __create_db_files_list(var_storer, cwd: Path) -> list[tuple[Path, str]]:
-    """
-    Gets the files from the DB and turns them into a
-    list of tuples containing file paths and mod times
-    """
-    db_files = var_storer.db_conn.execute(
+    def skip(self, cwd: Path) -> list[Path] | None:
+        """
+        Returns the subdirectories of cwd if it was finished by the resumed scan
+        """
+        if cwd not in self.finished:
+            return None
+        if not cwd.is_dir():
+            return []
+        return [file.path for file in self.var_storer.crud.files_in_dir(cwd) if file.is_dir]
+
+    def add(self, cwd: Path, changes: list[FileEntry]):
         """
-            SELECT file_path, modification_time
-            FROM Times
-            WHERE parent_path = ?;
-            """,
-        (str(cwd),),
-    ).fetchall()
+        Records a finished directory, saving the checkpoint when it's due
+        """
+        self.done.append(cwd)
+        self.changes.extend(changes)
+        if monotonic() - self.last_save >= CHECKPOINT_INTERVAL:
+            self.save()
 
-    return [(Path(db_f_tup[0]), db_f_tup[1]) for db_f_tup in db_files]
+    def save(self):
+        save_scan_checkpoint(self.var_storer, self.root, self.started, self.done, self.changes)
+        self.done = []
+        self.changes = []
+        self.last_save = monotonic()
 
 
-def __add_or_del_from_db(
-    var_storer, files: list[tuple[Path, str]], db_files: list[tuple[Path, str]]
-):
+def __log_scan_error(var_storer, cwd: Path, e: OSError):
     """
-    Clean up difference between local directory and database
+    Writes an error raised while scanning a directory to the run log
     """
-    local_files: set[Path] = {Path(file_tup[0]) for file_tup in files}
-    cloud_files: set[Path] = {Path(file_tup[0]) for file_tup in db_files}
+    with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M")
+        print(
+            dedent(
+                f"""
+                \n{now}\nError occured while scanning directory
+                \nCurrent working Directory:\n{cwd}
+                \nError:\n{e}
+                """
+            ),
+            file=log_file,
+        )
 
-    diff = local_files.symmetric_difference(cloud_files)
 
-    for file in diff:
-        if file not in cloud_files:  # File was created locally
-            parent_dir = file.parent
-            mod_time = next(
-                (file_tup[1] for file_tup in files if file_tup[0] == file), None
-            )
-            if file.is_dir():
-                var_storer.db_conn.execute(
-                    """
-                        INSERT INTO Folders(folder_path)
-                        VALUES(?);
-                        """,
-                    (str(file),),
-                )
-                var_storer.db_conn.execute(
-                    """
-                        INSERT INTO Times(parent_path, file_path, modification_time)
-                        VALUES(?,?,?);
-                        """,
-                    (str(parent_dir), str(file), mod_time),
-                )
-            else:
-                var_storer.db_conn.execute(
-                    """
-                        INSERT INTO Times(parent_path, file_path, modification_time)
-                        VALUES(?,?,?);
-                        """,
-                    (str(parent_dir), str(file), mod_time),
-                )
-
-                var_storer.mod_times.append((file, mod_time))
-
-        elif file not in local_files:  # File was deleted locally
-            mod_time = next(
-                (file_tup[1] for file_tup in db_files if file_tup[0] == file), None
-            )
+def __get_files_in_cwd(var_storer, cwd: Path) -> list[FileEntry] | None:
+    """
+    Function to get all files within the current working directory
+    along with their modification time, size, inode and type
+    using a single non following stat call per entry.
+    Returns None if the directory couldn't be read, so its files aren't taken as deleted
+    """
+    ret = []
+    try:
+        with scandir(cwd) as entries:
+            for entry in entries:
+                if entry.is_symlink() or is_excluded(
+                    var_storer, entry.path, entry.is_dir(follow_symlinks=False)
+                ):
+                    # Get rid of symlinks and files excluded by rclone_sync_filter.txt,
+                    # excluded directories are pruned without being listed or stat'ed
+                    continue
 
-            var_storer.db_conn.execute(
-                """
-                    DELETE FROM Times 
-                    WHERE parent_path=?;
-                    """,
-                (str(file),),
-            )
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    __log_scan_error(var_storer, cwd, e)
+                    continue
 
-            var_storer.db_conn.execute(
-                """
-                    DELETE FROM Folders
-                    WHERE folder_path=?;
-                    """,
-                (str(file),),
-            )
-            var_storer.db_conn.execute(
-                """
-                    DELETE FROM Times
-                    WHERE file_path=?;
-                    """,
-                (str(file),),
-            )
+                ret.append(FileEntry.from_stat(Path(entry.path), stat))
 
-            if file.is_file:
-                var_storer.mod_times.append((file, mod_time))
+    except OSError as e:
+        __log_scan_error(var_storer, cwd, e)
+        return None
+
+    return ret
 
 
-def __check_if_modified(
-    var_storer, files: list[tuple[Path, str]], db_files: list[tuple[Path, str]]
-):
+def __process_dir(
+    var_storer, cwd: Path, files: list[FileEntry]
+) -> list[FileEntry | Path]:
     """
-    Check the given files and see if they have been
-    modified or not if they have been then either check its
-    subdirectories or log the file as modified
+    Compares a listed directory with the database, updating the database
+    and returning its created, modified and deleted files followed by its
+    subdirectories, which mark where their own modified files belong
     """
+    modified: list[FileEntry | Path] = []
+    added: list[FileEntry] = []
+    removed: list[FileEntry] = []
 
-    for file_data in files:
-        file, _ = file_data
-        if file.is_dir():
-            get_modified_files(var_storer, file)
+    for event in diff_files(files, var_storer.crud.files_in_dir(cwd)):
+        if event.change is Change.ADDED:
+            added.append(event.entry)
+        elif event.change is Change.REMOVED:
+            removed.append(event.entry)
 
-        elif (
-            file.is_file()
-            and file_data not in db_files
-            and file_data not in var_storer.mod_times
-        ):
-            var_storer.mod_times.append(file_data)
+        if event.change is Change.REMOVED or not event.entry.is_dir:
+            modified.append(event.entry)
 
-        var_storer.cur_file += 1
+    var_storer.crud.add_files(added)
+    var_storer.crud.remove_files(removed)
 
+    if var_storer.checkpoint is not None:
+        var_storer.checkpoint.add(cwd, [item for item in modified if isinstance(item, FileEntry)])
 
-def get_modified_files(var_storer: VariableStorer, cwd: Path):
+    modified.extend(file.path for file in files if file.is_dir)
+    var_storer.cur_file += len(files)
+    var_storer.metrics.add("dirs_scanned")
+    var_storer.metrics.add("files_scanned", len(files))
+
+    return modified
+
+
+def __print_progress(var_storer, cwd: Path):
     """
-    Recursively checks the cwd and every subdirectory within it
+    Prints how far into the scan the program is
     """
     if var_storer.STDOUT:
         if var_storer.file_count != -99999:
@@ -177,16 +167,232 @@ def get_modified_files(var_storer: VariableStorer, cwd: Path):
             print(f"{percent}%", end=" ")
         print(f"In {cwd}")
 
+
+def __walk_serial(var_storer, cwd: Path) -> Iterator[FileEntry]:
+    """
+    Recursively checks the cwd and every subdirectory within it on the calling thread,
+    yielding the modified files
+    """
+    __print_progress(var_storer, cwd)
+
+    if var_storer.checkpoint is not None:
+        subdirs = var_storer.checkpoint.skip(cwd)
+        if subdirs is not None:
+            for subdir in subdirs:
+                yield from __walk_serial(var_storer, subdir)
+            return
+
     files = __get_files_in_cwd(var_storer, cwd)
-    if not files:
-        return var_storer.mod_times
+    if files is None:
+        return
+
+    for item in __process_dir(var_storer, cwd, files):
+        if isinstance(item, Path):
+            yield from __walk_serial(var_storer, item)
+        else:
+            yield item
+
+
+def __walk_parallel(var_storer, root: Path, in_order: bool) -> Iterator[FileEntry]:
+    """
+    Lists and stats directories on a pool of var_storer.scan_workers threads.
+    Finished listings come back through a queue to the calling thread,
+    which is the only one touching the database connection.
+    With in_order the modified files are kept per directory and yielded at the end
+    in the order the serial walk would have produced them, otherwise they're
+    yielded as soon as their directory is done
+    """
+    done: SimpleQueue[Future] = SimpleQueue()
+    results: dict[Path, list[FileEntry | Path]] = {}
+
+    def list_dir(cwd: Path) -> tuple[Path, list[FileEntry]]:
+        return cwd, __get_files_in_cwd(var_storer, cwd)
+
+    with ThreadPoolExecutor(max_workers=var_storer.scan_workers) as pool:
+        to_list = [root]
+        pending = 0
 
-    files = [(Path(f_tup[0]), f_tup[1]) for f_tup in files]
-    db_files = __create_db_files_list(var_storer, cwd)
+        while True:
+            for cwd in to_list:
+                subdirs = None
+                if var_storer.checkpoint is not None:
+                    subdirs = var_storer.checkpoint.skip(cwd)
+                if subdirs is None:
+                    pool.submit(list_dir, cwd).add_done_callback(done.put)
+                    pending += 1
+                else:
+                    # Finished by the resumed scan, so only its subdirectories are walked
+                    if in_order:
+                        results[cwd] = list(subdirs)
+                    to_list.extend(subdirs)
 
-    if len(files) != len(db_files) or files != db_files:
-        __add_or_del_from_db(var_storer, files, db_files)
+            if not pending:
+                break
 
-    __check_if_modified(var_storer, files, db_files)
+            cwd, files = done.get().result()
+            pending -= 1
+            __print_progress(var_storer, cwd)
 
+            entries = [] if files is None else __process_dir(var_storer, cwd, files)
+            to_list = [item for item in entries if isinstance(item, Path)]
+            # Only kept until the end for in_order, so memory doesn't grow with the tree
+            if in_order:
+                results[cwd] = entries
+            else:
+                yield from (item for item in entries if isinstance(item, FileEntry))
+
+    if not in_order:
+        return
+
+    stack = [iter(results.pop(root))]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif isinstance(item, Path):
+            stack.append(iter(results.pop(item)))
+        else:
+            yield item
+
+
+def __walk_sorted(var_storer, root: Path, unreadable: list[str]) -> Iterator[FileEntry]:
+    """
+    Yields every file and directory below root sorted by its full path string,
+    the same order as Times' primary key. Directories are listed before they're
+    yielded, and the ones that couldn't be read are added to unreadable
+    """
+    pending: list[tuple[str, FileEntry]] = []
+    files = __get_files_in_cwd(var_storer, root)
+    if files is None:
+        unreadable.append(str(root))
+        return
+
+    __print_progress(var_storer, root)
+    var_storer.metrics.add("dirs_scanned")
+    for file in files:
+        heappush(pending, (str(file.path), file))
+
+    while pending:
+        path, file = heappop(pending)
+        if file.is_dir:
+            __print_progress(var_storer, file.path)
+            files = __get_files_in_cwd(var_storer, file.path)
+            if files is None:
+                unreadable.append(path)
+            else:
+                var_storer.metrics.add("dirs_scanned")
+                for sub_file in files:
+                    heappush(pending, (str(sub_file.path), sub_file))
+
+        var_storer.cur_file += 1
+        var_storer.metrics.add("files_scanned")
+        yield file
+
+
+def __walk_merge(var_storer, root: Path) -> Iterator[FileEntry]:
+    """
+    Compares the whole tree below root with the DB in a single merge join of the
+    sorted walk and the sorted Times table, yielding the modified files. Changes are
+    written after the cursor is done, so memory depends on the number of changes
+    instead of the size of the tree
+    """
+    added: list[FileEntry] = []
+    removed: list[FileEntry] = []
+    removed_dirs: set[Path] = set()
+    unreadable: list[str] = []
+
+    for event in merge_files(
+        __walk_sorted(var_storer, root, unreadable), var_storer.crud.files_below(root)
+    ):
+        if event.change is Change.REMOVED and any(
+            str(event.entry.path).startswith(f"{path}/") for path in unreadable
+        ):
+            continue  # Not deleted, only unreadable this time
+
+        if event.change is Change.ADDED:
+            added.append(event.entry)
+        elif event.change is Change.REMOVED:
+            removed.append(event.entry)
+            if any(parent in removed_dirs for parent in event.entry.path.parents):
+                continue  # Covered by its removed folder, like in the directory walks
+            if event.entry.is_dir:
+                removed_dirs.add(event.entry.path)
+
+        if event.change is Change.REMOVED or not event.entry.is_dir:
+            yield event.entry
+
+    var_storer.crud.add_files(added)
+    var_storer.crud.remove_files(removed)
+
+
+def iter_modified_files(
+    var_storer: VariableStorer, cwd: Path, in_order: bool = True
+) -> Iterator[FileEntry]:
+    """
+    Checks the cwd and every subdirectory within it for modified files, yielding each
+    one as it's found. Compares in one merge join with the DB if var_storer.merge_scan
+    is set or walks directories on a thread pool if var_storer.scan_workers > 1,
+    whose files are only yielded in the serial walk's order at the end with in_order.
+    The directory walks save and resume from var_storer.checkpoint if it's set
+    """
+    if var_storer.merge_scan:
+        yield from __walk_merge(var_storer, cwd)
+    elif var_storer.scan_workers > 1:
+        yield from __walk_parallel(var_storer, cwd, in_order)
+    else:
+        yield from __walk_serial(var_storer, cwd)
+
+    if var_storer.checkpoint is not None and var_storer.checkpoint.root == cwd:
+        # Completed, so the next run starts a new scan
+        clear_scan_checkpoint(var_storer)
+        var_storer.checkpoint = None
+
+
+def get_modified_files(var_storer: VariableStorer, cwd: Path):
+    """
+    Adds every modified file in the cwd and the subdirectories within it to
+    var_storer.mod_times, see iter_modified_files
+    """
+    var_storer.mod_times.extend(iter_modified_files(var_storer, cwd))
+    return var_storer.mod_times
+
+
+def iter_journaled_files(
+    var_storer: VariableStorer, dirty: list[tuple[Path, bool]], in_order: bool = True
+) -> Iterator[FileEntry]:
+    """
+    Checks only the directories journaled by the watch daemon, sorted by path,
+    yielding the modified files. Recursive entries, i.e. directories created or moved
+    in while being watched, are walked like a full scan, other directories only have
+    their own files compared with the database
+    """
+    recursive_roots: list[Path] = []
+
+    for cwd, recursive in dirty:
+        if not cwd.is_dir() or any(
+            root == cwd or root in cwd.parents for root in recursive_roots
+        ):
+            # Deleted directories are picked up by their parent's entry
+            continue
+
+        if recursive:
+            recursive_roots.append(cwd)
+            yield from iter_modified_files(var_storer, cwd, in_order)
+            continue
+
+        __print_progress(var_storer, cwd)
+        files = __get_files_in_cwd(var_storer, cwd)
+        if files is not None:
+            yield from (
+                item for item in __process_dir(var_storer, cwd, files)
+                if not isinstance(item, Path)
+            )
+
+
+def get_journaled_files(var_storer: VariableStorer, dirty: list[tuple[Path, bool]]):
+    """
+    Adds the modified files of the directories journaled by the watch daemon
+    to var_storer.mod_times, see iter_journaled_files
+    """
+    var_storer.mod_times.extend(iter_journaled_files(var_storer, dirty))
     return var_storer.mod_times
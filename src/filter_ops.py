@@ -0,0 +1,158 @@
+"""
+Exclusion rules of the backup, read from the rclone filter file full_backup.py
+passes to rclone and compiled into one regular expression per kind of rule,
+so the scanner skips exactly what rclone skips
+"""
+
+import re
+from pathlib import Path
+
+# Filter file shared with full_backup.py, in rclone's filter file syntax
+FILTER_FILE = Path(__file__).resolve().parent.parent / "rclone_sync_filter.txt"
+
+
+def glob_to_regex(glob: str) -> str:
+    """
+    Converts an rclone filter glob to a regular expression matching a whole path
+    relative to the root. A glob starting with / is anchored to the root,
+    otherwise it matches the end of a path at any depth
+    """
+    if glob.startswith("/"):
+        regex = ""
+        glob = glob[1:]
+    elif glob.startswith("**"):
+        # Already matches any path before it
+        regex = ""
+    else:
+        regex = "(?:.*/)?"
+
+    i = 0
+    in_brackets = in_braces = False
+    while i < len(glob):
+        char = glob[i]
+        if in_brackets:
+            regex += char
+            in_brackets = char != "]"
+        elif char == "\\" and i + 1 < len(glob):
+            i += 1
+            regex += re.escape(glob[i])
+        elif char == "*":
+            if glob.startswith("**", i):
+                regex += ".*"
+                i += 1
+            else:
+                regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            regex += "["
+            in_brackets = True
+        elif char == "{" and not in_braces:
+            regex += "(?:"
+            in_braces = True
+        elif char == "," and in_braces:
+            regex += "|"
+        elif char == "}" and in_braces:
+            regex += ")"
+            in_braces = False
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    if in_brackets or in_braces:
+        raise ValueError(f"Unclosed {'[' if in_brackets else '{'} in filter {glob}")
+    return regex
+
+
+def dir_globs(glob: str) -> list[str]:
+    """
+    Globs of the directories a file matching glob could be in, so including
+    a file deep in an excluded tree doesn't get its directories pruned
+    """
+    globs = []
+    glob = glob.rstrip("/")
+    while "/" in glob:
+        glob = glob[: glob.rindex("/")]
+        if "**" in glob:
+            # Matches directories at any depth below it, nothing shallower is needed
+            globs.append(glob[: glob.index("**") + 2])
+            break
+        if glob:
+            globs.append(f"{glob}/")
+    return globs
+
+
+class PathFilter:
+    """
+    Decides if a path is excluded the way rclone does. The first rule matching
+    a file decides it, and directories are decided by the rules that can match
+    a directory: the ones ending in / or containing **, and the directories
+    leading to the files of include rules. A path no rule matches is included.
+    Paths are relative to the root and a directory excludes everything below it
+    """
+
+    def __init__(self, rules: list[tuple[bool, str]]) -> None:
+        """
+        rules are (include, glob) in the order they're checked
+        """
+        file_rules: list[tuple[bool, str]] = []
+        dir_rules: list[tuple[bool, str]] = []
+        for include, glob in rules:
+            dir_rule = glob.endswith("/") or "**" in glob
+            file_rule = not glob.endswith("/") or "**" in glob
+            if file_rule:
+                file_rules.append((include, glob_to_regex(glob)))
+                if include:
+                    dir_rules.extend((True, glob_to_regex(sub)) for sub in dir_globs(glob))
+            if dir_rule:
+                dir_rules.append((include, glob_to_regex(glob)))
+
+        self.file_regex, self.file_includes = self.__compile(file_rules)
+        self.dir_regex, self.dir_includes = self.__compile(dir_rules)
+
+    @staticmethod
+    def __compile(rules: list[tuple[bool, str]]) -> tuple[re.Pattern | None, list[bool]]:
+        """
+        Joins the rules into one alternation with a group per rule. Alternatives are
+        tried in order, so the group that matched is the first rule matching the path
+        """
+        if not rules:
+            return None, []
+        regex = "|".join(f"(?P<r{i}>{rule})" for i, (_, rule) in enumerate(rules))
+        return re.compile(regex, re.DOTALL), [include for include, _ in rules]
+
+    @classmethod
+    def from_file(
+        cls, filter_file: Path = FILTER_FILE, extra: list[tuple[bool, str]] | None = None
+    ) -> "PathFilter":
+        """
+        Reads an rclone filter file: lines of "- glob" to exclude, "+ glob" to
+        include and "!" to clear the rules before it, blank lines and lines
+        starting with # or ; are skipped. extra rules are checked after the file's
+        """
+        rules: list[tuple[bool, str]] = []
+        with open(filter_file, encoding="utf-8") as lines:
+            for line in lines:
+                line = line.strip()
+                if not line or line.startswith(("#", ";")):
+                    continue
+                if line == "!":
+                    rules.clear()
+                elif line.startswith(("+ ", "- ")):
+                    rules.append((line[0] == "+", line[2:]))
+                else:
+                    raise ValueError(f"Invalid line in {filter_file}: {line}")
+        return cls(rules + (extra or []))
+
+    def excluded(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Checks if a file or directory, given relative to the root, is excluded
+        """
+        if is_dir:
+            regex, includes, rel_path = self.dir_regex, self.dir_includes, f"{rel_path}/"
+        else:
+            regex, includes = self.file_regex, self.file_includes
+        if regex is None:
+            return False
+        match = regex.fullmatch(rel_path)
+        return match is not None and not includes[int(match.lastgroup[1:])]
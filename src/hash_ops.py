@@ -0,0 +1,123 @@
+"""
+Content hashes used to tell files whose modification time changed
+apart from files whose contents changed
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+
+from helpers import FileEntry, VariableStorer
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RateLimiter:
+    """
+    Paces the bytes read by every hashing thread together to a number of bytes
+    per second, by handing out consecutive time slots. A rate of 0 is unlimited
+    """
+
+    def __init__(self, rate: int) -> None:
+        self.rate = rate
+        self.next_free = monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount: int):
+        """
+        Blocks until amount bytes may be read
+        """
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = monotonic()
+            start = max(self.next_free, now)
+            self.next_free = start + amount / self.rate
+
+        if start > now:
+            sleep(start - now)
+
+
+def hash_file(path: Path, limiter: RateLimiter) -> str | None:
+    """
+    Hashes a file with BLAKE2b, returning None if it can't be read
+    """
+    digest = blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as file:
+            while True:
+                limiter.consume(CHUNK_SIZE)
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except OSError:
+        return None
+
+    return digest.hexdigest()
+
+
+def drop_unchanged_files(var_storer: VariableStorer):
+    """
+    Hashes the modified files on a pool of var_storer.hash_workers threads.
+    Files with the same size and hash as when they were last synced only had their
+    modification time changed, so they're marked clean in the DB without uploading.
+    The hashes of the other files are kept in var_storer.crud.hashes
+    and stored once they have synced
+    """
+    stored = var_storer.crud.get_hashes(var_storer.mod_times)
+    # Files with the same inode, size and mod time as stored, e.g. new files,
+    # weren't touched since and are only hashed once to have a hash to compare with.
+    # Files whose size changed can't be unchanged, so they aren't hashed at all
+    to_hash = [
+        file
+        for file in var_storer.mod_times
+        if file.path in stored
+        and not file.is_dir
+        and stored[file.path][1] == file.size
+        and (
+            stored[file.path][:3] != (file.inode, file.size, file.mod_time)
+            or stored[file.path][3] is None
+        )
+    ]
+    if not to_hash:
+        return
+
+    if var_storer.STDOUT:
+        print(f"Hashing {len(to_hash)} modified files")
+
+    limiter = RateLimiter(var_storer.hash_rate)
+    with ThreadPoolExecutor(max_workers=var_storer.hash_workers) as pool:
+        hashes = dict(
+            zip(
+                (file.path for file in to_hash),
+                pool.map(lambda file: hash_file(file.path, limiter), to_hash),
+            )
+        )
+
+    unchanged: list[FileEntry] = []
+    for file in to_hash:
+        content_hash = hashes[file.path]
+        if content_hash is None:
+            continue
+
+        inode, size, mod_time, old_hash = stored[file.path]
+        if (
+            (inode, size, mod_time) != (file.inode, file.size, file.mod_time)
+            and old_hash == content_hash
+        ):
+            unchanged.append(file)
+        else:
+            var_storer.crud.hashes[file.path] = content_hash
+
+    if unchanged:
+        if var_storer.STDOUT:
+            print(f"{len(unchanged)} files only had their modification time changed")
+        var_storer.crud.mark_unchanged(unchanged)
+        unchanged_paths = {file.path for file in unchanged}
+        var_storer.mod_times = [
+            file for file in var_storer.mod_times if file.path not in unchanged_paths
+        ]
@@ -3,8 +3,41 @@ Helper functions for the main function of the rclone backup script
 """
 
 from datetime import datetime
+from os import stat_result
 from pathlib import Path
 from sqlite3 import Connection
+from stat import S_ISDIR
+from typing import TYPE_CHECKING, NamedTuple
+
+from filter_ops import PathFilter
+from metrics_ops import RunMetrics, write_textfile
+
+if TYPE_CHECKING:
+    from db_ops import Crud
+    from dir_ops import ScanCheckpoint
+    from lane_ops import UploadTimeouts
+    from rcd_ops import RcdBackend
+    from roots_ops import Root
+
+
+class FileEntry(NamedTuple):
+    """
+    A single file or directory as seen by the scanner.
+    mod_time is the modification time in integer nanoseconds
+    """
+
+    path: Path
+    mod_time: int
+    size: int
+    inode: int
+    is_dir: bool
+
+    @classmethod
+    def from_stat(cls, path: Path, stat: stat_result) -> "FileEntry":
+        """
+        Creates an entry from the result of a non following stat call
+        """
+        return cls(path, stat.st_mtime_ns, stat.st_size, stat.st_ino, S_ISDIR(stat.st_mode))
 
 
 class VariableStorer:
@@ -12,36 +45,112 @@ class VariableStorer:
     Class to store the variables needed for the rclone backup script to run
     """
 
-    def __init__(self, STDOUT: bool, CWD: Path) -> None:
+    def __init__(self, STDOUT: bool, CWD: Path, root: "Root | None" = None) -> None:
         self.STDOUT: bool = STDOUT
         if self.STDOUT:
             print("Initializing VariableStorer")
         self.CWD = CWD
-        self.LOCAL_DIR: str = "/home/kr9sis/PDrive"
-        self.REMOTE_DIR: str = "PDrive:"
-        self.mod_times: list[tuple[Path, str]] = []
+        # Root of a config file being backed up, None for the default one
+        self.root = root
+        self.LOCAL_DIR: str = root.local_dir if root else "/home/kr9sis/PDrive"
+        self.REMOTE_DIR: str = root.remote_dir if root else "PDrive:"
+        # Added to every rclone call, e.g. the root's share of the --bwlimit
+        self.rclone_flags: list[str] = list(root.rclone_flags) if root else []
+        self.mod_times: list[FileEntry] = []
         self.file_count: int = -99999
         self.cur_file: int = 0
-        self.excluded_paths: set[str] = {
-            "__pycache__",
-            "node_modules",
-            "firm_extract_NOBACKUP",
-        }
-        # Dotfiles and synlinks are also excluded in get_files_in_cwd()
+        self.scan_workers: int = 1
+        self.merge_scan: bool = False
+        self.hash_files: bool = False
+        # Bytes per second read while hashing, 0 is unlimited
+        self.hash_rate: int = 0
+        self.hash_workers: int = 4
+        # Files copied per rclone call, 0 syncs each file with its own call
+        self.batch_size: int = 0
+        # Most uploads running at once, 1 uploads one at a time
+        self.upload_workers: int = 1
+        # Bytes and seconds each run may spend syncing, 0 is unlimited. An hour by
+        # default, so a long sync doesn't keep the runs after it from scanning
+        self.budget_bytes: int = 0
+        self.budget_seconds: int = 3600
+        # Running rclone rcd server, None runs rclone once per file
+        self.rcd: "RcdBackend | None" = None
+        # Seconds after which an unfinished scan is started over instead of resumed,
+        # 0 never checkpoints
+        self.checkpoint_age: int = 6 * 3600
+        # Checkpoint of the running full scan, None if it isn't resumable
+        self.checkpoint: "ScanCheckpoint | None" = None
+        # Seconds without a heartbeat before the watch daemon's journal is ignored
+        self.watch_timeout: int = 90
+        self.metrics = RunMetrics()
+        # node_exporter textfile the metrics are written to, None only keeps them in the database
+        self.metrics_file: Path | None = None
+        # Timeouts of this run's uploads, created by sync() if the caller didn't
+        self.upload_timeouts: "UploadTimeouts | None" = None
 
         file_dir = Path(__file__).resolve().parent
         self.start_time: datetime = datetime.now()
         self.now: str = self.start_time.strftime("%Y-%m-%d %H:%M")
 
+        # Every root of a config file has its own logs and database
         date = f"{self.start_time.year % 100}_{self.start_time.month:02}"
+        if root:
+            date += f"_{root.name}"
         self.run_log: Path = (file_dir / "logs" / f"{date}_run.log")
         self.err_log: Path = (file_dir / "logs" / f"{date}_error.log")
         del date
         
-        self.db_file: Path = file_dir / "RCloneBackupScript.db"
+        self.db_file: Path = file_dir / (
+            f"RCloneBackupScript_{root.name}.db" if root else "RCloneBackupScript.db"
+        )
         del file_dir
+        # Exclusion rules of rclone_sync_filter.txt, which full_backup.py syncs with,
+        # or of the root's filter file and excludes.
+        # The WAL and shared memory files only exist while the database is open.
+        # Symlinks are also excluded in get_files_in_cwd()
+        extra = [(False, f"{self.db_file.name}-*")]
+        if root:
+            self.path_filter = PathFilter.from_file(
+                root.filter_file, [(False, glob) for glob in root.excludes] + extra
+            )
+        else:
+            self.path_filter = PathFilter.from_file(extra=extra)
 
         self.db_conn: Connection
+        self.crud: "Crud"
+
+
+def is_excluded(var_storer: VariableStorer, path: str, is_dir: bool) -> bool:
+    """
+    Checks if a path below the local directory is excluded by var_storer.path_filter.
+    Excluded directories are never listed, so nothing below them needs checking.
+    Symlinks are excluded by the caller since that needs a stat call
+    """
+    root = var_storer.LOCAL_DIR.rstrip("/") + "/"
+    if not path.startswith(root):
+        return False
+    return var_storer.path_filter.excluded(path[len(root) :], is_dir)
+
+
+def remote_path(var_storer: VariableStorer, rel_path: str) -> str:
+    """
+    Joins a path relative to the local directory onto the remote directory
+    """
+    if var_storer.REMOTE_DIR.endswith((":", "/")):
+        return f"{var_storer.REMOTE_DIR}{rel_path}"
+    return f"{var_storer.REMOTE_DIR}/{rel_path}"
+
+
+def get_file_entry(path: Path) -> FileEntry:
+    """
+    Stats a single path without following symlinks.
+    Paths which no longer exist are returned as an empty entry
+    so they can still be synced as deletions
+    """
+    try:
+        return FileEntry.from_stat(path, path.lstat())
+    except FileNotFoundError:
+        return FileEntry(path, 0, 0, 0, False)
 
 
 def write_start_end_times(
@@ -52,7 +161,7 @@ def write_start_end_times(
     RETRYING=False,
     COUNTING=False,
 ):
-    from db_ops import log_start_end_times_db
+    from db_ops import log_start_end_times_db, record_metrics
 
     """
     Writes the start and end times to the run log
@@ -88,6 +197,12 @@ def write_start_end_times(
                 now.strftime("%Y-%m-%d %H:%M"),
                 f"End Time, Duration {h} h. {m} m. {s} s.",
             )
+            var_storer.metrics.set("run_seconds", total_seconds)
+            var_storer.metrics.set("db_seconds", var_storer.db_conn.db_seconds)
+            rows = var_storer.metrics.rows()
+            record_metrics(var_storer, var_storer.now, rows)
+            if var_storer.metrics_file is not None:
+                write_textfile(var_storer, rows)
 
         print(
             f"{msg}\n{dur}{" "*(len(msg)-len(dur)-1)}#\n{"#"*len(msg)}",
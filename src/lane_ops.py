@@ -0,0 +1,143 @@
+"""
+Splits uploads into lanes by file size. Each lane has its own share of the upload
+workers and its own rclone flags, and each file gets a timeout estimated from its
+size and the throughput of past runs instead of one fixed timeout for every file
+"""
+
+from math import inf
+from pathlib import Path
+from typing import NamedTuple
+
+from helpers import FileEntry, VariableStorer
+from sched_ops import estimate_costs
+
+# Seconds a single file may take to sync while there are no past runs to estimate from
+TIMEOUT = 1300
+# Times its estimated upload time a file may take before it's killed
+TIMEOUT_FACTOR = 4
+# Timeouts in a row after which a file is only synced by --retry_fails
+STUCK_TIMEOUTS = 3
+
+
+class Lane(NamedTuple):
+    """
+    Uploads of the files up to max_size bytes
+    """
+
+    name: str
+    max_size: float
+    # Shortest timeout in seconds, however fast past runs were
+    min_timeout: float
+    # Added to the lane's rclone calls
+    flags: tuple[str, ...]
+
+
+LANES = (
+    # A small file which stops transferring for a minute is hung
+    Lane("small", 16 * 2**20, 60, ("--timeout", "1m")),
+    Lane("medium", 512 * 2**20, 300, ()),
+    # A retry of the whole file starts over from zero, so only let rclone retry
+    # the parts of it which failed, and upload it in parallel streams where the
+    # backend supports it
+    Lane(
+        "large",
+        inf,
+        1800,
+        (
+            "--retries",
+            "1",
+            "--low-level-retries",
+            "20",
+            "--multi-thread-streams",
+            "4",
+            "--multi-thread-cutoff",
+            "256M",
+        ),
+    ),
+)
+
+
+def lane_of(file: FileEntry) -> Lane:
+    """
+    Gets the lane a file is uploaded in
+    """
+    return next(lane for lane in LANES if file.size <= lane.max_size)
+
+
+def lane_workers(upload_workers: int) -> list[int]:
+    """
+    Splits upload_workers between the lanes, which needs at least one for each:
+    one for large files, about a quarter of the rest for medium files and the
+    others for small files
+    """
+    if upload_workers < len(LANES):
+        raise ValueError(f"{upload_workers} upload workers can't run {len(LANES)} lanes at once")
+    medium = max(1, (upload_workers - 1) // 4)
+    return [upload_workers - 1 - medium, medium, 1]
+
+
+class UploadTimeouts:
+    """
+    Timeouts of single uploads. A file gets TIMEOUT_FACTOR times the upload time
+    estimated from the files, bytes and seconds of past runs, at least the min_timeout
+    of its lane, and twice that for each time in a row its upload timed out before.
+    A file which timed out STUCK_TIMEOUTS times in a row is left queued and
+    reported instead of being retried every run
+    """
+
+    def __init__(self, var_storer: VariableStorer) -> None:
+        self.costs = estimate_costs(var_storer)
+        # Concurrent uploads share the bandwidth
+        self.workers = max(1, var_storer.upload_workers)
+        self.streaks = var_storer.crud.get_timeout_streaks()
+        # Files whose upload timed out this run, added to by the upload threads
+        self.timed_out: set[Path] = set()
+        self.stuck: list[FileEntry] = []
+
+    def timeout(self, file: FileEntry) -> float:
+        """
+        Gets the seconds the upload of a file may take
+        """
+        if self.costs is None:
+            seconds = TIMEOUT
+        else:
+            overhead, rate = self.costs
+            estimate = overhead + file.size * self.workers / rate
+            seconds = max(lane_of(file).min_timeout, TIMEOUT_FACTOR * estimate)
+        return seconds * 2 ** self.streaks.get(file.path, 0)
+
+    def is_stuck(self, file: FileEntry) -> bool:
+        """
+        Checks if the upload of a file timed out STUCK_TIMEOUTS times in a row,
+        remembering it for report(). Deletions are never stuck
+        """
+        if self.streaks.get(file.path, 0) < STUCK_TIMEOUTS:
+            return False
+        # Only stat'ed for the few files which timed out that often
+        if not file.path.exists():
+            return False
+        self.stuck.append(file)
+        return True
+
+    def report(self, var_storer: VariableStorer, attempted: set[Path]):
+        """
+        Writes the stuck files which weren't attempted this run to the run and error logs
+        """
+        stuck = [file for file in self.stuck if file.path not in attempted]
+        if not stuck:
+            return
+
+        with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+            print(f"# Stuck {len(stuck):<17}#", file=log_file)
+        with open(var_storer.err_log, "a", encoding="utf-8") as err_file:
+            print(f"\n{'#'*80}", file=err_file)
+            print(var_storer.start_time, file=err_file)
+            print("Not synced, the upload timed out too many times in a row:", file=err_file)
+            for file in stuck:
+                print(
+                    f"{file.path} ({file.size / 1e6:.1f} MB, "
+                    f"{self.streaks[file.path]} timeouts)",
+                    file=err_file,
+                )
+            print("Run with --retry_fails to try them again with a longer timeout", file=err_file)
+            print(f"{'#'*80}", file=err_file)
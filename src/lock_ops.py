@@ -0,0 +1,213 @@
+"""
+Makes sure only one run uses a database at a time. The running process holds an
+advisory lock on a file beside the database and keeps a heartbeat with its progress
+in it. Another run started meanwhile quits, waits for it, or hands its retry or count
+over to it, which runs them once it's done
+"""
+
+from datetime import datetime
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from json import dumps, loads
+from os import O_APPEND, O_CREAT, O_RDWR, O_WRONLY, close, fstat, ftruncate, getpid, pwrite, stat, write
+from os import open as os_open
+from threading import Event, Thread
+from time import sleep, time
+
+from helpers import VariableStorer
+
+# Seconds between the holder's heartbeats, and between checks while waiting for the lock
+HEARTBEAT = 30
+# What a run does when another one holds the lock
+BUSY_ACTIONS = ("quit", "handoff", "wait")
+
+
+class RunLock:
+    """
+    Lock on the file var_storer.db_file-lock, which the WAL file exclusion also keeps
+    from being synced. The lock is released by the system when its process dies, so a
+    lock file which still has contents when it's acquired was left by a crashed run
+    """
+
+    def __init__(self, var_storer: VariableStorer) -> None:
+        self.var_storer = var_storer
+        self.lock_file = var_storer.db_file.with_name(f"{var_storer.db_file.name}-lock")
+        self.requests_file = var_storer.db_file.with_name(f"{var_storer.db_file.name}-requests")
+        self.fd: int | None = None
+        self.mode = "run"
+        self.started = time()
+        self.stop = Event()
+        self.beating: Thread | None = None
+
+    def holder(self) -> dict | None:
+        """
+        Gets the info the running or crashed holder last wrote, None if there is none
+        """
+        try:
+            return loads(self.lock_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self, wait: bool, mode: str = "run") -> bool:
+        """
+        Takes the lock, waiting for the holder to finish if wait is set.
+        Returns False if another run holds it
+        """
+        self.mode = mode
+        fd = os_open(self.lock_file, O_RDWR | O_CREAT, 0o644)
+        waited_for = None
+        while True:
+            try:
+                flock(fd, LOCK_EX | LOCK_NB)
+                break
+            except BlockingIOError:
+                if not wait:
+                    close(fd)
+                    return False
+                waited_for = self.holder() or waited_for
+                if self.var_storer.STDOUT and waited_for:
+                    print(f"Waiting for PID {waited_for['pid']}, {progress_text(waited_for)}")
+                self.stop.wait(HEARTBEAT)
+
+        self.fd = fd
+        if waited_for is not None:
+            # The run starts now, in another minute than the one it waited for
+            wait_for_minute(datetime.fromtimestamp(waited_for["started"]))
+            self.var_storer.start_time = datetime.now()
+            self.var_storer.now = self.var_storer.start_time.strftime("%Y-%m-%d %H:%M")
+            self.started = time()
+        stale = self.holder()
+        if stale is not None:
+            self.__log_stale(stale)
+        self.__beat()
+        self.beating = Thread(target=self.__heartbeat, daemon=True)
+        self.beating.start()
+        return True
+
+    def release(self):
+        """
+        Stops the heartbeat, empties the lock file and releases the lock
+        """
+        if self.fd is None:
+            return
+        self.stop.set()
+        if self.beating is not None:
+            self.beating.join()
+        ftruncate(self.fd, 0)
+        flock(self.fd, LOCK_UN)
+        close(self.fd)
+        self.fd = None
+
+    def __beat(self):
+        """
+        Writes this run's pid, heartbeat and progress to the lock file
+        """
+        metrics = self.var_storer.metrics
+        info = {
+            "pid": getpid(),
+            "mode": self.mode,
+            "started": self.started,
+            "heartbeat": time(),
+            "phase": "syncing" if metrics.get("scan_seconds") else "scanning",
+            "dirs_scanned": int(metrics.get("dirs_scanned")),
+            "files_scanned": int(metrics.get("files_scanned")),
+            "to_sync": len(self.var_storer.mod_times),
+            "uploaded": int(metrics.get("files_uploaded")),
+        }
+        data = dumps(info).encode()
+        ftruncate(self.fd, len(data))
+        pwrite(self.fd, data, 0)
+
+    def __heartbeat(self):
+        while not self.stop.wait(HEARTBEAT):
+            self.__beat()
+
+    def __log_stale(self, stale: dict):
+        """
+        Writes the last heartbeat of the crashed run whose lock file was found to the error log
+        """
+        heartbeat = datetime.fromtimestamp(stale.get("heartbeat", 0))
+        with open(self.var_storer.err_log, "a", encoding="utf-8") as err_file:
+            print(f"\n{'#'*80}", file=err_file)
+            print(self.var_storer.start_time, file=err_file)
+            print(
+                f"Cleared the stale lock of PID {stale.get('pid')}, which stopped while "
+                f"{progress_text(stale)}, last heartbeat {heartbeat:%Y-%m-%d %H:%M:%S}",
+                file=err_file,
+            )
+            print(f"{'#'*80}", file=err_file)
+
+    def request(self, mode: str):
+        """
+        Hands a retry or count over to the run holding the lock. The requests file is
+        locked while writing, and written again if it was taken in the meantime
+        """
+        while True:
+            fd = os_open(self.requests_file, O_WRONLY | O_CREAT | O_APPEND, 0o644)
+            try:
+                flock(fd, LOCK_EX)
+                try:
+                    current = stat(self.requests_file).st_ino == fstat(fd).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    write(fd, f"{mode}\n".encode())
+                    return
+            finally:
+                close(fd)
+
+    def take_requests(self) -> list[str]:
+        """
+        Gets the retries and counts handed over by other runs, each once, and clears them.
+        The requests file is renamed before it's read, so requests written meanwhile go
+        to a new one, and read once no request is being written to it
+        """
+        taken = self.requests_file.with_name(f"{self.requests_file.name}-taken")
+        try:
+            self.requests_file.rename(taken)
+        except FileNotFoundError:
+            return []
+
+        with open(taken, encoding="utf-8") as file:
+            flock(file, LOCK_EX)
+            requests = file.read().split()
+        taken.unlink()
+        return [mode for mode in ("retry", "count") if mode in requests]
+
+
+def progress_text(info: dict) -> str:
+    """
+    Describes the progress in a lock file
+    """
+    if info.get("phase") == "syncing":
+        return f"syncing, {info.get('uploaded', 0)} of {info.get('to_sync', 0)} files uploaded"
+    return (
+        f"scanning, {info.get('files_scanned', 0)} files in "
+        f"{info.get('dirs_scanned', 0)} directories so far"
+    )
+
+
+def wait_for_minute(after: datetime):
+    """
+    Waits until the minute of after is over. Runs are told apart by the minute
+    they started in, so a run can't start in the same minute as the one before it
+    """
+    while datetime.now().strftime("%Y-%m-%d %H:%M") <= after.strftime("%Y-%m-%d %H:%M"):
+        sleep(1)
+
+
+def log_busy(var_storer: VariableStorer, lock: RunLock, mode: str, handed_over: bool):
+    """
+    Writes to the error log that the run didn't start because another one is running,
+    as the run log is still being written by that one
+    """
+    holder = lock.holder() or {}
+    msg = f"Didn't {mode}, PID {holder.get('pid', '?')} is running, {progress_text(holder)}"
+    if handed_over:
+        msg += f". Handed the {mode} over to it"
+    with open(var_storer.err_log, "a", encoding="utf-8") as err_file:
+        print(f"\n{'#'*80}", file=err_file)
+        print(var_storer.start_time, file=err_file)
+        print(msg, file=err_file)
+        print(f"{'#'*80}", file=err_file)
+    if var_storer.STDOUT:
+        print(msg)
@@ -4,25 +4,134 @@ rclone backup script for backing up local directory files
 
 from contextlib import closing
 from datetime import datetime
-from logging import ERROR, basicConfig, error
+from logging import ERROR, FileHandler, Formatter, getLogger
 from os import getpid
 from pathlib import Path
-from sqlite3 import IntegrityError, OperationalError, connect
+from sqlite3 import IntegrityError, OperationalError
 from traceback import format_exc
 from argparse import ArgumentParser
 
+from time import monotonic, time_ns
+from typing import Iterator
+
 from db_ops import (
+    Crud,
+    clear_journal,
+    connect_db,
     get_count_or_setup_db,
     get_fails,
+    get_journal,
     log_start_end_times_db,
     write_db_mod_files,
 )
-from dir_ops import get_modified_files
-from helpers import VariableStorer, write_start_end_times
-from rclone_ops import check_connection, sync
+from dir_ops import ScanCheckpoint, iter_journaled_files, iter_modified_files
+from hash_ops import drop_unchanged_files
+from move_ops import find_moves
+from helpers import FileEntry, VariableStorer, write_start_end_times
+from lane_ops import UploadTimeouts
+from rclone_ops import (
+    connection_available,
+    rclone_backend,
+    record_connection,
+    sync,
+    sync_pipelined,
+)
+from lock_ops import BUSY_ACTIONS, RunLock, log_busy, wait_for_minute
+from roots_ops import Root, read_config, run_roots
+from sched_ops import schedule
+from watch_ops import watch
+
+
+def __start_checkpoint(var_storer: VariableStorer, resumable: bool, scan_start: int) -> int:
+    """
+    Makes the full scan about to start resumable, resuming an unfinished one
+    if there is one, and returns when the scan started.
+    A count or a new database's first scan isn't, as neither keeps what it found,
+    and neither is the merge scan, which doesn't walk directory by directory
+    """
+    if not resumable or var_storer.merge_scan or not var_storer.checkpoint_age:
+        return scan_start
+
+    var_storer.checkpoint = ScanCheckpoint(var_storer, var_storer.CWD, scan_start)
+    return var_storer.checkpoint.started
+
+
+def __scan(
+    var_storer: VariableStorer, resumable: bool, in_order: bool
+) -> tuple[int, Iterator[FileEntry]]:
+    """
+    Starts scanning for modified files: the directories journaled by the watch daemon
+    if there's a journal, otherwise every directory below the CWD.
+    Full scans are checkpointed if resumable is set.
+    Returns when the scan started, earlier than now if it resumes a checkpoint,
+    and the modified files, which are found while they're being iterated over
+    """
+    scan_start = time_ns()
+    if var_storer.CWD != Path(var_storer.LOCAL_DIR):
+        scan_start = __start_checkpoint(var_storer, resumable, scan_start)
+        return scan_start, iter_modified_files(var_storer, var_storer.CWD, in_order)
+
+    journal = get_journal(var_storer)
+    if journal is None:
+        scan_start = __start_checkpoint(var_storer, resumable, scan_start)
+        changes = iter_modified_files(var_storer, var_storer.CWD, in_order)
+    else:
+        if var_storer.STDOUT:
+            print(f"Checking {len(journal)} journaled directories")
+        # The database and logs are never journaled but always modified
+        journal.extend(
+            (log_dir, False)
+            for log_dir in (var_storer.db_file.parent, var_storer.run_log.parent)
+            if log_dir.is_relative_to(var_storer.LOCAL_DIR)
+        )
+        changes = iter_journaled_files(var_storer, sorted(journal), in_order)
+
+    def scan() -> Iterator[FileEntry]:
+        yield from changes
+        clear_journal(var_storer, scan_start, full_scan=journal is None)
 
+    return scan_start, scan()
 
-def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
+
+def __log_exception(var_storer: VariableStorer):
+    """
+    Writes the traceback of the exception being handled to the run's error log.
+    Roots of a config file run on threads of one process, so each run writes
+    through its own logger and handler rather than the process wide logging config
+    """
+    logger = getLogger(f"{__name__}.{var_storer.root.name if var_storer.root else 'default'}")
+    logger.propagate = False
+    handler = FileHandler(var_storer.err_log, mode="a", encoding="utf-8")
+    handler.setFormatter(Formatter("\n%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    try:
+        logger.log(ERROR, format_exc())
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def main(
+    STDOUT: bool,
+    CWD: Path,
+    RETRY_FAILS: bool,
+    COUNT_MODF: bool,
+    SCAN_WORKERS: int = 1,
+    MERGE_SCAN: bool = False,
+    HASH_FILES: bool = False,
+    HASH_RATE: int = 0,
+    BATCH_SIZE: int = 0,
+    UPLOAD_WORKERS: int = 1,
+    USE_RCD: bool = False,
+    BUDGET_BYTES: int = 0,
+    BUDGET_SECONDS: int = 3600,
+    CHECKPOINT_AGE: int = 6 * 3600,
+    DETECT_MOVES: bool = False,
+    METRICS_FILE: Path | None = None,
+    PIPELINE: bool = False,
+    ROOT: Root | None = None,
+    ON_BUSY: str = "handoff",
+):
     """
     Main function for the rclone backup script
     """
@@ -34,13 +143,126 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
         raise TypeError("COUNT_MODE must be of type bool")
     if not isinstance(CWD, Path) or not CWD.exists():
         raise TypeError("CWD must be of type path and exist")
+    if not isinstance(SCAN_WORKERS, int) or SCAN_WORKERS < 1:
+        raise TypeError("SCAN_WORKERS must be of type int and at least 1")
+    if not isinstance(MERGE_SCAN, bool):
+        raise TypeError("MERGE_SCAN must be of type bool")
+    if not isinstance(HASH_FILES, bool):
+        raise TypeError("HASH_FILES must be of type bool")
+    if not isinstance(HASH_RATE, int) or HASH_RATE < 0:
+        raise TypeError("HASH_RATE must be of type int and not negative")
+    if not isinstance(BATCH_SIZE, int) or BATCH_SIZE < 0:
+        raise TypeError("BATCH_SIZE must be of type int and not negative")
+    if not isinstance(UPLOAD_WORKERS, int) or UPLOAD_WORKERS < 1:
+        raise TypeError("UPLOAD_WORKERS must be of type int and at least 1")
+    if not isinstance(USE_RCD, bool):
+        raise TypeError("USE_RCD must be of type bool")
+    if not isinstance(BUDGET_BYTES, int) or BUDGET_BYTES < 0:
+        raise TypeError("BUDGET_BYTES must be of type int and not negative")
+    if not isinstance(BUDGET_SECONDS, int) or BUDGET_SECONDS < 0:
+        raise TypeError("BUDGET_SECONDS must be of type int and not negative")
+    if not isinstance(CHECKPOINT_AGE, int) or CHECKPOINT_AGE < 0:
+        raise TypeError("CHECKPOINT_AGE must be of type int and not negative")
+    if not isinstance(DETECT_MOVES, bool):
+        raise TypeError("DETECT_MOVES must be of type bool")
+    if METRICS_FILE is not None and not isinstance(METRICS_FILE, Path):
+        raise TypeError("METRICS_FILE must be of type Path or None")
+    if not isinstance(PIPELINE, bool):
+        raise TypeError("PIPELINE must be of type bool")
+    if ROOT is not None and not isinstance(ROOT, Root):
+        raise TypeError("ROOT must be of type Root or None")
+    if ON_BUSY not in BUSY_ACTIONS:
+        raise TypeError(f"ON_BUSY must be one of {', '.join(BUSY_ACTIONS)}")
+
+    var_storer = VariableStorer(STDOUT, CWD, ROOT)
+    var_storer.scan_workers = SCAN_WORKERS
+    var_storer.merge_scan = MERGE_SCAN
+    var_storer.hash_files = HASH_FILES
+    var_storer.hash_rate = HASH_RATE
+    var_storer.batch_size = BATCH_SIZE
+    var_storer.upload_workers = UPLOAD_WORKERS
+    var_storer.budget_bytes = BUDGET_BYTES
+    var_storer.budget_seconds = BUDGET_SECONDS
+    var_storer.checkpoint_age = CHECKPOINT_AGE
+    var_storer.metrics_file = METRICS_FILE
+    if ROOT is not None and METRICS_FILE is not None:
+        # One textfile per root
+        var_storer.metrics_file = METRICS_FILE.with_stem(f"{METRICS_FILE.stem}_{ROOT.name}")
+
+    def run_requests(requests: list[str]):
+        """
+        Runs the retries and counts handed over by runs started meanwhile,
+        waiting in case yet another run started first
+        """
+        started = var_storer.start_time
+        for request in requests:
+            wait_for_minute(started)
+            started = datetime.now()
+            main(
+                STDOUT,
+                CWD,
+                request == "retry",
+                request == "count",
+                SCAN_WORKERS,
+                MERGE_SCAN,
+                HASH_FILES,
+                HASH_RATE,
+                BATCH_SIZE,
+                UPLOAD_WORKERS,
+                USE_RCD,
+                BUDGET_BYTES,
+                BUDGET_SECONDS,
+                CHECKPOINT_AGE,
+                DETECT_MOVES,
+                METRICS_FILE,
+                PIPELINE,
+                ROOT,
+                "wait",
+            )
+
+    # Only one run at a time uses the database
+    lock = RunLock(var_storer)
+    mode = "retry" if RETRY_FAILS else "count" if COUNT_MODF else "run"
+    if not lock.acquire(ON_BUSY == "wait", mode):
+        # A scan now would only repeat the running one's, but a retry or count is run after it
+        handed_over = ON_BUSY == "handoff" and mode != "run"
+        if handed_over:
+            lock.request(mode)
+        log_busy(var_storer, lock, mode, handed_over)
+        if not (handed_over and lock.acquire(False, mode)):
+            return
+        # The running one finished before it could see the request, so it's run here
+        requests = lock.take_requests()
+        lock.release()
+        # Requests handed over while releasing would otherwise wait for the next run
+        requests += [request for request in lock.take_requests() if request not in requests]
+        run_requests(requests)
+        return
 
-    var_storer = VariableStorer(STDOUT, CWD)
     try:
         write_start_end_times(var_storer, var_storer.start_time, RETRYING=RETRY_FAILS, COUNTING=COUNT_MODF)
 
-        with closing(connect(var_storer.db_file)) as var_storer.db_conn:
-            if not check_connection(var_storer):
+        with (
+            closing(connect_db(var_storer.db_file)) as var_storer.db_conn,
+            rclone_backend(var_storer, USE_RCD),
+        ):
+            var_storer.crud = Crud(var_storer.db_conn)
+            # Moves and hashes need every change before syncing anything
+            pipelined = PIPELINE and not (RETRY_FAILS or COUNT_MODF or DETECT_MOVES or HASH_FILES)
+            new_db = get_count_or_setup_db(var_storer)
+            var_storer.crud.track_moves = DETECT_MOVES and not new_db
+            log_start_end_times_db(
+                var_storer, var_storer.now, f"Start Time, PID: {getpid()}"
+            )
+            if pipelined and not new_db and var_storer.crud.get_moves():
+                # Pending moves are made before any upload
+                pipelined = False
+
+            # A pipelined run checks the connection alongside the scan, and a count
+            # or the first scan of a new database doesn't sync anything
+            offline = not (pipelined or COUNT_MODF or new_db)
+            offline = offline and not connection_available(var_storer)
+            if offline and RETRY_FAILS:
                 write_start_end_times(
                     var_storer,
                     datetime.now(),
@@ -48,23 +270,54 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
                 )
                 return
 
-            new_db = get_count_or_setup_db(var_storer)
-            log_start_end_times_db(
-                var_storer, var_storer.now, f"Start Time, PID: {getpid()}"
-            )
-
+            scan_start = time_ns()
+            scan_started = monotonic()
+            queue = []
             if RETRY_FAILS:
                 if STDOUT:
                     print("Retrying fails")
                 var_storer.mod_times = get_fails(var_storer)
+            elif pipelined and not new_db:
+                scan_start, changes = __scan(var_storer, True, in_order=False)
+                if not sync_pipelined(var_storer, changes, scan_start):
+                    with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
+                        print("# Files 0    Exiting     #", file=run_log)
+                    write_start_end_times(
+                        var_storer,
+                        datetime.now(),
+                        start_time=var_storer.start_time,
+                    )
+                    return  # Only sync files if they are different
+
+                write_start_end_times(
+                    var_storer,
+                    datetime.now(),
+                    start_time=var_storer.start_time,
+                )
+                var_storer.db_conn.commit()
+                return
             else:
-                var_storer.mod_times = get_modified_files(var_storer, var_storer.CWD)
+                scan_start, changes = __scan(var_storer, not (new_db or COUNT_MODF), in_order=True)
+                var_storer.mod_times.extend(changes)
+
+            if DETECT_MOVES and not RETRY_FAILS:
+                find_moves(var_storer)
+
+            if HASH_FILES:
+                drop_unchanged_files(var_storer)
+            var_storer.metrics.set("scan_seconds", monotonic() - scan_started)
+
+            if not RETRY_FAILS:
+                # Everything modified waits in the queue until it has synced,
+                # so files which don't fit this run's budget aren't scanned again
+                var_storer.crud.queue_files(var_storer.mod_times, scan_start)
+                queue = var_storer.crud.get_queue()
 
             if COUNT_MODF:
                 if STDOUT:
-                    print(f"\n{len(var_storer.mod_times)} modified files")
+                    print(f"\n{len(queue)} modified files")
                 with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
-                    msg = f"# Files {len(var_storer.mod_times):<7}{'Exiting':<10}#"
+                    msg = f"# Files {len(queue):<7}{'Exiting':<10}#"
                     print(msg, file=run_log)
                 write_start_end_times(
                     var_storer,
@@ -81,9 +334,28 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
                     datetime.now(),
                     start_time=var_storer.start_time,
                 )
+                # The first scan is what later runs compare against, without syncing it
+                var_storer.crud.unqueue_files(var_storer.mod_times)
+                var_storer.db_conn.commit()
                 return  # Only sync if database existed to get around syncing thousands of files
 
-            if not RETRY_FAILS and len(var_storer.mod_times) == 3:
+            if offline:
+                # Everything found waits in the queue for the first run back online
+                with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
+                    print(f"# Files {len(queue):<7}{'Queued':<10}#", file=run_log)
+                write_start_end_times(
+                    var_storer,
+                    datetime.now(),
+                    start_time=var_storer.start_time,
+                )
+                var_storer.db_conn.commit()
+                return
+
+            if not RETRY_FAILS and len(queue) == 3 and not var_storer.crud.get_moves():
+                # The scan isn't kept, but the remote being back online is
+                var_storer.crud.rollback()
+                record_connection(var_storer, True)
+                var_storer.db_conn.commit()
                 with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
                     print("# Files 0    Exiting     #", file=run_log)
                 write_start_end_times(
@@ -93,11 +365,11 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
                 )
                 return  # Only sync files if they are different
 
-            elif len(var_storer.mod_times) > 200:
-                if STDOUT:
-                    print(f"{len(var_storer.mod_times)} modified files\nModified files list will be truncated down to 200")
-                # Only sync 200 files at a time
-                var_storer.mod_times = var_storer.mod_times[:200]
+            var_storer.upload_timeouts = UploadTimeouts(var_storer)
+            if not RETRY_FAILS:
+                # Files which keep timing out wait for --retry_fails
+                queue = [item for item in queue if not var_storer.upload_timeouts.is_stuck(item[0])]
+                var_storer.mod_times = schedule(var_storer, queue)
 
             write_db_mod_files(var_storer)
             sync(var_storer)
@@ -111,7 +383,7 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
     except (Exception, IntegrityError, OperationalError) as exc:
         # Logging any unknown exceptions which might happen.
         # Because this program will be called automatically and without anyone watching stdout.
-        with closing(connect(var_storer.db_file)) as var_storer.db_conn:
+        with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
             with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
                 print(f"\n  {exc}\n", file=run_log)
 
@@ -125,13 +397,7 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
             write_start_end_times(
                 var_storer, var_storer.start_time, RETRYING=RETRY_FAILS, error=True
             )
-            basicConfig(
-                filename=var_storer.err_log,
-                filemode="a",
-                format="\n%(asctime)s - %(levelname)s - %(message)s",
-                level=ERROR,
-            )
-            error(format_exc())
+            __log_exception(var_storer)
             write_start_end_times(
                 var_storer,
                 end_time,
@@ -140,6 +406,13 @@ def main(STDOUT: bool, CWD: Path, RETRY_FAILS: bool, COUNT_MODF: bool):
             )
             var_storer.db_conn.commit()
 
+    finally:
+        requests = lock.take_requests()
+        lock.release()
+        requests += [request for request in lock.take_requests() if request not in requests]
+
+    run_requests(requests)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(prog="RCloneBackupScript")
@@ -157,6 +430,101 @@ if __name__ == "__main__":
         help="Chose where to look for files to sync",
         default="/home/kr9sis/PDrive/",
     )
+    parser.add_argument(
+        "-w",
+        "--scan-workers",
+        type=int,
+        help="Number of threads listing directories while scanning for modified files",
+        default=1,
+    )
+    parser.add_argument(
+        "-m",
+        "--merge-scan",
+        help="Compare the whole tree with the database in one sorted pass",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--hash",
+        help="Hash modified files of unchanged size and skip uploading the ones whose contents didn't change",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--hash-rate",
+        type=int,
+        help="Bytes per second read while hashing, 0 for no limit",
+        default=0,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        help="Copy modified files in batches of this many per rclone call, 0 syncs each file on its own",
+        default=0,
+    )
+    parser.add_argument(
+        "-u",
+        "--upload-workers",
+        type=int,
+        help="Most uploads running at once, adjusted to the throughput the remote allows",
+        default=1,
+    )
+    parser.add_argument(
+        "--rcd",
+        help="Run one rclone rcd server for the whole run instead of rclone once per file",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--budget-bytes",
+        type=int,
+        help="Most bytes uploaded per run, the rest stays queued for the next run, 0 for no limit",
+        default=0,
+    )
+    parser.add_argument(
+        "--budget-seconds",
+        type=int,
+        help="Seconds a run may spend syncing before leaving the rest queued, 0 for no limit. "
+        "An hour by default, so a long sync doesn't hold the lock while the next runs are skipped",
+        default=3600,
+    )
+    parser.add_argument(
+        "--checkpoint-age",
+        type=int,
+        help="Seconds after which an unfinished scan is started over instead of resumed, 0 to not checkpoint scans",
+        default=6 * 3600,
+    )
+    parser.add_argument(
+        "--moves",
+        help="Detect moved and renamed files and folders and move them on the remote instead of uploading them again",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="node_exporter textfile to write the metrics of each run to, e.g. /var/lib/node_exporter/rclone_backup.prom",
+        default=None,
+    )
+    parser.add_argument(
+        "--pipeline",
+        help="Start uploading modified files while the scan is still running, checking the connection alongside it",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--on-busy",
+        choices=BUSY_ACTIONS,
+        help="What to do while another run is going: quit, hand a --retry_fails or --count over to it to run once it's done (other runs quit), or wait for it",
+        default="handoff",
+    )
+    parser.add_argument(
+        "--config",
+        type=Path,
+        help="Back up every root of this TOML file at once instead of the default directory, see roots.example.toml",
+        default=None,
+    )
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "-r",
@@ -165,6 +533,12 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    group.add_argument(
+        "--watch",
+        help="Run as a daemon journaling changed directories for the next runs",
+        action="store_true",
+        default=False,
+    )
     group.add_argument(
         "-c",
         "--count",
@@ -174,4 +548,58 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    main(args.stdout, args.cwd, args.retry_fails, args.count)
+    if args.watch and args.config is not None:
+        parser.error("--watch only watches the default directory, not the roots of --config")
+
+    def run_root(root: Root, upload_workers: int):
+        """
+        Runs the backup of a root from the config file with its share of the upload workers
+        """
+        main(
+            args.stdout,
+            Path(root.local_dir),
+            args.retry_fails,
+            args.count,
+            args.scan_workers,
+            args.merge_scan,
+            args.hash,
+            args.hash_rate,
+            args.batch_size,
+            upload_workers,
+            args.rcd,
+            args.budget_bytes,
+            args.budget_seconds,
+            args.checkpoint_age,
+            args.moves,
+            args.metrics_file,
+            args.pipeline,
+            root,
+            args.on_busy,
+        )
+
+    if args.watch:
+        watch(args.stdout)
+    elif args.config is not None:
+        run_roots(read_config(args.config), run_root)
+    else:
+        main(
+            args.stdout,
+            args.cwd,
+            args.retry_fails,
+            args.count,
+            args.scan_workers,
+            args.merge_scan,
+            args.hash,
+            args.hash_rate,
+            args.batch_size,
+            args.upload_workers,
+            args.rcd,
+            args.budget_bytes,
+            args.budget_seconds,
+            args.checkpoint_age,
+            args.moves,
+            args.metrics_file,
+            args.pipeline,
+            None,
+            args.on_busy,
+        )
@@ -0,0 +1,136 @@
+"""
+Metrics of a run: what the scan and sync did and how long they took, saved to the
+Metrics table and optionally to a node_exporter textfile for graphing and alerting
+"""
+
+from os import replace
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from helpers import VariableStorer
+
+# Prefix of every metric in the textfile
+PREFIX = "rclone_backup"
+# Upper bounds in seconds of the upload latency histogram's buckets
+UPLOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Help text of each metric, keyed by name
+HELP = {
+    "run_seconds": "Wall time of the run",
+    "scan_seconds": "Wall time of the scan, including its database reads and writes",
+    "db_seconds": "Time spent in SQLite calls",
+    "sync_seconds": "Wall time of syncing",
+    "dirs_scanned": "Directories listed by the scan",
+    "files_scanned": "Files and directories stat'ed by the scan",
+    "files_modified": "Files which were modified, created or deleted and synced this run",
+    "files_uploaded": "Files uploaded",
+    "bytes_uploaded": "Bytes uploaded",
+    "files_deleted": "Deletions synced",
+    "files_failed": "Files which failed to sync",
+    "rclone_failures": "Failed rclone calls by exit code",
+    "peak_rss_bytes": "Peak resident memory of the script",
+    "children_peak_rss_bytes": "Peak resident memory of the largest rclone process",
+    "upload_seconds": "Time each file took to upload",
+    "last_run_timestamp_seconds": "Unix time the last run finished",
+}
+
+
+class RunMetrics:
+    """
+    Counters and gauges of a run. Uploads running on the upload pool's
+    threads record into it too, so every update takes a lock
+    """
+
+    def __init__(self) -> None:
+        self.values: dict[tuple[str, str], float] = {}
+        self.upload_seconds: list[float] = []
+        self.lock = Lock()
+
+    def add(self, name: str, value: float = 1, labels: str = ""):
+        """
+        Adds value to a counter
+        """
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def set(self, name: str, value: float, labels: str = ""):
+        """
+        Sets a gauge
+        """
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def get(self, name: str, labels: str = "") -> float:
+        """
+        Gets the current value of a metric, 0 if it wasn't set
+        """
+        with self.lock:
+            return self.values.get((name, labels), 0)
+
+    def observe_upload(self, seconds: float):
+        """
+        Records how long a file took to upload
+        """
+        with self.lock:
+            self.upload_seconds.append(seconds)
+
+    def failure(self, code: int | str):
+        """
+        Counts a failed rclone call by its exit code, or the kind of error it had
+        """
+        self.add("rclone_failures", 1, f'code="{code}"')
+
+    def rows(self) -> list[tuple[str, str, float]]:
+        """
+        Gets every metric as (name, labels, value), the upload latency
+        histogram as cumulative buckets along with its sum and count
+        """
+        with self.lock:
+            rows = [
+                (name, labels, value) for (name, labels), value in sorted(self.values.items())
+            ]
+            upload_seconds = sorted(self.upload_seconds)
+
+        rows.append(("peak_rss_bytes", "", getrusage(RUSAGE_SELF).ru_maxrss * 1024))
+        rows.append(("children_peak_rss_bytes", "", getrusage(RUSAGE_CHILDREN).ru_maxrss * 1024))
+
+        count = 0
+        for bound in UPLOAD_BUCKETS:
+            while count < len(upload_seconds) and upload_seconds[count] <= bound:
+                count += 1
+            rows.append(("upload_seconds_bucket", f'le="{bound}"', count))
+        rows.append(("upload_seconds_bucket", 'le="+Inf"', len(upload_seconds)))
+        rows.append(("upload_seconds_sum", "", sum(upload_seconds)))
+        rows.append(("upload_seconds_count", "", len(upload_seconds)))
+        return rows
+
+
+def write_textfile(var_storer: "VariableStorer", rows: list[tuple[str, str, float]]):
+    """
+    Writes the metrics to var_storer.metrics_file in the Prometheus text format,
+    through a temporary file so node_exporter never reads half of it.
+    The metrics of a root from a config file are labeled with its name
+    """
+    root = f'root="{var_storer.root.name}"' if var_storer.root else ""
+    lines = []
+    described = set()
+    for name, labels, value in rows + [("last_run_timestamp_seconds", "", time())]:
+        # The histogram's buckets, sum and count are described once under its own name
+        base = "upload_seconds" if name.startswith("upload_seconds_") else name
+        if base not in described:
+            described.add(base)
+            lines.append(f"# HELP {PREFIX}_{base} {HELP[base]}")
+            kind = "histogram" if base == "upload_seconds" else "gauge"
+            lines.append(f"# TYPE {PREFIX}_{base} {kind}")
+
+        value = int(value) if float(value).is_integer() else value
+        labels = ",".join(label for label in (root, labels) if label)
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{PREFIX}_{name}{labels} {value}")
+
+    temp_file = var_storer.metrics_file.with_name(f".{var_storer.metrics_file.name}.tmp")
+    with open(temp_file, "w", encoding="utf-8") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    replace(temp_file, var_storer.metrics_file)
@@ -0,0 +1,102 @@
+"""
+Turns files and folders which were deleted in one place and created in another
+into moves, so the remote can move them instead of uploading them again
+"""
+
+from pathlib import Path
+
+from diff_ops import pair_moves
+from hash_ops import RateLimiter, hash_file
+from helpers import FileEntry, VariableStorer
+
+
+def __same_contents(
+    var_storer: VariableStorer,
+    limiter: RateLimiter,
+    old: FileEntry,
+    old_hash: str | None,
+    new: FileEntry,
+) -> bool:
+    """
+    Whether a file at its new path is what was synced from its old path.
+    The size and modification time have to match, and the content hash too
+    when hashing is on and a hash was stored, read within the rate of limiter
+    """
+    if old.is_dir or new.is_dir:
+        return old.is_dir == new.is_dir
+    if (old.size, old.mod_time) != (new.size, new.mod_time):
+        return False
+    if var_storer.hash_files and old_hash is not None:
+        new_hash = hash_file(new.path, limiter)
+        if new_hash != old_hash:
+            return False
+        var_storer.crud.hashes[new.path] = new_hash
+    return True
+
+
+def find_moves(var_storer: VariableStorer):
+    """
+    Pairs the files and folders removed and added during the scan as moves.
+    The moved entries are taken out of var_storer.mod_times, except files within a moved
+    folder which changed, and files which were deleted from within a moved folder are
+    added to it as deletions at their new path. The moves are recorded in the Moves table,
+    in the same transaction as the scan, for sync() to make on the remote
+    """
+    crud = var_storer.crud
+    moves = pair_moves(crud.removed, crud.added)
+    if not moves:
+        return
+
+    # One limiter for every file hashed, so they're read within --hash-rate together
+    limiter = RateLimiter(var_storer.hash_rate)
+    dropped: set[Path] = set()
+    deletions: list[FileEntry] = []
+    synced_hashes: dict[Path, str] = {}
+    added = {entry.path: entry for entry in crud.added}
+    removed_rows = sorted(crud.removed_rows.items(), key=lambda item: str(item[0]))
+    confirmed = []
+
+    for old, new in moves:
+        old_hash = crud.removed_rows.get(old.path, (old, None))[1]
+        if not __same_contents(var_storer, limiter, old, old_hash, new):
+            continue
+        confirmed.append((old, new))
+        dropped.update((old.path, new.path))
+        if old_hash is not None:
+            synced_hashes[new.path] = old_hash
+        if not old.is_dir:
+            continue
+
+        deleted_dirs: list[Path] = []
+        for path, (old_entry, old_hash) in removed_rows:
+            if not path.is_relative_to(old.path) or path == old.path:
+                continue
+
+            new_path = new.path / path.relative_to(old.path)
+            new_entry = added.get(new_path)
+            if new_entry is None:
+                # Deleted since it was synced, so it has to go from the moved folder too
+                if not any(new_path.is_relative_to(deleted) for deleted in deleted_dirs):
+                    deletions.append(old_entry._replace(path=new_path))
+                    if old_entry.is_dir:
+                        deleted_dirs.append(new_path)
+            elif __same_contents(var_storer, limiter, old_entry, old_hash, new_entry):
+                dropped.add(new_path)
+                if old_hash is not None:
+                    synced_hashes[new_path] = old_hash
+
+    if not confirmed:
+        return
+
+    if var_storer.STDOUT:
+        for old, new in confirmed:
+            print(f"Moved {old.path} -> {new.path}")
+
+    # Queued by a scan checkpoint before the moves were found. Files still waiting
+    # to be synced from the old path are moved to the new path in the queue afterwards
+    crud.unqueue_files(FileEntry(path, 0, 0, 0, False) for path in dropped)
+    crud.add_moves(confirmed)
+    crud.set_hashes(synced_hashes)
+    var_storer.mod_times = [
+        file for file in var_storer.mod_times if file.path not in dropped
+    ] + deletions
@@ -0,0 +1,237 @@
+"""
+Backend which starts one rclone rcd server per run and talks to it over
+its HTTP remote control API, so rclone's startup, config parsing and
+remote login are only paid once instead of once per file
+"""
+
+from http.client import HTTPConnection
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+from socket import AF_UNIX, SOCK_STREAM, socket
+from subprocess import DEVNULL, Popen, TimeoutExpired
+from tempfile import mkdtemp
+from threading import Lock, local
+from time import monotonic, sleep
+
+from helpers import FileEntry, VariableStorer, remote_path
+
+
+class RcdError(Exception):
+    """
+    Raised when rclone rcd can't be started or a call to it fails.
+    status is the HTTP status rc answered the call with, None if it didn't
+    """
+
+    def __init__(self, msg: str, status: int | None = None) -> None:
+        super().__init__(msg)
+        self.status = status
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    HTTP connection over a unix socket
+    """
+
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RcdBackend:
+    """
+    Runs rclone rcd on a unix socket within a private temporary directory,
+    which is why the server doesn't need authentication. Each thread keeps
+    its own persistent HTTP connection to it
+    """
+
+    def __init__(self, var_storer: VariableStorer, timeout: float) -> None:
+        self.var_storer = var_storer
+        self.timeout = timeout
+        self.socket_dir = mkdtemp(prefix="rclone_rcd_")
+        self.socket_path = str(Path(self.socket_dir) / "rc.sock")
+        self.connections = local()
+        # Every thread's connection, so stop() can close them
+        self.all_connections: list[UnixHTTPConnection] = []
+        self.connections_lock = Lock()
+        self.proc: Popen | None = None
+
+    def __enter__(self) -> "RcdBackend":
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self, wait: float = 15):
+        """
+        Starts rclone rcd and waits until it answers
+        """
+        self.proc = Popen(
+            [
+                "rclone",
+                "rcd",
+                "--rc-addr",
+                f"unix://{self.socket_path}",
+                "--rc-no-auth",
+                "--protondrive-replace-existing-draft=true",
+                *self.var_storer.rclone_flags,
+            ],
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+
+        deadline = monotonic() + wait
+        while True:
+            try:
+                self.call("rc/noop", {})
+                return
+            except (OSError, RcdError):
+                if self.proc.poll() is not None or monotonic() > deadline:
+                    self.stop()
+                    raise RcdError("rclone rcd didn't start")
+                sleep(0.1)
+
+    def stop(self):
+        """
+        Closes the connections, stops the server and removes its socket
+        """
+        with self.connections_lock:
+            for conn in self.all_connections:
+                conn.close()
+            self.all_connections.clear()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except TimeoutExpired:
+                self.proc.kill()
+        rmtree(self.socket_dir, ignore_errors=True)
+
+    def call(self, method: str, params: dict, timeout: float | None = None) -> dict:
+        """
+        Calls an rc method, reusing this thread's connection.
+        timeout overrides the backend's timeout for this call
+        """
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = self.connections.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+            with self.connections_lock:
+                self.all_connections.append(conn)
+        conn.timeout = timeout or self.timeout
+
+        try:
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            conn.request(
+                "POST",
+                f"/{method}",
+                body=dumps(params),
+                headers={"Content-Type": "application/json"},
+            )
+            response = conn.getresponse()
+            body = loads(response.read() or b"{}")
+        except (OSError, ValueError):
+            # Reconnect on the next call
+            conn.close()
+            self.connections.conn = None
+            with self.connections_lock:
+                self.all_connections.remove(conn)
+            raise
+
+        if response.status != 200:
+            raise RcdError(body.get("error", f"HTTP {response.status}"), response.status)
+        return body
+
+    def list(self, remote: str = "", dirs_only: bool = False) -> list[dict]:
+        """
+        Lists a directory of the remote
+        """
+        return self.call(
+            "operations/list",
+            {"fs": self.var_storer.REMOTE_DIR, "remote": remote, "opt": {"dirsOnly": dirs_only}},
+        )["list"]
+
+    def sync_file(self, file: FileEntry, timeout: float | None = None) -> None:
+        """
+        Copies a file to the remote, or deletes it there if it was deleted locally.
+        Raises RcdError or OSError if that fails, TimeoutError if the copy takes
+        longer than timeout
+        """
+        rel_file_path = str(file.path.relative_to(self.var_storer.LOCAL_DIR))
+
+        if file.path.exists():
+            self.__copy(rel_file_path, timeout)
+            return
+
+        try:
+            self.call(
+                "operations/purge" if file.is_dir else "operations/deletefile",
+                {"fs": self.var_storer.REMOTE_DIR, "remote": rel_file_path},
+            )
+        except RcdError as e:
+            # rc answers 404 when the file or directory isn't there, so it's already deleted
+            if e.status != 404:
+                raise
+
+    def __copy(self, rel_file_path: str, timeout: float | None):
+        """
+        Copies a file as an rc job, polling until it's done. A copy taking longer
+        than timeout is stopped with job/stop, so it doesn't keep running inside
+        rcd while the file is retried
+        """
+        job_id = self.call(
+            "operations/copyfile",
+            {
+                "srcFs": self.var_storer.LOCAL_DIR,
+                "srcRemote": rel_file_path,
+                "dstFs": self.var_storer.REMOTE_DIR,
+                "dstRemote": rel_file_path,
+                "_async": True,
+            },
+        )["jobid"]
+
+        deadline = None if timeout is None else monotonic() + timeout
+        delay = 0.01
+        while True:
+            job = self.call("job/status", {"jobid": job_id})
+            if job["finished"]:
+                if not job["success"]:
+                    raise RcdError(job.get("error") or "copy failed")
+                return
+            if deadline is not None and monotonic() >= deadline:
+                self.call("job/stop", {"jobid": job_id})
+                raise TimeoutError(f"Copy stopped after {timeout:.0f} seconds")
+            sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def move(self, old_path: str, new_path: str, is_dir: bool) -> None:
+        """
+        Moves a file or directory on the remote, server side where the remote supports it.
+        Raises RcdError or OSError if that fails
+        """
+        if is_dir:
+            self.call(
+                "sync/move",
+                {
+                    "srcFs": remote_path(self.var_storer, old_path),
+                    "dstFs": remote_path(self.var_storer, new_path),
+                    "deleteEmptySrcDirs": True,
+                },
+            )
+            return
+
+        self.call(
+            "operations/movefile",
+            {
+                "srcFs": self.var_storer.REMOTE_DIR,
+                "srcRemote": old_path,
+                "dstFs": self.var_storer.REMOTE_DIR,
+                "dstRemote": new_path,
+            },
+        )
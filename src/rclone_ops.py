@@ -2,12 +2,38 @@
 Functions which interact with rclone
 """
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from json import loads
 from pathlib import Path
-from subprocess import CalledProcessError, TimeoutExpired, run
+from queue import Queue, SimpleQueue
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, TimeoutExpired, run
+from tempfile import NamedTemporaryFile
 from textwrap import dedent
+from threading import Event, Lock, Timer
+from time import monotonic, time_ns
+from typing import Iterable, Iterator
 
-from db_ops import get_num_synced_files, update_db_mod_file
-from helpers import VariableStorer
+from db_ops import (
+    get_connectivity,
+    get_num_synced_files,
+    set_connectivity,
+    update_db_mod_file,
+    write_num_mod_files,
+)
+from helpers import FileEntry, VariableStorer, get_file_entry, remote_path
+from lane_ops import LANES, TIMEOUT, UploadTimeouts, lane_of, lane_workers
+from rcd_ops import RcdBackend, RcdError
+from upload_ops import UploadJob, UploadPool, run_lanes
+
+# Failed attempts at a move before its files are uploaded again instead
+MOVE_ATTEMPTS = 3
+# Uploads the pipelined scan may get ahead of the upload workers by before it waits for them
+PIPELINE_BACKLOG = 64
+# Seconds runs skip the connection check for after it failed, doubled for every
+# failure in a row up to OFFLINE_BACKOFF_MAX
+OFFLINE_BACKOFF = 900
+OFFLINE_BACKOFF_MAX = 21600
 
 
 def check_connection(var_storer: VariableStorer) -> bool:
@@ -19,28 +45,106 @@ def check_connection(var_storer: VariableStorer) -> bool:
     try:
         if var_storer.STDOUT:
             print("Checking connection")
+        if var_storer.rcd is not None:
+            var_storer.rcd.list(dirs_only=True)
+            return True
         _ = run(
-            ["rclone", "lsd", var_storer.REMOTE_DIR],
+            ["rclone", "lsd", var_storer.REMOTE_DIR, *var_storer.rclone_flags],
             check=True,
             timeout=60,
             capture_output=True,
         )
         return True
 
-    except (CalledProcessError, TimeoutExpired):
+    except (CalledProcessError, TimeoutExpired, OSError, RcdError):
         with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
             print(
-                dedent("# Remote Connect Failed  #\n# Exiting Run            #"),
+                "# Remote Connect Failed  #",
                 file=log_file,
             )
         return False
 
 
-def sync(var_storer: VariableStorer):
+def in_backoff(var_storer: VariableStorer) -> bool:
     """
-    Sync modified files to Proton Drive
+    Checks if the remote couldn't be reached recently enough that checking again is skipped
+    """
+    state = get_connectivity(var_storer)
+    if state is None or not state[0] or time_ns() >= state[1]:
+        return False
+    with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+        print("# Connect Check Skipped  #", file=log_file)
+    return True
+
+
+def record_connection(var_storer: VariableStorer, online: bool):
+    """
+    Records the result of a connection check. Each failure in a row doubles
+    how long the following runs skip the check for
+    """
+    if online:
+        set_connectivity(var_storer, 0, 0)
+        return
+    state = get_connectivity(var_storer)
+    failures = (state[0] if state else 0) + 1
+    backoff = min(OFFLINE_BACKOFF * 2 ** (failures - 1), OFFLINE_BACKOFF_MAX)
+    set_connectivity(var_storer, failures, time_ns() + backoff * 1_000_000_000)
+
+
+def connection_available(var_storer: VariableStorer) -> bool:
+    """
+    Checks the connection unless it failed recently, and records the result
+    """
+    if in_backoff(var_storer):
+        return False
+    online = check_connection(var_storer)
+    record_connection(var_storer, online)
+    return online
+
+
+@contextmanager
+def rclone_backend(var_storer: VariableStorer, use_rcd: bool):
+    """
+    Runs an rclone rcd server for the duration of the block if use_rcd is set.
+    If it can't be started, every file gets its own rclone call as before
+    """
+    if not use_rcd:
+        yield
+        return
+
+    try:
+        var_storer.rcd = RcdBackend(var_storer, TIMEOUT)
+        var_storer.rcd.start()
+    except (OSError, RcdError) as e:
+        if var_storer.STDOUT:
+            print(f"Falling back to one rclone call per file: {e}")
+        var_storer.rcd = None
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        var_storer.rcd.stop()
+        var_storer.rcd = None
+
+
+def __log_sync_error(var_storer: VariableStorer, e):
+    """
+    Writes a failed sync to the error log
     """
+    with open(var_storer.err_log, "a", encoding="utf-8") as err_file:
+        print(f"\n{'#'*80}", file=err_file)
+        print(var_storer.start_time, file=err_file)
+        print(e, file=err_file)
+        print(f"{'#'*80}", file=err_file)
+
 
+def __sync_file(var_storer: VariableStorer, file: FileEntry) -> bool:
+    """
+    Syncs a single file with its own rclone sync call
+    """
+    rel_file_path: Path = file.path.relative_to(var_storer.LOCAL_DIR)
     command = [
         "rclone",
         "sync",
@@ -48,49 +152,680 @@ def sync(var_storer: VariableStorer):
         var_storer.REMOTE_DIR,
         "-v",
         "--protondrive-replace-existing-draft=true",
+        *var_storer.rclone_flags,
+        *lane_of(file).flags,
+        "--include",
+        str(rel_file_path),
     ]
+    timeout = var_storer.upload_timeouts.timeout(file)
 
-    sync_fails: int = 0
-    file_num = 0
-    for file_path, mod_time in var_storer.mod_times:
-        rel_file_path: Path = file_path.relative_to(var_storer.LOCAL_DIR)
-        cmd_with_file = []
-        cmd_with_file.extend(command)
-        cmd_with_file.extend(["--include", str(rel_file_path)])
+    start = monotonic()
+    try:
+        # Concurrent uploads would interleave rclone's output
+        run(command, check=True, timeout=timeout, capture_output=var_storer.upload_workers > 1)
+        var_storer.metrics.observe_upload(monotonic() - start)
+        return True
+
+    except CalledProcessError as e:
+        var_storer.metrics.failure(e.returncode)
+        __log_sync_error(var_storer, f"{e}\n{e.stderr.decode() if e.stderr else ''}")
+        return False
+    except TimeoutExpired as e:
+        var_storer.metrics.failure("timeout")
+        var_storer.upload_timeouts.timed_out.add(file.path)
+        __log_sync_error(var_storer, f"{e}\n{e.stderr.decode() if e.stderr else ''}")
+        return False
+
+
+def __sync_file_rcd(var_storer: VariableStorer, file: FileEntry) -> bool:
+    """
+    Syncs a single file, or its deletion, through the rclone rcd server
+    """
+    start = monotonic()
+    try:
+        var_storer.rcd.sync_file(file, var_storer.upload_timeouts.timeout(file))
+        var_storer.metrics.observe_upload(monotonic() - start)
+        return True
+
+    except TimeoutError as e:
+        var_storer.metrics.failure("timeout")
+        var_storer.upload_timeouts.timed_out.add(file.path)
+        __log_sync_error(var_storer, f"{file.path}: {e}")
+        return False
+    except (OSError, RcdError) as e:
+        var_storer.metrics.failure("rcd")
+        __log_sync_error(var_storer, f"{file.path}: {e}")
+        return False
+
+
+def __sync_batch(
+    var_storer: VariableStorer, batch: list[FileEntry]
+) -> Iterator[tuple[FileEntry, bool]]:
+    """
+    Copies a batch of existing files of one lane with one rclone copy call reading them
+    from a --files-from-raw list. The JSON log rclone writes to stderr is read while it runs,
+    so each file is yielded as (file, synced) as soon as rclone reports it copied.
+    Files it didn't report on were already up to date if rclone succeeded.
+    rclone is killed once the batch takes longer than the timeouts of its files together
+    """
+    pending = {str(file.path.relative_to(var_storer.LOCAL_DIR)): file for file in batch}
+
+    with NamedTemporaryFile(
+        "w", encoding="utf-8", prefix="rclone_files_", suffix=".txt"
+    ) as files_from:
+        files_from.write("\n".join(pending) + "\n")
+        files_from.flush()
+
+        command = [
+            "rclone",
+            "copy",
+            var_storer.LOCAL_DIR,
+            var_storer.REMOTE_DIR,
+            "-v",
+            "--use-json-log",
+            "--protondrive-replace-existing-draft=true",
+            *var_storer.rclone_flags,
+            *lane_of(batch[0]).flags,
+            "--files-from-raw",
+            files_from.name,
+        ]
+        timeout = sum(var_storer.upload_timeouts.timeout(file) for file in batch)
+        killed = Event()
+
+        with Popen(command, stdout=DEVNULL, stderr=PIPE, encoding="utf-8") as proc:
+
+            def kill():
+                killed.set()
+                proc.kill()
+
+            timer = Timer(timeout, kill)
+            timer.start()
+            # Files are copied one after the other, so each took the time since the last
+            last_copied = monotonic()
+            try:
+                for line in proc.stderr:
+                    try:
+                        log = loads(line)
+                    except ValueError:
+                        continue
+
+                    rel_file_path = log.get("object")
+                    if rel_file_path not in pending:
+                        continue
+
+                    if log.get("level") == "error":
+                        # rclone retries failed files, so only log it for now
+                        __log_sync_error(var_storer, f"{rel_file_path}: {log.get('msg')}")
+                    elif str(log.get("msg", "")).startswith(("Copied", "Updated")):
+                        var_storer.metrics.observe_upload(monotonic() - last_copied)
+                        last_copied = monotonic()
+                        yield pending.pop(rel_file_path), True
+
+                proc.wait()
+            finally:
+                timer.cancel()
+
+    if killed.is_set():
+        var_storer.metrics.failure("timeout")
+        var_storer.upload_timeouts.timed_out.update(file.path for file in pending.values())
+        __log_sync_error(
+            var_storer, f"rclone copy of {len(batch)} files timed out after {timeout:.0f} seconds"
+        )
+    elif proc.returncode != 0:
+        var_storer.metrics.failure(proc.returncode)
+        __log_sync_error(
+            var_storer, f"rclone copy of {len(batch)} files exited with {proc.returncode}"
+        )
+    for file in pending.values():
+        yield file, proc.returncode == 0
+
+
+def __collapse_deletions(deleted: list[FileEntry]) -> list[tuple[FileEntry, list[FileEntry]]]:
+    """
+    Groups deleted files under the highest deleted folder they're in,
+    as (deleted folder or loose file, every deleted entry it covers)
+    """
+    roots: list[tuple[FileEntry, list[FileEntry]]] = []
+    for file in sorted(deleted, key=lambda file: file.path.parts):
+        if roots and roots[-1][0].is_dir and file.path.is_relative_to(roots[-1][0].path):
+            roots[-1][1].append(file)
+        else:
+            roots.append((file, [file]))
+    return roots
+
+
+def __delete_dir(var_storer: VariableStorer, root: FileEntry, covered: list[FileEntry]):
+    """
+    Deletes a deleted folder and everything in it from the remote with one rclone purge
+    """
+    rel_dir_path = str(root.path.relative_to(var_storer.LOCAL_DIR))
+    try:
+        run(
+            [
+                "rclone",
+                "purge",
+                remote_path(var_storer, rel_dir_path),
+                "-v",
+                *var_storer.rclone_flags,
+            ],
+            check=True,
+            timeout=TIMEOUT,
+            capture_output=True,
+        )
+        deleted = True
+
+    except CalledProcessError as e:
+        # Exit code 3 is rclone's directory not found, so it's already gone
+        deleted = e.returncode == 3
+        if not deleted:
+            var_storer.metrics.failure(e.returncode)
+            __log_sync_error(var_storer, f"{e}\n{e.stderr.decode() if e.stderr else ''}")
+    except TimeoutExpired as e:
+        var_storer.metrics.failure("timeout")
+        __log_sync_error(var_storer, e)
+        deleted = False
+
+    return [(file, deleted) for file in covered]
+
+
+def __delete_files(var_storer: VariableStorer, files: list[FileEntry]):
+    """
+    Deletes deleted files from the remote with one rclone delete call
+    reading them from a --files-from-raw list
+    """
+    with NamedTemporaryFile(
+        "w", encoding="utf-8", prefix="rclone_deleted_", suffix=".txt"
+    ) as files_from:
+        files_from.write(
+            "\n".join(str(file.path.relative_to(var_storer.LOCAL_DIR)) for file in files) + "\n"
+        )
+        files_from.flush()
 
         try:
-            run(cmd_with_file, check=True, timeout=1300)
-            update_db_mod_file(var_storer, str(file_path), mod_time)
+            run(
+                [
+                    "rclone",
+                    "delete",
+                    var_storer.REMOTE_DIR,
+                    "-v",
+                    *var_storer.rclone_flags,
+                    "--files-from-raw",
+                    files_from.name,
+                ],
+                check=True,
+                timeout=TIMEOUT,
+                capture_output=True,
+            )
+            deleted = True
 
         except (CalledProcessError, TimeoutExpired) as e:
-            sync_fails += 1
+            var_storer.metrics.failure(getattr(e, "returncode", "timeout"))
+            __log_sync_error(var_storer, f"{e}\n{e.stderr.decode() if e.stderr else ''}")
+            deleted = False
+
+    return [(file, deleted) for file in files]
+
+
+def __delete_rcd(var_storer: VariableStorer, root: FileEntry, covered: list[FileEntry]):
+    """
+    Deletes a deleted file, or purges a deleted folder, through the rclone rcd server
+    """
+    deleted = __sync_file_rcd(var_storer, root)
+    return [(file, deleted) for file in covered]
+
+
+def __deletion_jobs(var_storer: VariableStorer, deleted: list[FileEntry]) -> list[UploadJob]:
+    """
+    Turns deleted files into as few jobs as possible. Every deleted folder is purged
+    along with everything in it and the loose files are deleted together,
+    or one by one through the rclone rcd server where each call is cheap
+    """
+    jobs: list[UploadJob] = []
+    loose: list[FileEntry] = []
+    for root, covered in __collapse_deletions(deleted):
+        if var_storer.rcd is not None:
+            jobs.append(lambda root=root, covered=covered: __delete_rcd(var_storer, root, covered))
+        elif root.is_dir:
+            jobs.append(lambda root=root, covered=covered: __delete_dir(var_storer, root, covered))
+        else:
+            loose.append(root)
+
+    if loose:
+        jobs.append(lambda: __delete_files(var_storer, loose))
+    return jobs
+
+
+def __move(var_storer: VariableStorer, old_path: Path, new_path: Path, is_dir: bool) -> bool:
+    """
+    Moves a file or folder on the remote with rclone moveto, or the rclone rcd server
+    """
+    old_rel = str(old_path.relative_to(var_storer.LOCAL_DIR))
+    new_rel = str(new_path.relative_to(var_storer.LOCAL_DIR))
+    try:
+        if var_storer.rcd is not None:
+            var_storer.rcd.move(old_rel, new_rel, is_dir)
+        else:
+            run(
+                [
+                    "rclone",
+                    "moveto",
+                    remote_path(var_storer, old_rel),
+                    remote_path(var_storer, new_rel),
+                    "-v",
+                    "--protondrive-replace-existing-draft=true",
+                    *var_storer.rclone_flags,
+                ],
+                check=True,
+                timeout=TIMEOUT,
+                capture_output=True,
+            )
+        return True
+
+    except (CalledProcessError, TimeoutExpired) as e:
+        __log_sync_error(var_storer, f"{e}\n{e.stderr.decode() if e.stderr else ''}")
+    except (OSError, RcdError) as e:
+        __log_sync_error(var_storer, f"Moving {old_path}: {e}")
+    return False
+
+
+def __make_moves(var_storer: VariableStorer) -> list[Path]:
+    """
+    Makes the moves found by earlier scans on the remote, in the order they were made.
+    A move which failed MOVE_ATTEMPTS times is given up on, and its files are queued
+    to be uploaded to the new path and deleted from the old one instead.
+    Returns the new paths of the moves still to be made, which nothing may be uploaded to
+    """
+    pending = []
+    for old_path, new_path, is_dir, attempts in var_storer.crud.get_moves():
+        if __move(var_storer, old_path, new_path, is_dir):
+            if var_storer.STDOUT:
+                print(f"Moved {old_path} -> {new_path}")
+            var_storer.crud.finish_move(old_path, True)
+            continue
+
+        if attempts + 1 < MOVE_ATTEMPTS:
+            var_storer.crud.finish_move(old_path, False)
+            pending.append(new_path)
+            continue
+
+        with var_storer.crud.transaction():
+            files = [get_file_entry(new_path), FileEntry(old_path, 0, 0, 0, is_dir)]
+            if is_dir:
+                files.extend(var_storer.crud.files_below(new_path))
+            var_storer.crud.queue_files(files, time_ns())
+        var_storer.crud.finish_move(old_path, True)
+
+    return pending
+
+
+def __sync_files(var_storer: VariableStorer) -> Iterator[tuple[FileEntry, bool]]:
+    """
+    Syncs every modified file, yielding (file, synced) as each one finishes.
+    With var_storer.batch_size set, existing files are copied in batches of that size
+    within each lane of lane_ops.LANES.
+    With the rcd backend running every file is one call to it.
+    Deleted files are grouped by __deletion_jobs after the existing files.
+    With var_storer.upload_workers above 1 the uploads run concurrently, and with at
+    least one upload worker per lane each lane runs at once with its share of them.
+    Pending moves are made first, and files within the new path of a move
+    which couldn't be made are left for the next run
+    """
+    moves = __make_moves(var_storer)
+    mod_times = [
+        file for file in var_storer.mod_times
+        if not any(file.path.is_relative_to(new_path) for new_path in moves)
+    ]
+
+    existing = [file for file in mod_times if file.path.exists()]
+    deleted = [file for file in mod_times if not file.path.exists()]
+
+    lanes: list[list[UploadJob]] = []
+    for lane in LANES:
+        files = [file for file in existing if lane_of(file) is lane]
+        jobs: list[UploadJob] = []
+        if var_storer.rcd is not None:
+            # Calls to the server are cheap, so batching wouldn't gain anything
+            for file in files:
+                jobs.append(lambda file=file: [(file, __sync_file_rcd(var_storer, file))])
+        elif var_storer.batch_size:
+            for start in range(0, len(files), var_storer.batch_size):
+                batch = files[start : start + var_storer.batch_size]
+                jobs.append(lambda batch=batch: __sync_batch(var_storer, batch))
+        else:
+            for file in files:
+                jobs.append(lambda file=file: [(file, __sync_file(var_storer, file))])
+        lanes.append(jobs)
+
+    deletions = __deletion_jobs(var_storer, deleted)
+
+    if var_storer.upload_workers >= len(LANES):
+        # Deleting is quick, like uploading a small file
+        lanes[0].extend(deletions)
+        yield from run_lanes(
+            var_storer,
+            [
+                (workers, __before_deadline(var_storer, jobs))
+                for workers, jobs in zip(lane_workers(var_storer.upload_workers), lanes)
+            ],
+        )
+        return
+
+    jobs = __before_deadline(var_storer, [job for jobs in lanes for job in jobs] + deletions)
+    if var_storer.upload_workers > 1:
+        yield from UploadPool(var_storer, var_storer.upload_workers).run(jobs)
+    else:
+        for job in jobs:
+            yield from job()
+
+
+def __before_deadline(var_storer: VariableStorer, jobs: list[UploadJob]) -> Iterable[UploadJob]:
+    """
+    Hands out jobs until var_storer.budget_seconds have passed since the first one.
+    Jobs already running are finished, the rest is left for the next run
+    """
+    deadline = monotonic() + var_storer.budget_seconds
+    for job in jobs:
+        if var_storer.budget_seconds and monotonic() >= deadline:
+            if var_storer.STDOUT:
+                print("Sync time budget used up")
+            return
+        yield job
+
+
+class SyncTally:
+    """
+    Keeps count of the files a sync has finished, writing each result to the database,
+    and writes the run's totals and summary once it's done
+    """
+
+    def __init__(self, var_storer: VariableStorer) -> None:
+        self.var_storer = var_storer
+        self.start = monotonic()
+        self.sync_fails = 0
+        self.file_num = 0
+        self.attempted: set[Path] = set()
+        self.synced_bytes = 0
+
+    def record(self, file: FileEntry, synced: bool):
+        """
+        Records whether a file synced
+        """
+        var_storer = self.var_storer
+        self.attempted.add(file.path)
+        if synced:
+            update_db_mod_file(var_storer, file)
+            self.synced_bytes += file.size
+            if file.path.exists():
+                var_storer.metrics.add("files_uploaded")
+                var_storer.metrics.add("bytes_uploaded", file.size)
+            else:
+                var_storer.metrics.add("files_deleted")
+        else:
+            self.sync_fails += 1
+            timed_out = file.path in var_storer.upload_timeouts.timed_out
+            var_storer.crud.mark_failed(var_storer.now, file, timed_out)
             print("\nFAILED ", end="")
-            with open(var_storer.err_log, "a", encoding="utf-8") as err_file:
-                print(f"\n{'#'*80}", file=err_file)
-                print(var_storer.start_time, file=err_file)
-                print(e, file=err_file)
-                print(f"{'#'*80}", file=err_file)
 
         if var_storer.STDOUT:
-            file_num += 1
-            percent = round((file_num / len(var_storer.mod_times)) * 100)
-            print(f"Syncing file #{file_num}:\n{rel_file_path}\n")
+            self.file_num += 1
+            percent = round((self.file_num / len(var_storer.mod_times)) * 100)
+            print(f"Syncing file #{self.file_num}:\n{file.path.relative_to(var_storer.LOCAL_DIR)}\n")
             print(f"Total synced: {percent}%\n")
 
-    if sync_fails:
-        fails = f"Fails {sync_fails}"
-        if len(fails) < 12:
-            str_diff = 12 - len(fails)
-            fails += " " * str_diff
-        fails += "#"
-        with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
-            print(dedent(fails), file=log_file)
+    def finish(self):
+        """
+        Writes the remaining results, the run's totals and the summary in the run log.
+        Files of var_storer.mod_times which weren't attempted are left queued, and the
+        ids of paths nothing refers to anymore are pruned
+        """
+        var_storer = self.var_storer
+        sync_fails = self.sync_fails
+        var_storer.crud.flush()
+        var_storer.crud.record_run(
+            var_storer.now,
+            len(self.attempted) - sync_fails,
+            self.synced_bytes,
+            monotonic() - self.start,
+        )
+        var_storer.metrics.set("sync_seconds", monotonic() - self.start)
+        var_storer.metrics.set("files_modified", len(var_storer.mod_times))
+        var_storer.metrics.set("files_failed", sync_fails)
+
+        skipped = [file for file in var_storer.mod_times if file.path not in self.attempted]
+        if skipped:
+            # They're still queued, so only the next run logs them
+            var_storer.crud.unlog_files(var_storer.now, skipped)
+            if var_storer.STDOUT:
+                print(f"{len(skipped)} files left queued for the next run")
+        with var_storer.crud.transaction():
+            var_storer.crud.prune_ids()
+
+        if sync_fails:
+            fails = f"Fails {sync_fails}"
+            if len(fails) < 12:
+                str_diff = 12 - len(fails)
+                fails += " " * str_diff
+            fails += "#"
+            with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+                print(dedent(fails), file=log_file)
+
+        else:
+            with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
+                synced = f"Synced {get_num_synced_files(var_storer)} "
+                if len(synced) < 12:
+                    str_diff = 12 - len(synced)
+                    synced += " " * str_diff
+                synced += "#"
+                print(dedent(synced), file=log_file)
+
+        var_storer.upload_timeouts.report(var_storer, self.attempted)
 
+
+def sync(var_storer: VariableStorer):
+    """
+    Sync modified files to Proton Drive
+    """
+    if var_storer.upload_timeouts is None:
+        var_storer.upload_timeouts = UploadTimeouts(var_storer)
+    tally = SyncTally(var_storer)
+    for file, synced in __sync_files(var_storer):
+        tally.record(file, synced)
+    tally.finish()
+
+
+def __always_modified(var_storer: VariableStorer, file: FileEntry) -> bool:
+    """
+    Whether a file is the database or a log, which keep changing during the run
+    """
+    return file.path.name.startswith(var_storer.db_file.name) or file.path.is_relative_to(
+        var_storer.run_log.parent
+    )
+
+
+def sync_pipelined(
+    var_storer: VariableStorer, changes: Iterable[FileEntry], scan_start: int
+) -> bool:
+    """
+    Syncs the modified files while the scan is still finding them. The connection is
+    checked on its own thread alongside the scan, unless it failed recently, and the
+    files left queued by earlier runs are handed to var_storer.upload_workers upload
+    threads first. Then each modified file is queued, logged and handed to them as soon
+    as it's found. The scan waits for the uploads once PIPELINE_BACKLOG of them are waiting.
+    Deletions and the database and logs are synced after the scan. Results are written
+    by the calling thread in between reading changes, as it's the only one using the
+    database connection. If the remote can't be reached everything found stays queued
+    for the next run.
+    Returns False if only the database and logs changed, in which case nothing
+    is synced and, like a phased run, the scan shouldn't be committed
+    """
+    start = monotonic()
+    checked = not in_backoff(var_storer)
+    if checked:
+        checker = ThreadPoolExecutor(max_workers=1)
+        online = checker.submit(check_connection, var_storer)
+        checker.shutdown(wait=False)
     else:
-        with open(var_storer.run_log, "a", encoding="utf-8") as log_file:
-            synced = f"Synced {get_num_synced_files(var_storer)} "
-            if len(synced) < 12:
-                str_diff = 12 - len(synced)
-                synced += " " * str_diff
-            synced += "#"
-            print(dedent(synced), file=log_file)
+        online = Future()
+        online.set_result(False)
+
+    jobs: Queue[UploadJob | None] = Queue(maxsize=PIPELINE_BACKLOG)
+    results: SimpleQueue = SimpleQueue()
+    stop = Event()
+    # Like a phased run, the time budget counts from the first upload handed out
+    deadline: float | None = None
+    deadline_lock = Lock()
+
+    def past_deadline() -> bool:
+        nonlocal deadline
+        with deadline_lock:
+            if deadline is None:
+                deadline = monotonic() + var_storer.budget_seconds
+            return monotonic() >= deadline
+
+    def worker():
+        while (job := jobs.get()) is not None:
+            if stop.is_set() or not online.result():
+                continue
+            if var_storer.budget_seconds and past_deadline():
+                continue  # Left for the next run
+            try:
+                for result in job():
+                    results.put(result)
+            except Exception as e:
+                results.put(e)
+        results.put(None)
+
+    var_storer.upload_timeouts = UploadTimeouts(var_storer)
+    tally = SyncTally(var_storer)
+    workers = var_storer.upload_workers
+
+    def handle(result):
+        nonlocal workers
+        if result is None:
+            workers -= 1
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            tally.record(*result)
+
+    found: set[Path] = set()
+    # Queued files uploaded before the scan
+    early: set[Path] = set()
+    # Only the files which weren't modified again are left once the scan is done
+    leftovers = {file.path: file for file, _ in var_storer.crud.get_queue()}
+    # Batches are filled per lane
+    batches: dict[str, list[FileEntry]] = {lane.name: [] for lane in LANES}
+    deleted: list[FileEntry] = []
+    last: list[FileEntry] = []
+    total_bytes = 0
+
+    def submit(files: list[FileEntry], job: UploadJob):
+        var_storer.crud.log_files(var_storer.now, files)
+        var_storer.mod_times.extend(files)
+        jobs.put(job)
+
+    def upload(file: FileEntry):
+        nonlocal total_bytes
+        if var_storer.budget_bytes and total_bytes + file.size > var_storer.budget_bytes:
+            return  # Stays queued
+        if var_storer.upload_timeouts.is_stuck(file):
+            return  # Stays queued until --retry_fails
+        total_bytes += file.size
+
+        if var_storer.rcd is not None:
+            submit([file], lambda file=file: [(file, __sync_file_rcd(var_storer, file))])
+        elif var_storer.batch_size:
+            batch = batches[lane_of(file).name]
+            batch.append(file)
+            if len(batch) >= var_storer.batch_size:
+                submit(batch, lambda batch=list(batch): __sync_batch(var_storer, batch))
+                batch.clear()
+        else:
+            submit([file], lambda file=file: [(file, __sync_file(var_storer, file))])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in range(workers):
+            pool.submit(worker)
+
+        try:
+            if checked:
+                # Files queued while offline don't wait for the scan
+                for path, file in list(leftovers.items()):
+                    if not __always_modified(var_storer, file) and file.path.exists():
+                        del leftovers[path]
+                        found.add(path)
+                        early.add(path)
+                        upload(file)
+
+            for file in changes:
+                if file.path in early:
+                    # Changed again, which its upload may have missed, so the next run syncs it
+                    var_storer.crud.queue_files([file], scan_start)
+                    early.discard(file.path)
+                    continue
+                if file.path in found:
+                    continue
+                var_storer.crud.queue_files([file], scan_start)
+                leftovers.pop(file.path, None)
+                found.add(file.path)
+
+                if online.done() and not online.result():
+                    continue
+                if __always_modified(var_storer, file):
+                    last.append(file)
+                elif file.path.exists():
+                    upload(file)
+                else:
+                    deleted.append(file)
+
+                while not results.empty():
+                    handle(results.get())
+
+            var_storer.metrics.set("scan_seconds", monotonic() - start)
+
+            if not online.result():
+                stop.set()
+            elif not var_storer.mod_times and len(found) + len(leftovers) == 3:
+                # Only the database and logs changed
+                stop.set()
+                var_storer.crud.rollback()
+                record_connection(var_storer, True)
+                var_storer.db_conn.commit()
+                return False
+            else:
+                for file in [*leftovers.values(), *last]:
+                    if file.path.exists():
+                        upload(file)
+                    else:
+                        deleted.append(file)
+                for batch in batches.values():
+                    if batch:
+                        submit(batch, lambda batch=batch: __sync_batch(var_storer, batch))
+                if deleted:
+                    var_storer.crud.log_files(var_storer.now, deleted)
+                    var_storer.mod_times.extend(deleted)
+                    for job in __deletion_jobs(var_storer, deleted):
+                        jobs.put(job)
+                write_num_mod_files(var_storer)
+
+        except BaseException:
+            stop.set()
+            raise
+
+        finally:
+            for _ in range(var_storer.upload_workers):
+                jobs.put(None)
+            while workers:
+                handle(results.get())
+
+    if checked:
+        record_connection(var_storer, online.result())
+    if stop.is_set():
+        # Nothing was attempted
+        var_storer.crud.unlog_files(var_storer.now, var_storer.mod_times)
+        var_storer.mod_times = []
+        with open(var_storer.run_log, "a", encoding="utf-8") as run_log:
+            print(f"# Files {len(found) + len(leftovers):<7}{'Queued':<10}#", file=run_log)
+        return True
+    tally.finish()
+    return True
@@ -0,0 +1,134 @@
+"""
+Backs up several local directories, each to its own remote, from one config file.
+Every root has its own exclusions, database and logs, and the roots run at the same
+time while sharing one upload bandwidth and upload worker budget between them
+"""
+
+import re
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+from filter_ops import FILTER_FILE
+
+# rclone --bwlimit sizes, in KiB per second without a suffix
+__BWLIMIT_UNITS = {"b": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+class Root(NamedTuple):
+    """
+    A local directory backed up to a remote, with its own exclusions, database and logs
+    """
+
+    name: str
+    local_dir: str
+    remote_dir: str
+    # rclone filter file with the root's exclusions
+    filter_file: Path
+    # Globs excluded on top of the filter file
+    excludes: tuple[str, ...]
+    # Added to every rclone call of the root's runs
+    rclone_flags: tuple[str, ...] = ()
+
+
+class RootsConfig(NamedTuple):
+    """
+    The roots of a config file and the budget they share
+    """
+
+    roots: list[Root]
+    # Bytes per second all roots may upload together, 0 for no limit
+    bwlimit: int
+    # Uploads all roots may run at once
+    upload_workers: int
+    # Roots running at once
+    parallel: int
+
+
+def parse_bwlimit(bwlimit: str | int) -> int:
+    """
+    Converts a size like rclone's --bwlimit takes, e.g. 512k or 10M,
+    to bytes per second. Plain numbers are KiB and "off" is 0
+    """
+    if isinstance(bwlimit, int):
+        return bwlimit * 2**10
+    bwlimit = bwlimit.strip().lower()
+    if bwlimit == "off":
+        return 0
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([bkmgt]?)", bwlimit)
+    if match is None:
+        raise ValueError(f"Invalid bwlimit {bwlimit}, expected a size like 10M or off")
+    return int(float(match[1]) * __BWLIMIT_UNITS[match[2] or "k"])
+
+
+def read_config(config_file: Path) -> RootsConfig:
+    """
+    Reads a TOML config file of [[root]] tables with a name, a local directory and
+    a remote, plus an optional filter file and list of globs to exclude. Relative
+    paths are relative to the config file. bwlimit, upload_workers and parallel at the top are shared by
+    every root
+    """
+    with open(config_file, "rb") as file:
+        config = tomllib.load(file)
+
+    roots = []
+    for table in config.get("root", []):
+        name = table["name"]
+        if not re.fullmatch(r"[\w-]+", name) or any(root.name == name for root in roots):
+            raise ValueError(f"Root names must be unique letters, digits, _ and -, got {name}")
+        local_dir = (config_file.parent / Path(table["local"]).expanduser()).resolve()
+        if not local_dir.is_dir():
+            raise ValueError(f"Local directory {local_dir} of root {name} doesn't exist")
+        filter_file = (
+            config_file.parent / table["filter"] if "filter" in table else FILTER_FILE
+        )
+        if not filter_file.is_file():
+            raise ValueError(f"Filter file {filter_file} of root {name} doesn't exist")
+        roots.append(
+            Root(
+                name,
+                str(local_dir),
+                table["remote"],
+                filter_file,
+                tuple(table.get("exclude", [])),
+            )
+        )
+    if not roots:
+        raise ValueError(f"No [[root]] tables in {config_file}")
+
+    upload_workers = config.get("upload_workers", 1)
+    parallel = config.get("parallel", len(roots))
+    if upload_workers < 1 or parallel < 1:
+        raise ValueError("upload_workers and parallel must be at least 1")
+    return RootsConfig(
+        roots,
+        parse_bwlimit(config.get("bwlimit", "off")),
+        upload_workers,
+        min(parallel, len(roots)),
+    )
+
+
+def run_roots(config: RootsConfig, run: Callable[[Root, int], None]):
+    """
+    Calls run with each root and its share of the upload workers, on config.parallel
+    threads, or fewer if there aren't enough upload workers for each of them to have one.
+    The upload workers are split evenly between the roots running at once, and the
+    bandwidth between all of their uploads, as each upload worker runs one rclone call
+    at a time and each of those is limited with --bwlimit. An rclone rcd server is
+    limited to one upload's share for all of its uploads, which stays within the budget
+    """
+    parallel = min(config.parallel, config.upload_workers)
+    upload_workers = config.upload_workers // parallel
+    flags: tuple[str, ...] = ()
+    if config.bwlimit:
+        share = max(1, config.bwlimit // (upload_workers * parallel) // 2**10)
+        flags = ("--bwlimit", f"{share}k")
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        runs = [
+            pool.submit(run, root._replace(rclone_flags=root.rclone_flags + flags), upload_workers)
+            for root in config.roots
+        ]
+        for future in runs:
+            future.result()
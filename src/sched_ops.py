@@ -0,0 +1,100 @@
+"""
+Picks which queued files a run syncs, so each run fits a byte and time budget
+and whatever doesn't fit waits in the queue for the next run
+"""
+
+from time import time_ns
+
+from helpers import FileEntry, VariableStorer
+
+# Number of past runs the upload speed is estimated from
+HISTORY_RUNS = 20
+# Bytes per second files are ranked by before any run has synced anything
+DEFAULT_RATE = 2**20
+
+
+def estimate_costs(var_storer: VariableStorer) -> tuple[float, float] | None:
+    """
+    Estimates the seconds each file takes on top of its bytes and the bytes
+    uploaded per second, by fitting seconds = overhead * files + bytes / rate
+    to the latest runs with least squares.
+    Returns None if no run has synced anything yet
+    """
+    history = var_storer.crud.get_run_history(HISTORY_RUNS)
+    if not history:
+        return None
+
+    ff = sum(files * files for files, _, _ in history)
+    fb = sum(files * size for files, size, _ in history)
+    bb = sum(size * size for _, size, _ in history)
+    fs = sum(files * seconds for files, _, seconds in history)
+    bs = sum(size * seconds for _, size, seconds in history)
+
+    det = ff * bb - fb * fb
+    if det > 0:
+        overhead = (fs * bb - bs * fb) / det
+        per_byte = (ff * bs - fb * fs) / det
+        if overhead >= 0 and per_byte > 0:
+            return overhead, 1 / per_byte
+
+    # Too few or too similar runs to tell the two apart,
+    # so count half of the time as overhead and half as uploading
+    files = sum(files for files, _, _ in history)
+    size = sum(size for _, size, _ in history)
+    seconds = sum(seconds for _, _, seconds in history)
+    if size:
+        return seconds / 2 / files, size / max(seconds / 2, 1e-6)
+    return seconds / files, float("inf")
+
+
+def schedule(var_storer: VariableStorer, queue: list[tuple[FileEntry, int]]) -> list[FileEntry]:
+    """
+    Picks the files of the queue to sync this run. Files are ranked by how long
+    they have been waiting divided by their estimated upload time, so small files
+    go first but large files still get their turn as they age, and picked while
+    they fit within var_storer.budget_bytes and var_storer.budget_seconds.
+    The oldest file larger than the whole budget is picked as well,
+    so it isn't stuck in the queue forever.
+    The picked files are returned in rank order, so the files left over once the
+    time budget runs out while syncing are the ones which would have waited anyway
+    """
+    costs = estimate_costs(var_storer)
+    overhead, rate = costs if costs is not None else (1.0, DEFAULT_RATE)
+
+    def cost(file: FileEntry) -> float:
+        return overhead + file.size / rate
+
+    now = time_ns()
+    ranked = sorted(
+        queue,
+        key=lambda item: (now - item[1]) / 1e9 / max(cost(item[0]), 1e-3),
+        reverse=True,
+    )
+
+    def fits(file: FileEntry, total_bytes: int, total_seconds: float) -> bool:
+        if var_storer.budget_bytes and total_bytes + file.size > var_storer.budget_bytes:
+            return False
+        # Without any history the time budget is only enforced while syncing
+        return not (
+            costs is not None
+            and var_storer.budget_seconds
+            and total_seconds + cost(file) > var_storer.budget_seconds
+        )
+
+    # The oldest file which won't ever fit the budget is synced anyway
+    too_large = [item for item in queue if not fits(item[0], 0, 0.0)]
+    oldest = min(too_large, key=lambda item: item[1])[0] if too_large else None
+
+    picked: list[FileEntry] = []
+    total_bytes = 0
+    total_seconds = 0.0
+    for file, _ in ranked:
+        if file is not oldest and not fits(file, total_bytes, total_seconds):
+            continue
+        picked.append(file)
+        total_bytes += file.size
+        total_seconds += cost(file)
+
+    if var_storer.STDOUT and len(picked) < len(queue):
+        print(f"{len(queue)} queued files, syncing {len(picked)} of them this run")
+    return picked
@@ -0,0 +1,140 @@
+"""
+Splits the local directory into shards of about the same size for full_backup.py.
+Each shard is a list of rclone filter rules, and together the shards cover every
+path exactly once, including the paths which only exist on the remote, so syncing
+every shard is the same as syncing the whole directory
+"""
+
+from heapq import heapify, heapreplace
+from os import scandir
+from pathlib import Path
+
+from helpers import VariableStorer, is_excluded
+
+
+class SizeNode:
+    """
+    A directory with the total size of the files below it and its subdirectories by name
+    """
+
+    def __init__(self) -> None:
+        self.size = 0
+        self.children: dict[str, "SizeNode"] = {}
+
+    def add(self, parts: tuple[str, ...], size: int):
+        """
+        Adds size bytes to the directory at parts below this one, and every directory on the way
+        """
+        node = self
+        node.size += size
+        for name in parts:
+            node = node.children.setdefault(name, SizeNode())
+            node.size += size
+
+
+def size_tree_from_db(var_storer: VariableStorer, root: Path) -> SizeNode | None:
+    """
+    Builds the size tree of root from the sizes stored by the last scan.
+    Returns None if no files below root are stored
+    """
+    tree = SizeNode()
+    rows = var_storer.db_conn.execute(
+        """
+        SELECT Files.folder_id, SUM(Times.size)
+        FROM Times
+        JOIN Files USING (file_id)
+        WHERE NOT Times.is_dir
+        GROUP BY Files.folder_id;
+        """
+    ).fetchall()
+
+    for folder_id, size in rows:
+        folder = var_storer.crud.folder_path(folder_id)
+        if folder == root or folder.is_relative_to(root):
+            tree.add(folder.relative_to(root).parts, size)
+
+    return tree if tree.size else None
+
+
+def size_tree_from_scan(var_storer: VariableStorer, root: Path) -> SizeNode:
+    """
+    Builds the size tree of root by walking it, skipping what var_storer.path_filter excludes
+    """
+    tree = SizeNode()
+    stack = [root]
+    while stack:
+        cwd = stack.pop()
+        size = 0
+        try:
+            with scandir(cwd) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if entry.is_symlink() or is_excluded(var_storer, entry.path, is_dir):
+                        continue
+                    if is_dir:
+                        stack.append(Path(entry.path))
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue  # rclone reports the directories it can't read
+        tree.add(cwd.relative_to(root).parts, size)
+
+    return tree
+
+
+def escape_glob(name: str) -> str:
+    """
+    Escapes the characters with a meaning in rclone globs, so name only matches itself
+    """
+    return "".join(f"\\{char}" if char in "\\*?[]{}," else char for char in name)
+
+
+def __split(
+    node: SizeNode, rel_path: str, target: float, units: list[tuple[int, str, list[str]]]
+):
+    """
+    Adds the subtrees of node to units as (bytes, rel_path, split off subdirectories).
+    A directory larger than target is split into each of its subdirectories
+    and the rest of it, which is the files directly in it
+    """
+    if node.size <= target or not node.children:
+        units.append((node.size, rel_path, []))
+        return
+
+    for name, child in node.children.items():
+        __split(child, f"{rel_path}/{escape_glob(name)}", target, units)
+    rest = node.size - sum(child.size for child in node.children.values())
+    units.append((rest, rel_path, sorted(node.children)))
+
+
+def plan_shards(tree: SizeNode, shards: int) -> list[tuple[int, str]]:
+    """
+    Splits the tree into at most shards shards of about the same size.
+    Returns the bytes and the rclone filter rules of each shard, largest first
+    """
+    units: list[tuple[int, str, list[str]]] = []
+    __split(tree, "", tree.size / shards, units)
+
+    # Largest unit first onto the smallest shard
+    bins: list[tuple[int, int, list[tuple[str, list[str]]]]] = [
+        (0, i, []) for i in range(shards)
+    ]
+    heapify(bins)
+    for size, rel_path, split_off in sorted(units, key=lambda unit: unit[0], reverse=True):
+        load, i, shard_units = bins[0]
+        shard_units.append((rel_path, split_off))
+        heapreplace(bins, (load + size, i, shard_units))
+
+    plan = []
+    for load, _, shard_units in sorted(bins, reverse=True):
+        if not shard_units:
+            continue
+        rules = []
+        # Deeper subtrees first, a parent's rules exclude the subdirectories split off from it
+        for rel_path, split_off in sorted(
+            shard_units, key=lambda unit: unit[0].count("/"), reverse=True
+        ):
+            rules.extend(f"- {rel_path}/{escape_glob(name)}/**" for name in split_off)
+            rules.append(f"+ {rel_path}/**")
+        plan.append((load, "\n".join(rules)))
+    return plan
@@ -0,0 +1,140 @@
+"""
+Runs uploads concurrently while adapting how many run at once,
+optionally in several lanes which each run at the same time
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+from time import monotonic
+from typing import Callable, Iterable, Iterator
+
+from helpers import FileEntry, VariableStorer
+
+# A job uploads one or more files, yielding (file, synced) as each one finishes
+UploadJob = Callable[[], Iterable[tuple[FileEntry, bool]]]
+
+
+class UploadPool:
+    """
+    Runs upload jobs on up to max_workers threads. The number allowed to run at once
+    starts at 1 and is adjusted additive increase, multiplicative decrease style:
+    it grows by one while the throughput of the last window of files improves
+    and is halved whenever an upload fails, e.g. because the remote rate limits us.
+    Results are handed back to the calling thread, which is the only one writing them
+    """
+
+    def __init__(self, var_storer: VariableStorer, max_workers: int) -> None:
+        self.var_storer = var_storer
+        self.max_workers = max_workers
+        self.limit = 1
+        self.window_start = monotonic()
+        self.window_files = 0
+        self.window_bytes = 0
+        self.last_throughput = 0.0
+
+    def __set_limit(self, limit: int):
+        limit = max(1, min(self.max_workers, limit))
+        if limit != self.limit and self.var_storer.STDOUT:
+            print(f"Uploading {limit} at a time")
+        self.limit = limit
+        self.window_start = monotonic()
+        self.window_files = 0
+        self.window_bytes = 0
+
+    def __record(self, file: FileEntry, synced: bool):
+        """
+        Adjusts the limit after each finished file
+        """
+        if not synced:
+            self.__set_limit(self.limit // 2)
+            # Compared with the halved limit's throughput, so it grows back from there
+            self.last_throughput = 0.0
+            return
+
+        self.window_files += 1
+        self.window_bytes += max(file.size, 1)
+        if self.window_files < self.limit * 2:
+            return
+
+        throughput = self.window_bytes / max(monotonic() - self.window_start, 1e-6)
+        if throughput > self.last_throughput * 1.05:
+            self.__set_limit(self.limit + 1)
+        elif throughput < self.last_throughput * 0.9:
+            self.__set_limit(self.limit - 1)
+        else:
+            self.__set_limit(self.limit)
+        self.last_throughput = throughput
+
+    def run(self, jobs: Iterable[UploadJob]) -> Iterator[tuple[FileEntry, bool]]:
+        """
+        Runs every job and yields (file, synced) in the order files finish
+        """
+        results: SimpleQueue = SimpleQueue()
+        done = object()
+
+        def worker(job: UploadJob):
+            try:
+                for result in job():
+                    results.put(result)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        pending = iter(jobs)
+        running = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                while running < self.limit:
+                    job = next(pending, None)
+                    if job is None:
+                        break
+                    pool.submit(worker, job)
+                    running += 1
+
+                if not running:
+                    return
+
+                result = results.get()
+                if result is done:
+                    running -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    self.__record(*result)
+                    yield result
+
+
+def run_lanes(
+    var_storer: VariableStorer, lanes: list[tuple[int, Iterable[UploadJob]]]
+) -> Iterator[tuple[FileEntry, bool]]:
+    """
+    Runs the jobs of every lane at once, each lane on its own UploadPool of up to
+    its number of workers, so the uploads of one lane don't wait for another's.
+    Yields (file, synced) in the order files finish, on the calling thread
+    """
+    results: SimpleQueue = SimpleQueue()
+    done = object()
+
+    def run_lane(max_workers: int, jobs: Iterable[UploadJob]):
+        try:
+            for result in UploadPool(var_storer, max_workers).run(jobs):
+                results.put(result)
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    with ThreadPoolExecutor(max_workers=len(lanes)) as pool:
+        for max_workers, jobs in lanes:
+            pool.submit(run_lane, max_workers, jobs)
+
+        running = len(lanes)
+        while running:
+            result = results.get()
+            if result is done:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
@@ -0,0 +1,215 @@
+"""
+Long running daemon which watches the local directory with inotify
+and journals the directories that changed to the database,
+so a run only has to check those instead of scanning the whole tree
+"""
+
+from contextlib import closing
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from errno import ENOSPC
+from os import close, getpid, read, scandir, strerror
+from pathlib import Path
+from select import select
+from signal import SIGTERM, signal
+from sqlite3 import OperationalError
+from struct import calcsize, unpack_from
+from sys import exit as sys_exit
+from time import monotonic
+
+from db_ops import connect_db, get_count_or_setup_db, journal_dirs, start_watch_state
+from helpers import VariableStorer, is_excluded
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = calcsize(EVENT_FORMAT)
+
+# Seconds events are collected before being written to the journal
+DEBOUNCE = 5
+# Seconds between heartbeats when nothing changes
+HEARTBEAT = 30
+
+
+class Watcher:
+    """
+    Keeps an inotify watch on every directory below the root
+    and collects the directories events happen in
+    """
+
+    def __init__(self, var_storer: VariableStorer, root: Path) -> None:
+        self.var_storer = var_storer
+        self.libc = CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+
+        self.watches: dict[int, Path] = {}
+        # Dirty directories, mapped to whether they have to be walked recursively
+        self.dirty: dict[Path, bool] = {}
+        # Set when events were lost and the journal can't be trusted
+        self.overflowed = False
+        # Set when a watch couldn't be added, so the journal never covers the whole tree
+        self.incomplete = False
+        self.db_names = var_storer.db_file.name
+
+        self.add_tree(root)
+
+    def add_tree(self, root: Path):
+        """
+        Adds a watch to root and every directory below it which isn't excluded
+        """
+        stack = [root]
+        while stack:
+            cwd = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, bytes(cwd), WATCH_MASK)
+            if wd < 0:
+                if get_errno() == ENOSPC:
+                    # fs.inotify.max_user_watches reached
+                    self.incomplete = True
+                    return
+                continue  # Directory vanished or isn't readable
+            self.watches[wd] = cwd
+
+            try:
+                with scandir(cwd) as entries:
+                    for entry in entries:
+                        if (
+                            entry.is_dir(follow_symlinks=False)
+                            and not is_excluded(self.var_storer, entry.path, True)
+                        ):
+                            stack.append(Path(entry.path))
+            except OSError:
+                continue
+
+    def handle_events(self, buffer: bytes):
+        """
+        Turns a buffer of raw inotify events into dirty directories
+        """
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = unpack_from(EVENT_FORMAT, buffer, offset)
+            name = buffer[offset + EVENT_SIZE : offset + EVENT_SIZE + length]
+            name = name.rstrip(b"\0").decode("utf-8", "surrogateescape")
+            offset += EVENT_SIZE + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+
+            cwd = self.watches.get(wd)
+            if cwd is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # The parent directory gets its own event for the removal
+                continue
+
+            path = cwd / name
+            if name.startswith(self.db_names) or is_excluded(
+                self.var_storer, str(path), bool(mask & IN_ISDIR)
+            ):
+                # Our own database writes would otherwise keep the journal busy
+                continue
+
+            self.dirty.setdefault(cwd, False)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been created before the new watch was added.
+                # Adding a watch to an already watched directory which was moved
+                # returns its old descriptor, so this also updates the moved paths
+                self.dirty[path] = True
+                self.add_tree(path)
+
+    def flush(self) -> bool:
+        """
+        Writes the dirty directories and a heartbeat to the journal.
+        Returns False and keeps them for the next flush if the database is busy
+        """
+        try:
+            journal_dirs(
+                self.var_storer,
+                self.dirty,
+                full_scan=self.overflowed or self.incomplete,
+            )
+        except OperationalError:
+            self.var_storer.db_conn.rollback()
+            return False
+
+        self.dirty = {}
+        self.overflowed = False
+        return True
+
+
+def watch(STDOUT: bool):
+    """
+    Runs the watch daemon until it's killed
+    """
+    var_storer = VariableStorer(STDOUT, Path())
+    root = var_storer.CWD = Path(var_storer.LOCAL_DIR)
+
+    # Let SIGTERM unwind through the finally block so pending events are written
+    signal(SIGTERM, lambda *_: sys_exit(0))
+
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        get_count_or_setup_db(var_storer)
+        start_watch_state(var_storer, getpid())
+
+        if STDOUT:
+            print(f"Watching {root}")
+        watcher = Watcher(var_storer, root)
+        if STDOUT:
+            print(f"{len(watcher.watches)} directories watched")
+            if watcher.incomplete:
+                print("inotify watch limit reached, every run will do a full scan")
+
+        last_flush = monotonic()
+        try:
+            while True:
+                ready, _, _ = select([watcher.fd], [], [], DEBOUNCE)
+                if ready:
+                    watcher.handle_events(read(watcher.fd, 64 * 1024))
+
+                since_flush = monotonic() - last_flush
+                if (
+                    (watcher.dirty or watcher.overflowed) and since_flush >= DEBOUNCE
+                ) or since_flush >= HEARTBEAT:
+                    if watcher.flush():
+                        last_flush = monotonic()
+                        if STDOUT:
+                            print("Journal flushed")
+
+        finally:
+            watcher.flush()
+            close(watcher.fd)
@@ -0,0 +1,117 @@
+"""
+Runs backups of a test tree the way main() does, with whatever rclone is first
+on PATH, which is bench/fake_rclone/rclone in the tests. Run as a script it does
+one backup, so a test can kill it part way through:
+
+    python tests/backup_run.py TREE TMP DATE [BATCH_SIZE]
+"""
+
+import json
+import sys
+from contextlib import closing
+from pathlib import Path
+from time import time_ns
+
+TESTS_DIR = Path(__file__).resolve().parent
+FAKE_RCLONE_DIR = TESTS_DIR.parent / "bench" / "fake_rclone"
+# full_backup.py
+sys.path.insert(0, str(TESTS_DIR.parent))
+sys.path.insert(0, str(TESTS_DIR.parent / "bench"))
+sys.path.insert(0, str(TESTS_DIR.parent / "src"))
+
+from db_ops import Crud, connect_db, get_count_or_setup_db, write_db_mod_files  # noqa: E402
+from dir_ops import get_modified_files, iter_modified_files  # noqa: E402
+from hash_ops import drop_unchanged_files  # noqa: E402
+from helpers import VariableStorer  # noqa: E402
+from move_ops import find_moves  # noqa: E402
+from rclone_ops import connection_available, sync, sync_pipelined  # noqa: E402
+
+
+def make_var_storer(
+    tree: Path, tmp: Path, date: str = "2026-01-01 00:00", batch_size: int = 0
+) -> VariableStorer:
+    """
+    Creates a VariableStorer backing tree up to the fake remote, with the database
+    and logs in tmp. date tells runs apart like the minute they start in does
+    """
+    var_storer = VariableStorer(False, tree)
+    var_storer.LOCAL_DIR = str(tree)
+    var_storer.REMOTE_DIR = "test:"
+    var_storer.run_log = tmp / "run.log"
+    var_storer.err_log = tmp / "error.log"
+    var_storer.db_file = tmp / "test.db"
+    var_storer.now = date
+    var_storer.batch_size = batch_size
+    return var_storer
+
+
+def backup(var_storer: VariableStorer, moves: bool = False, check_connection: bool = False):
+    """
+    Scans the tree and syncs every modified file, like a run of main() without the
+    lock, budgets or run times. moves is --moves and var_storer.hash_files --hash.
+    With check_connection the remote is checked first, and the files are only
+    queued if it's offline. A new database's first scan is only committed
+    """
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        new_db = get_count_or_setup_db(var_storer)
+        offline = check_connection and not new_db and not connection_available(var_storer)
+        var_storer.crud.track_moves = moves and not new_db
+        get_modified_files(var_storer, var_storer.CWD)
+        if new_db:
+            var_storer.db_conn.commit()
+            return
+
+        if moves:
+            find_moves(var_storer)
+        if var_storer.hash_files:
+            drop_unchanged_files(var_storer)
+
+        var_storer.crud.queue_files(var_storer.mod_times, time_ns())
+        if offline:
+            var_storer.db_conn.commit()
+            return
+        var_storer.mod_times = [file for file, _ in var_storer.crud.get_queue()]
+        write_db_mod_files(var_storer)
+        sync(var_storer)
+        var_storer.db_conn.commit()
+
+
+def backup_pipelined(var_storer: VariableStorer):
+    """
+    Like backup(), on an existing database, but syncs while scanning like --pipeline
+    """
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        changes = iter_modified_files(var_storer, var_storer.CWD, in_order=False)
+        if sync_pipelined(var_storer, changes, time_ns()):
+            var_storer.db_conn.commit()
+
+
+def rclone_calls(calls_file: Path) -> list[list[str]]:
+    """
+    The commands the fake rclone logged to calls_file since the last check, which
+    empties it: the arguments before the options, followed by the files it was given
+    """
+    if not calls_file.exists():
+        return []
+    with open(calls_file, encoding="utf-8") as lines:
+        calls = [json.loads(line) for line in lines]
+    calls_file.unlink()
+
+    commands = []
+    for call in calls:
+        args = call["args"]
+        options = [i for i, arg in enumerate(args) if arg.startswith("-")]
+        command = args[: options[0]] if options else args
+        if "--include" in args:
+            command.append(args[args.index("--include") + 1])
+        commands.append(command + call["files"])
+    return commands
+
+
+if __name__ == "__main__":
+    tree, tmp = Path(sys.argv[1]), Path(sys.argv[2])
+    batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    backup(make_var_storer(tree, tmp, sys.argv[3], batch_size))
@@ -0,0 +1,30 @@
+"""
+Fixtures shared by the tests. The code under test is imported from src
+and rclone is replaced by bench/fake_rclone/rclone
+"""
+
+import os
+
+import pytest
+
+from backup_run import FAKE_RCLONE_DIR
+
+
+@pytest.fixture
+def fake_rclone(monkeypatch):
+    """
+    Puts the fake rclone first on PATH, with no latency, no bandwidth limit and no failures
+    """
+    monkeypatch.setenv("PATH", f"{FAKE_RCLONE_DIR}{os.pathsep}{os.environ['PATH']}")
+    for name, value in (("LATENCY", "0"), ("BANDWIDTH", "0"), ("FAIL_RATE", "0"), ("SEED", "0")):
+        monkeypatch.setenv(f"FAKE_RCLONE_{name}", value)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    Empty directory to back up
+    """
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    return tree
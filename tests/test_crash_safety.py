@@ -0,0 +1,112 @@
+"""
+A run killed while it's syncing leaves a consistent database: the files of every
+batch Crud.flush() wrote are synced everywhere, the others are still logged as not
+synced and queued, and the next run syncs them
+"""
+
+import os
+import sqlite3
+import sys
+from contextlib import closing
+from signal import SIGKILL
+from subprocess import Popen
+from time import monotonic, sleep
+
+from backup_run import TESTS_DIR, backup, make_var_storer
+from db_ops import Crud
+from synth_tree import make_tree
+
+FILES = 600
+KILLED_RUN = "2026-01-01 00:01"
+NEXT_RUN = "2026-01-01 00:02"
+
+
+def __synced(db_file, date: str) -> int:
+    with closing(sqlite3.connect(db_file, timeout=30)) as db_conn:
+        return db_conn.execute(
+            "SELECT COUNT(*) FROM Log WHERE date = ? AND synced = 1", (date,)
+        ).fetchone()[0]
+
+
+def __kill_after_flushes(tree, tmp_path, flushes: int):
+    """
+    Starts a run syncing every file and kills it once flushes batches are written
+    """
+    proc = Popen(
+        [sys.executable, str(TESTS_DIR / "backup_run.py"), str(tree), str(tmp_path), KILLED_RUN, "20"]
+    )
+    deadline = monotonic() + 60
+    try:
+        while __synced(tmp_path / "test.db", KILLED_RUN) < flushes * Crud.BATCH_SIZE:
+            assert proc.poll() is None, "the run finished before it could be killed"
+            assert monotonic() < deadline
+            sleep(0.01)
+    finally:
+        os.kill(proc.pid, SIGKILL)
+        proc.wait()
+
+
+def test_killed_sync_stays_consistent(fake_rclone, monkeypatch, tree, tmp_path):
+    # Every file takes 5 ms to upload, so the run is killed well before it's done
+    monkeypatch.setenv("FAKE_RCLONE_BANDWIDTH", str(1024 * 200))
+    make_tree(tree, FILES, 2, 4, "fixed:1024")
+    backup(make_var_storer(tree, tmp_path))
+
+    for path in tree.rglob("*.dat"):
+        mod_time = path.stat().st_mtime_ns + 3600 * 1_000_000_000
+        os.utime(path, ns=(mod_time, mod_time))
+    __kill_after_flushes(tree, tmp_path, 2)
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        assert db_conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert db_conn.execute("PRAGMA foreign_key_check").fetchall() == []
+
+        log = dict(
+            db_conn.execute(
+                """
+                SELECT p.file_path, l.synced
+                FROM Log AS l
+                JOIN FilePaths AS p ON p.file_id = l.file_id
+                WHERE l.date = ?;
+                """,
+                (KILLED_RUN,),
+            ).fetchall()
+        )
+        state = dict(
+            db_conn.execute(
+                """
+                SELECT p.file_path, s.synced
+                FROM SyncState AS s
+                JOIN FilePaths AS p ON p.file_id = s.file_id;
+                """
+            ).fetchall()
+        )
+        queue = {path for (path,) in db_conn.execute("SELECT file_path FROM Queue")}
+        times = dict(
+            db_conn.execute(
+                """
+                SELECT p.file_path, t.modification_time
+                FROM Times AS t
+                JOIN FilePaths AS p ON p.file_id = t.file_id;
+                """
+            ).fetchall()
+        )
+
+    synced = {path for path, done in log.items() if done}
+    assert len(log) == FILES
+    # Only whole batches were written
+    assert 0 < len(synced) < FILES
+    assert len(synced) % Crud.BATCH_SIZE == 0
+
+    for path, done in log.items():
+        assert state[path] == done
+        assert (path in queue) != done
+        local_time = os.stat(path).st_mtime_ns
+        assert (times[path] == local_time) == done
+
+    backup(make_var_storer(tree, tmp_path, NEXT_RUN, 20))
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        assert db_conn.execute("SELECT COUNT(*) FROM Queue").fetchone()[0] == 0
+        assert db_conn.execute("SELECT COUNT(*) FROM SyncState WHERE synced = 0").fetchone()[0] == 0
+        assert __synced(tmp_path / "test.db", NEXT_RUN) == FILES - len(synced)
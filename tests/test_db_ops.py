@@ -0,0 +1,119 @@
+"""
+Path ids nothing refers to anymore are pruned, while removed files which were
+logged keep their path, and SyncState always matches what the Log says
+"""
+
+import sqlite3
+from contextlib import closing
+
+import db_ops
+from backup_run import backup, make_var_storer
+from db_ops import SYNC_STATE_FROM_LOG, Crud, connect_db, get_count_or_setup_db, get_fails, migrate_db
+from helpers import get_file_entry
+
+
+def test_prune_ids(fake_rclone, tree, tmp_path):
+    (tree / "kept").mkdir()
+    (tree / "kept" / "file.txt").write_bytes(b"kept")
+    (tree / "removed" / "sub").mkdir(parents=True)
+    for name in ("a.txt", "b.txt", "sub/c.txt"):
+        (tree / "removed" / name).write_bytes(b"removed")
+    backup(make_var_storer(tree, tmp_path))
+
+    for name in ("a.txt", "b.txt", "sub/c.txt"):
+        (tree / "removed" / name).unlink()
+    (tree / "removed" / "sub").rmdir()
+    (tree / "removed").rmdir()
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01"))
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        assert db_conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        paths = {path for (path,) in db_conn.execute("SELECT file_path FROM FilePaths")}
+        logged = {
+            path
+            for (path,) in db_conn.execute(
+                "SELECT p.file_path FROM Log AS l JOIN FilePaths AS p ON p.file_id = l.file_id"
+            )
+        }
+        folders = db_conn.execute("SELECT COUNT(*) FROM Folders").fetchone()[0]
+
+    # Only the removed folder was synced, so the files below it have nothing left
+    assert logged == {str(tree / "removed")}
+    assert paths == {str(tree / "kept"), str(tree / "kept" / "file.txt"), str(tree / "removed")}
+    # The folders above the tree, the tree and kept
+    assert folders == len(tree.parts) + 1
+
+
+def __sync_state(db_conn) -> dict[str, tuple]:
+    return {
+        path: tuple(row)
+        for path, *row in db_conn.execute(
+            "SELECT file_path, synced, attempts, last_error FROM SyncState JOIN FilePaths USING (file_id)"
+        )
+    }
+
+
+def __recomputed(db_conn) -> dict[str, tuple]:
+    """
+    SyncState rebuilt from the whole Log, without keeping it
+    """
+    db_conn.execute("DELETE FROM SyncState")
+    db_conn.execute(SYNC_STATE_FROM_LOG.format(where="1"))
+    state = __sync_state(db_conn)
+    db_conn.rollback()
+    return state
+
+
+def test_sync_state_matches_log(fake_rclone, monkeypatch, tree, tmp_path):
+    names = [f"f{i}.txt" for i in range(6)]
+    for name in names:
+        (tree / name).write_text(name)
+    backup(make_var_storer(tree, tmp_path))
+
+    # Each run changes one more file, and fewer of the ones left fail
+    runs = [("*f[0-2]*", names), ("*f[01]*", ["f3.txt"]), ("*f0*", ["f4.txt"])]
+    for minute, (fail_glob, changed) in enumerate(runs, start=1):
+        for name in changed:
+            (tree / name).write_text(f"changed {minute}")
+        monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", fail_glob)
+        backup(make_var_storer(tree, tmp_path, f"2026-01-01 00:0{minute}"))
+        with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+            assert __sync_state(db_conn) == __recomputed(db_conn)
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        state = __sync_state(db_conn)
+        # --retry_fails only reads the pending rows, through their partial index
+        plan = db_conn.execute("EXPLAIN QUERY PLAN SELECT file_id FROM SyncState WHERE synced = 0").fetchall()
+        log = db_conn.execute(
+            "SELECT date, file_path, synced FROM Log JOIN FilePaths USING (file_id)"
+        ).fetchall()
+    assert state[str(tree / "f0.txt")] == (0, 3, "2026-01-01 00:03")
+    assert state[str(tree / "f1.txt")] == (1, 0, None)
+    assert "idx_sync_state_pending" in plan[0][-1]
+
+    var_storer = make_var_storer(tree, tmp_path)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        assert get_fails(var_storer) == [get_file_entry(tree / "f0.txt")]
+
+    # The same Log in a database from before SyncState is backfilled to the same rows
+    var_storer = make_var_storer(tree, tmp_path)
+    var_storer.db_file = tmp_path / "old.db"
+    migrations = getattr(db_ops, "__MIGRATIONS")
+    monkeypatch.setattr(db_ops, "__MIGRATIONS", migrations[:7])
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        get_count_or_setup_db(var_storer)
+        for name in names:
+            var_storer.db_conn.execute(
+                "INSERT INTO Times (parent_path, file_path, modification_time) VALUES (?, ?, 0)",
+                (str(tree), str(tree / name)),
+            )
+        var_storer.db_conn.executemany(
+            "INSERT OR IGNORE INTO Dates (date) VALUES (?)", [(date,) for date, _, _ in log]
+        )
+        var_storer.db_conn.executemany("INSERT INTO Log (date, file_path, synced) VALUES (?, ?, ?)", log)
+        var_storer.db_conn.commit()
+
+        monkeypatch.setattr(db_ops, "__MIGRATIONS", migrations)
+        migrate_db(var_storer)
+        assert __sync_state(var_storer.db_conn) == state
@@ -0,0 +1,162 @@
+"""
+The scans built on diff_ops find the same modified files, and leave the same
+modification times stored, as the per directory comparison they replaced
+"""
+
+import os
+from contextlib import closing
+from pathlib import Path
+from random import Random
+from shutil import rmtree
+
+import pytest
+
+from backup_run import make_var_storer
+from bench_diff import time_diff
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from dir_ops import get_modified_files
+from synth_tree import make_tree
+
+
+class BaselineScan:
+    """
+    __add_or_del_from_db and __check_if_modified of the original dir_ops.py, with
+    the Times table as a dict and os.scandir in place of a stat call per file.
+    Kept as they were, including deleting only the direct children of a removed
+    folder and not comparing empty folders
+    """
+
+    def __init__(self) -> None:
+        # file_path -> (parent_path, modification_time)
+        self.times: dict[Path, tuple[Path, int]] = {}
+        self.mod_times: list[tuple[Path, int]] = []
+
+    def __add_or_del_from_db(self, files, db_files):
+        local_files = {file for file, _ in files}
+        cloud_files = {file for file, _ in db_files}
+
+        for file in local_files.symmetric_difference(cloud_files):
+            if file not in cloud_files:
+                mod_time = next(mod_time for path, mod_time in files if path == file)
+                self.times[file] = (file.parent, mod_time)
+                if not file.is_dir():
+                    self.mod_times.append((file, mod_time))
+            else:
+                mod_time = next(mod_time for path, mod_time in db_files if path == file)
+                for path in [path for path, (parent, _) in self.times.items() if parent == file]:
+                    del self.times[path]
+                del self.times[file]
+                # file.is_file without calling it, so removed folders are included
+                self.mod_times.append((file, mod_time))
+
+    def __check_if_modified(self, files, db_files):
+        for file_data in files:
+            file, _ = file_data
+            if file.is_dir():
+                self.get_modified_files(file)
+            elif file.is_file() and file_data not in db_files and file_data not in self.mod_times:
+                self.mod_times.append(file_data)
+
+    def get_modified_files(self, cwd: Path):
+        with os.scandir(cwd) as entries:
+            files = [
+                (Path(entry.path), entry.stat(follow_symlinks=False).st_mtime_ns)
+                for entry in entries
+                if not entry.name.startswith(".") and not entry.is_symlink()
+            ]
+        if not files:
+            return
+
+        db_files = [
+            (path, mod_time) for path, (parent, mod_time) in self.times.items() if parent == cwd
+        ]
+        if len(files) != len(db_files) or files != db_files:
+            self.__add_or_del_from_db(files, db_files)
+        self.__check_if_modified(files, db_files)
+
+
+def __scan(var_storer) -> list[Path]:
+    """
+    Scans the tree with the current scanner, committing its changes
+    """
+    var_storer.mod_times = []
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        get_modified_files(var_storer, var_storer.CWD)
+        var_storer.db_conn.commit()
+    return sorted(file.path for file in var_storer.mod_times)
+
+
+def __stored_times(var_storer) -> dict[Path, int]:
+    with closing(connect_db(var_storer.db_file)) as db_conn:
+        return {
+            Path(file_path): mod_time
+            for file_path, mod_time in db_conn.execute(
+                """
+                SELECT p.file_path, t.modification_time
+                FROM Times AS t
+                JOIN FilePaths AS p ON p.file_id = t.file_id;
+                """
+            )
+        }
+
+
+def __change_tree(tree: Path, seed: int):
+    """
+    Modifies, deletes and adds files, adds a folder with a subfolder and
+    deletes a folder, without leaving any folder empty
+    """
+    rand = Random(seed)
+    files = sorted(tree.rglob("*.dat"))
+    for path in rand.sample(files, 20):
+        mod_time = path.stat().st_mtime_ns + 3600 * 1_000_000_000
+        os.utime(path, ns=(mod_time, mod_time))
+
+    removed_dir = tree / "dir_1" / "dir_2"
+    rmtree(removed_dir)
+    for path in rand.sample([path for path in files if path.exists()], 20):
+        if len(list(path.parent.iterdir())) > 1:
+            path.unlink()
+
+    dirs = sorted({path.parent for path in tree.rglob("*.dat")})
+    for i in range(20):
+        (rand.choice(dirs) / f"new_{i}.dat").write_bytes(b"new")
+    (tree / "dir_0" / "added" / "sub").mkdir(parents=True)
+    for i in range(3):
+        (tree / "dir_0" / "added" / f"file_{i}.dat").write_bytes(b"added")
+        (tree / "dir_0" / "added" / "sub" / f"file_{i}.dat").write_bytes(b"added")
+
+
+@pytest.mark.parametrize(
+    "scan_workers, merge_scan", [(1, False), (4, False), (1, True)], ids=["serial", "parallel", "merge"]
+)
+def test_same_changes_as_baseline(tree, tmp_path, scan_workers, merge_scan):
+    make_tree(tree, 400, 2, 3, "fixed:1024", seed=1)
+    var_storer = make_var_storer(tree, tmp_path)
+    var_storer.scan_workers = scan_workers
+    var_storer.merge_scan = merge_scan
+    baseline = BaselineScan()
+
+    baseline.get_modified_files(tree)
+    assert __scan(var_storer) == sorted(path for path, _ in baseline.mod_times)
+
+    __change_tree(tree, seed=2)
+    baseline.mod_times = []
+    baseline.get_modified_files(tree)
+    found = __scan(var_storer)
+    assert found == sorted(path for path, _ in baseline.mod_times)
+    assert tree / "dir_1" / "dir_2" in found
+
+    stored = __stored_times(var_storer)
+    assert stored == {
+        path: mod_time for path, (_, mod_time) in baseline.times.items() if path.exists()
+    }
+
+
+def test_diff_scales_linearly():
+    # Cache misses make larger directories a few times slower per file,
+    # a quadratic diff like the one it replaced would be 100 times slower
+    per_file = {size: time_diff(size, 0.1) for size in (1_000, 10_000, 100_000)}
+    assert all(ok for _, ok in per_file.values())
+    assert per_file[100_000][0] < per_file[1_000][0] * 10
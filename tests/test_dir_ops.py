@@ -0,0 +1,121 @@
+"""
+A full scan killed part way through resumes from its checkpoint and ends up
+with the same queue and stored times as a scan which wasn't interrupted
+"""
+
+import sqlite3
+from contextlib import closing
+from time import time_ns
+
+import pytest
+
+import dir_ops
+from backup_run import backup, make_var_storer
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from dir_ops import ScanCheckpoint, get_modified_files
+from synth_tree import churn, make_tree
+
+
+class Killed(Exception):
+    pass
+
+
+def __scan(var_storer) -> tuple[set, set]:
+    """
+    Runs a checkpointed full scan and queues what it found, like main() does.
+    Returns the queued paths and the stored times
+    """
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        var_storer.checkpoint = ScanCheckpoint(var_storer, var_storer.CWD, time_ns())
+        started = var_storer.checkpoint.started
+        get_modified_files(var_storer, var_storer.CWD)
+        var_storer.crud.queue_files(var_storer.mod_times, started)
+        var_storer.db_conn.commit()
+        queue = {file.path for file, _ in var_storer.crud.get_queue()}
+        times = set(
+            var_storer.db_conn.execute(
+                """
+                SELECT p.file_path, t.modification_time, t.size
+                FROM Times AS t JOIN FilePaths AS p USING (file_id);
+                """
+            )
+        )
+    return queue, times
+
+
+def __copy_db(tmp_path, name: str):
+    copy = tmp_path / name
+    copy.mkdir()
+    with closing(sqlite3.connect(tmp_path / "test.db")) as src, closing(
+        sqlite3.connect(copy / "test.db")
+    ) as dst:
+        src.backup(dst)
+    return copy
+
+
+@pytest.mark.parametrize("scan_workers", [1, 4], ids=["serial", "parallel"])
+def test_resumed_scan_finds_the_same(monkeypatch, tree, tmp_path, scan_workers):
+    make_tree(tree, 400, 2, 4, seed=5)
+    backup(make_var_storer(tree, tmp_path))
+    churn(tree, 20, seed=6)
+    uninterrupted = __copy_db(tmp_path, "uninterrupted")
+    killed = __copy_db(tmp_path, "killed")
+
+    var_storer = make_var_storer(tree, uninterrupted, "2026-01-01 00:01")
+    var_storer.scan_workers = scan_workers
+    expected = __scan(var_storer)
+    assert expected[0]
+
+    # Saved after every directory, and killed after the 8th of 21
+    monkeypatch.setattr(dir_ops, "CHECKPOINT_INTERVAL", 0)
+    process_dir = getattr(dir_ops, "__process_dir")
+    processed = []
+    kill_after = 8
+
+    def counted_process_dir(var_storer, cwd, files):
+        processed.append(cwd)
+        if len(processed) > kill_after:
+            raise Killed()
+        return process_dir(var_storer, cwd, files)
+
+    monkeypatch.setattr(dir_ops, "__process_dir", counted_process_dir)
+    var_storer = make_var_storer(tree, killed, "2026-01-01 00:01")
+    var_storer.scan_workers = scan_workers
+    with pytest.raises(Killed):
+        __scan(var_storer)
+
+    processed.clear()
+    kill_after = 21
+    var_storer = make_var_storer(tree, killed, "2026-01-01 00:02")
+    var_storer.scan_workers = scan_workers
+    with closing(sqlite3.connect(killed / "test.db")) as db_conn:
+        assert db_conn.execute("SELECT COUNT(*) FROM ScanDone").fetchone()[0] == 8
+    assert __scan(var_storer) == expected
+    # Only the directories the killed scan didn't finish
+    assert len(processed) == 21 - 8
+
+    with closing(sqlite3.connect(killed / "test.db")) as db_conn:
+        assert db_conn.execute("SELECT COUNT(*) FROM ScanState").fetchone()[0] == 0
+
+
+def test_old_checkpoint_is_discarded(tree, tmp_path):
+    make_tree(tree, 50, 1, 3, seed=7)
+    var_storer = make_var_storer(tree, tmp_path)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        hour_ago = time_ns() - 3600 * 1_000_000_000
+        checkpoint = ScanCheckpoint(var_storer, tree, hour_ago)
+        checkpoint.add(tree / "dir_0", [])
+        checkpoint.save()
+
+        var_storer.checkpoint_age = 2 * 3600
+        assert ScanCheckpoint(var_storer, tree, time_ns()).finished == {tree / "dir_0"}
+
+        var_storer.checkpoint_age = 1800
+        resumed = ScanCheckpoint(var_storer, tree, time_ns())
+        assert resumed.finished == set()
+        assert resumed.started > hour_ago
+        assert var_storer.db_conn.execute("SELECT COUNT(*) FROM ScanState").fetchone()[0] == 0
@@ -0,0 +1,89 @@
+"""
+The scanner excludes what rclone excludes with the same filter file, and
+never lists the directories it excludes
+"""
+
+from contextlib import closing
+
+import dir_ops
+from backup_run import make_var_storer
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from dir_ops import get_modified_files
+from filter_ops import PathFilter
+
+
+def test_filter_file():
+    path_filter = PathFilter.from_file()
+    assert path_filter.excluded("a/node_modules", True)
+    assert path_filter.excluded("a/node_modules/b/c.js", False)
+    # Only the directory is excluded, not every name containing it
+    assert not path_filter.excluded("my_node_modules_notes.txt", False)
+    assert not path_filter.excluded("a/my_node_modules", True)
+    assert path_filter.excluded(".hidden", False)
+    assert path_filter.excluded("a/.git", True)
+
+
+def test_anchored_rules():
+    anchored = PathFilter([(False, "/x")])
+    assert anchored.excluded("x", False)
+    assert not anchored.excluded("a/x", False)
+
+    unanchored = PathFilter([(False, "x")])
+    assert unanchored.excluded("x", False)
+    assert unanchored.excluded("a/x", False)
+    assert not unanchored.excluded("a/xy", False)
+
+
+def test_star_and_double_star():
+    star = PathFilter([(False, "/a/*.txt")])
+    assert star.excluded("a/b.txt", False)
+    assert not star.excluded("a/b/c.txt", False)
+
+    double_star = PathFilter([(False, "/a/**.txt")])
+    assert double_star.excluded("a/b.txt", False)
+    assert double_star.excluded("a/b/c.txt", False)
+
+
+def test_dir_rules_only_match_directories():
+    path_filter = PathFilter([(False, "build/")])
+    assert path_filter.excluded("build", True)
+    assert path_filter.excluded("a/build", True)
+    assert not path_filter.excluded("build", False)
+
+
+def test_first_matching_rule_decides():
+    path_filter = PathFilter([(True, "/keep/**"), (False, "*")])
+    assert not path_filter.excluded("keep/file", False)
+    assert not path_filter.excluded("keep", True)
+    assert path_filter.excluded("other", False)
+
+
+def test_scan_prunes_excluded_dirs(monkeypatch, tree, tmp_path):
+    (tree / "a" / "node_modules" / "pkg").mkdir(parents=True)
+    (tree / "a" / "node_modules" / "pkg" / "index.js").write_text("js")
+    (tree / "a" / "my_node_modules_notes.txt").write_text("notes")
+    (tree / ".cache").mkdir()
+    (tree / ".cache" / "file").write_text("cached")
+    # Left beside the database while it's open, which make_var_storer's filter is made for
+    for suffix in ("", "-wal", "-shm", "-lock"):
+        (tree / f"RCloneBackupScript.db{suffix}").write_text("db")
+    var_storer = make_var_storer(tree, tmp_path)
+
+    listed = []
+
+    def scandir(path):
+        listed.append(path)
+        return real_scandir(path)
+
+    real_scandir = dir_ops.scandir
+    monkeypatch.setattr(dir_ops, "scandir", scandir)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        get_modified_files(var_storer, var_storer.CWD)
+
+    assert sorted(str(path) for path in listed) == [str(tree), str(tree / "a")]
+    assert sorted(file.path.name for file in var_storer.mod_times) == [
+        "RCloneBackupScript.db",
+        "my_node_modules_notes.txt",
+    ]
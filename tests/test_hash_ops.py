@@ -0,0 +1,122 @@
+"""
+With --hash, files whose modification time changed but whose contents didn't
+are dropped without uploading, and only files which could be unchanged are hashed
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+from time import monotonic
+
+import hash_ops
+from backup_run import backup, make_var_storer, rclone_calls
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from hash_ops import CHUNK_SIZE, RateLimiter, drop_unchanged_files
+from helpers import get_file_entry
+
+
+def __hash_var_storer(tree, tmp_path, minute: int, **options):
+    var_storer = make_var_storer(tree, tmp_path, f"2026-01-01 00:0{minute}")
+    var_storer.hash_files = True
+    for name, value in options.items():
+        setattr(var_storer, name, value)
+    return var_storer
+
+
+def __synced_with_hashes(fake_rclone, tree, tmp_path, names):
+    """
+    Backs up a tree twice, so every file's hash is stored. Its contents change
+    but not its size, since files whose size changed aren't hashed
+    """
+    for name in names:
+        (tree / name).write_text(name)
+    backup(__hash_var_storer(tree, tmp_path, 0))
+    for name in names:
+        (tree / name).write_text(name.upper())
+    backup(__hash_var_storer(tree, tmp_path, 1))
+
+
+def __touch(path):
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_touched_file_dropped(fake_rclone, monkeypatch, tree, tmp_path):
+    __synced_with_hashes(fake_rclone, tree, tmp_path, ["touched.txt", "edited.txt"])
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    __touch(tree / "touched.txt")
+    # Same size, other contents
+    (tree / "edited.txt").write_text("edited.TXT")
+    backup(__hash_var_storer(tree, tmp_path, 2))
+
+    assert [call[-1] for call in rclone_calls(calls)] == ["edited.txt"]
+    touched = get_file_entry(tree / "touched.txt")
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        assert db_conn.execute(
+            "SELECT modification_time, inode FROM Times JOIN FilePaths USING (file_id) WHERE file_path = ?",
+            (str(touched.path),),
+        ).fetchone() == (touched.mod_time, touched.inode)
+        assert db_conn.execute(
+            "SELECT file_path FROM Log JOIN FilePaths USING (file_id) WHERE date = '2026-01-01 00:02'"
+        ).fetchall() == [(str(tree / "edited.txt"),)]
+        assert db_conn.execute("SELECT COUNT(*) FROM Queue").fetchone() == (0,)
+
+
+def test_only_same_size_files_hashed(fake_rclone, monkeypatch, tree, tmp_path):
+    __synced_with_hashes(fake_rclone, tree, tmp_path, ["touched.txt", "grown.txt"])
+    hashed = []
+    hash_file = hash_ops.hash_file
+
+    def record(path, limiter):
+        hashed.append(path.name)
+        return hash_file(path, limiter)
+
+    monkeypatch.setattr(hash_ops, "hash_file", record)
+
+    __touch(tree / "touched.txt")
+    (tree / "grown.txt").write_text("GROWN.TXT, now larger")
+    (tree / "new.txt").write_text("new")
+    backup(__hash_var_storer(tree, tmp_path, 2))
+
+    # A new file is hashed once to have a hash to compare with next time
+    assert sorted(hashed) == ["new.txt", "touched.txt"]
+
+
+def test_rate_limiter_shared(fake_rclone, monkeypatch, tree, tmp_path):
+    names = [f"f{i}.txt" for i in range(4)]
+    __synced_with_hashes(fake_rclone, tree, tmp_path, names)
+    for name in names:
+        __touch(tree / name)
+
+    limiters = set()
+    hash_file = hash_ops.hash_file
+
+    def record(path, limiter):
+        limiters.add(limiter)
+        return hash_file(path, limiter)
+
+    monkeypatch.setattr(hash_ops, "hash_file", record)
+    # A file takes a chunk and the empty read after it
+    rate = 32 * CHUNK_SIZE
+    var_storer = __hash_var_storer(tree, tmp_path, 2, hash_rate=rate, hash_workers=4)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        var_storer.mod_times = [get_file_entry(tree / name) for name in names]
+        started = monotonic()
+        drop_unchanged_files(var_storer)
+        elapsed = monotonic() - started
+
+    assert len(limiters) == 1 and var_storer.mod_times == []
+    # The 4 threads share the rate, one limiter each would take a quarter of it
+    assert elapsed >= (2 * len(names) - 1) * CHUNK_SIZE / rate
+
+
+def test_unlimited_rate_doesnt_wait():
+    limiter = RateLimiter(0)
+    started = monotonic()
+    for _ in range(1000):
+        limiter.consume(CHUNK_SIZE)
+    assert monotonic() - started < 0.1
@@ -0,0 +1,106 @@
+"""
+Uploads get timeouts estimated from past runs, doubled for every timeout in a row,
+and files which keep timing out are reported instead of retried every run
+"""
+
+from contextlib import closing
+from itertools import count
+
+import pytest
+
+from backup_run import make_var_storer
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from helpers import FileEntry, get_file_entry
+from lane_ops import LANES, STUCK_TIMEOUTS, TIMEOUT, UploadTimeouts, lane_of, lane_workers
+
+
+@pytest.fixture
+def var_storer(tree, tmp_path):
+    var_storer = make_var_storer(tree, tmp_path)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        yield var_storer
+
+
+__runs = count()
+
+
+def __time_out(var_storer, file: FileEntry, times: int):
+    for _ in range(times):
+        date = f"2026-01-01 00:{next(__runs):02}"
+        var_storer.crud.log_files(date, [file])
+        var_storer.crud.mark_failed(date, file, timed_out=True)
+        var_storer.crud.flush()
+
+
+def test_lanes():
+    assert [lane_of(FileEntry(None, 0, size, 0, False)).name for size in (0, 2**24, 2**24 + 1, 2**30)] == [
+        "small",
+        "small",
+        "medium",
+        "large",
+    ]
+
+
+@pytest.mark.parametrize(
+    "upload_workers, split", [(3, [1, 1, 1]), (5, [3, 1, 1]), (9, [6, 2, 1]), (16, [12, 3, 1])]
+)
+def test_lane_workers(upload_workers, split):
+    assert lane_workers(upload_workers) == split
+
+
+def test_too_few_lane_workers():
+    with pytest.raises(ValueError):
+        lane_workers(len(LANES) - 1)
+
+
+def test_timeout_estimate(var_storer, tree):
+    small = FileEntry(tree / "small", 0, 2**20, 0, False)
+    medium = FileEntry(tree / "medium", 0, 100 * 10**6, 0, False)
+    assert UploadTimeouts(var_storer).timeout(medium) == TIMEOUT
+
+    # Too few runs to fit, so half the time is overhead: a second per file and 1 MB/s
+    var_storer.crud.record_run("2026-01-01 00:00", 10, 10 * 10**6, 20)
+    timeouts = UploadTimeouts(var_storer)
+    assert timeouts.timeout(small) == 60
+    assert timeouts.timeout(medium) == pytest.approx(4 * 101)
+
+    # Concurrent uploads share the bandwidth
+    var_storer.upload_workers = 2
+    assert UploadTimeouts(var_storer).timeout(medium) == pytest.approx(4 * 201)
+
+
+def test_timeout_doubles_per_streak(var_storer, tree):
+    (tree / "file").write_text("file")
+    file = get_file_entry(tree / "file")
+    for streak in range(3):
+        assert UploadTimeouts(var_storer).timeout(file) == TIMEOUT * 2**streak
+        __time_out(var_storer, file, 1)
+
+    # Any other outcome ends the streak
+    date = f"2026-01-01 00:{next(__runs):02}"
+    var_storer.crud.log_files(date, [file])
+    var_storer.crud.mark_synced(date, file)
+    var_storer.crud.flush()
+    assert UploadTimeouts(var_storer).timeout(file) == TIMEOUT
+
+
+def test_stuck_files_reported(var_storer, tree):
+    for name in ("stuck", "attempted", "almost", "deleted"):
+        (tree / name).write_text(name)
+    files = {name: get_file_entry(tree / name) for name in ("stuck", "attempted", "almost", "deleted")}
+    for name in ("stuck", "attempted", "deleted"):
+        __time_out(var_storer, files[name], STUCK_TIMEOUTS)
+    __time_out(var_storer, files["almost"], STUCK_TIMEOUTS - 1)
+    (tree / "deleted").unlink()
+
+    timeouts = UploadTimeouts(var_storer)
+    assert [name for name, file in files.items() if timeouts.is_stuck(file)] == ["stuck", "attempted"]
+    # --retry_fails syncs them anyway
+    timeouts.report(var_storer, {files["attempted"].path})
+
+    assert var_storer.run_log.read_text().splitlines()[-1] == f"# Stuck 1{' ' * 16}#"
+    errors = var_storer.err_log.read_text()
+    assert f"{tree / 'stuck'} (0.0 MB, {STUCK_TIMEOUTS} timeouts)" in errors
+    assert "attempted" not in errors
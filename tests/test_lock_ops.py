@@ -0,0 +1,24 @@
+"""
+Retries and counts handed over to the running process are each taken once
+"""
+
+from backup_run import make_var_storer
+from lock_ops import RunLock
+
+
+def test_requests_taken_once(tree, tmp_path):
+    var_storer = make_var_storer(tree, tmp_path)
+    holder = RunLock(var_storer)
+    assert holder.acquire(False)
+    assert not RunLock(var_storer).acquire(False)
+
+    for mode in ("count", "retry", "count"):
+        RunLock(var_storer).request(mode)
+    assert holder.take_requests() == ["retry", "count"]
+    assert holder.take_requests() == []
+
+    # A request after the holder took them goes to a new file
+    RunLock(var_storer).request("retry")
+    holder.release()
+    assert holder.take_requests() == ["retry"]
+    assert not holder.requests_file.exists()
@@ -0,0 +1,131 @@
+"""
+A run's metrics are recorded in the Metrics table and written to a textfile
+node_exporter can parse
+"""
+
+import re
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+from backup_run import backup, make_var_storer
+from db_ops import connect_db
+from helpers import write_start_end_times
+from metrics_ops import PREFIX, RunMetrics, write_textfile
+from roots_ops import Root
+
+SAMPLE = re.compile(
+    r"(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)"
+    r"(?:\{(?P<labels>[a-zA-Z_][a-zA-Z0-9_]*=\"[^\"\n]*\"(?:,[a-zA-Z_][a-zA-Z0-9_]*=\"[^\"\n]*\")*)\})?"
+    r" (?P<value>[-+]?(?:\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|Inf|NaN))"
+)
+
+
+def __parse(text: str) -> dict[tuple[str, str], float]:
+    """
+    Parses the Prometheus text format, checking every sample is described
+    once by a HELP and a TYPE line before it
+    """
+    assert text.endswith("\n")
+    kinds: dict[str, str] = {}
+    helped = set()
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name = line.split()[2]
+            assert name not in helped
+            helped.add(name)
+        elif line.startswith("# TYPE "):
+            _, _, name, kind = line.split()
+            assert name in helped and name not in kinds
+            assert kind in ("counter", "gauge", "histogram", "summary", "untyped")
+            kinds[name] = kind
+        else:
+            match = SAMPLE.fullmatch(line)
+            assert match, line
+            name = match["name"]
+            base = re.sub(r"_(bucket|sum|count)$", "", name) if name not in kinds else name
+            assert base in kinds, name
+            if kinds[base] != "histogram":
+                assert name == base
+            samples[(name, match["labels"] or "")] = float(match["value"])
+    return samples
+
+
+def test_textfile_format(tmp_path):
+    var_storer = make_var_storer(tmp_path, tmp_path)
+    var_storer.metrics_file = tmp_path / "backup.prom"
+    var_storer.root = Root("photos", str(tmp_path), "p:", tmp_path, ())
+    metrics = RunMetrics()
+    metrics.add("files_uploaded", 3)
+    metrics.set("scan_seconds", 1.5)
+    metrics.failure(1)
+    metrics.failure("timeout")
+    for seconds in (0.05, 0.3, 0.3, 400):
+        metrics.observe_upload(seconds)
+
+    write_textfile(var_storer, metrics.rows())
+    samples = __parse(var_storer.metrics_file.read_text())
+    assert list(tmp_path.glob(".*.tmp")) == []
+
+    root = 'root="photos"'
+    assert samples[(f"{PREFIX}_files_uploaded", root)] == 3
+    assert samples[(f"{PREFIX}_scan_seconds", root)] == 1.5
+    assert samples[(f"{PREFIX}_rclone_failures", f'{root},code="1"')] == 1
+    assert samples[(f"{PREFIX}_rclone_failures", f'{root},code="timeout"')] == 1
+    assert (f"{PREFIX}_last_run_timestamp_seconds", root) in samples
+
+    buckets = [
+        value for (name, labels), value in samples.items() if name == f"{PREFIX}_upload_seconds_bucket"
+    ]
+    # Cumulative, ending with +Inf, which is the count
+    assert buckets == sorted(buckets) and buckets[0] == 1 and buckets[2] == 3
+    assert samples[(f"{PREFIX}_upload_seconds_bucket", f'{root},le="+Inf"')] == 4
+    assert samples[(f"{PREFIX}_upload_seconds_count", root)] == 4
+    assert samples[(f"{PREFIX}_upload_seconds_sum", root)] == 400.65
+
+
+def test_run_metrics_recorded(fake_rclone, monkeypatch, tree, tmp_path):
+    names = [f"f{i}.txt" for i in range(5)] + ["bad.txt"]
+    for name in names:
+        (tree / name).write_text(name)
+    backup(make_var_storer(tree, tmp_path))
+    for name in names:
+        (tree / name).write_text(f"changed {name}")
+
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "bad.txt")
+    var_storer = make_var_storer(tree, tmp_path, "2026-01-01 00:01")
+    var_storer.metrics_file = tmp_path / "backup.prom"
+    backup(var_storer)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        write_start_end_times(var_storer, datetime.now(), start_time=var_storer.start_time)
+        var_storer.db_conn.commit()
+
+    with closing(sqlite3.connect(var_storer.db_file)) as db_conn:
+        recorded = {
+            (name, labels): value
+            for name, labels, value in db_conn.execute(
+                "SELECT name, labels, value FROM Metrics WHERE date = '2026-01-01 00:01'"
+            )
+        }
+        files_synced, bytes_synced = db_conn.execute(
+            "SELECT files_synced, bytes_synced FROM Runs WHERE date = '2026-01-01 00:01'"
+        ).fetchone()
+
+    assert recorded[("files_uploaded", "")] == files_synced == 5
+    assert recorded[("bytes_uploaded", "")] == bytes_synced == sum(
+        (tree / name).stat().st_size for name in names if name != "bad.txt"
+    )
+    assert recorded[("files_failed", "")] == 1
+    assert recorded[("files_modified", "")] == 6
+    assert recorded[("rclone_failures", 'code="1"')] == 1
+    assert recorded[("upload_seconds_count", "")] == 5
+    assert recorded[("run_seconds", "")] > 0
+
+    # The textfile holds the same, and when the run finished
+    samples = __parse(var_storer.metrics_file.read_text())
+    written = {(name.removeprefix(f"{PREFIX}_"), labels): value for (name, labels), value in samples.items()}
+    assert written == {
+        **recorded,
+        ("last_run_timestamp_seconds", ""): samples[(f"{PREFIX}_last_run_timestamp_seconds", "")],
+    }
@@ -0,0 +1,178 @@
+"""
+Files and folders renamed locally are moved on the remote instead of being
+deleted and uploaded again, and nothing else is taken for a move
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from time import time_ns
+
+from backup_run import backup, make_var_storer, rclone_calls
+from db_ops import Crud, connect_db, get_count_or_setup_db, write_db_mod_files
+from diff_ops import pair_moves
+from dir_ops import get_modified_files
+from helpers import FileEntry
+from move_ops import find_moves
+from rclone_ops import MOVE_ATTEMPTS, sync
+
+
+def __entry(path: str, inode: int, size: int = 10, mod_time: int = 1, is_dir: bool = False):
+    return FileEntry(Path(path), mod_time, size, inode, is_dir)
+
+
+def __rows(db_file: Path, query: str) -> set:
+    with closing(sqlite3.connect(db_file)) as db_conn:
+        return set(db_conn.execute(query).fetchall())
+
+
+def test_pairs_renamed_file():
+    old, new = __entry("/t/a", 5), __entry("/t/b", 5)
+    assert pair_moves([old], [new]) == [(old, new)]
+
+
+def test_reused_inode_isnt_paired():
+    old = __entry("/t/a", 5)
+    assert pair_moves([old], [__entry("/t/b", 5, size=11)]) == []
+    assert pair_moves([old], [__entry("/t/b", 5, mod_time=2)]) == []
+    # Hard links of the same file can't be told apart
+    assert pair_moves([old], [__entry("/t/b", 5), __entry("/t/c", 5)]) == []
+
+
+def test_moved_dir_covers_its_contents():
+    old_dir, new_dir = __entry("/t/d", 7, is_dir=True), __entry("/t/e", 7, size=0, is_dir=True)
+    removed = [old_dir, __entry("/t/d/f", 8)]
+    added = [new_dir, __entry("/t/e/f", 8)]
+    assert pair_moves(removed, added) == [(old_dir, new_dir)]
+
+
+def test_file_rename_is_moved(fake_rclone, monkeypatch, tree, tmp_path):
+    (tree / "a.txt").write_text("a")
+    (tree / "other.txt").write_text("other")
+    backup(make_var_storer(tree, tmp_path))
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    (tree / "a.txt").rename(tree / "b.txt")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01"), moves=True)
+
+    assert rclone_calls(calls) == [["moveto", "test:a.txt", "test:b.txt"]]
+    assert __rows(tmp_path / "test.db", "SELECT file_path FROM FilePaths JOIN Times USING (file_id)") == {
+        (str(tree / "b.txt"),),
+        (str(tree / "other.txt"),),
+    }
+
+
+def test_dir_rename_moves_subtree(fake_rclone, monkeypatch, tree, tmp_path):
+    (tree / "d" / "sub").mkdir(parents=True)
+    for path in ("d/x.txt", "d/sub/y.txt", "d/bad.txt"):
+        (tree / path).write_text(path)
+    backup(make_var_storer(tree, tmp_path))
+    # Left waiting to be retried from the old folder
+    (tree / "d" / "bad.txt").write_text("changed")
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "*bad*")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01"))
+    monkeypatch.delenv("FAKE_RCLONE_FAIL_GLOB")
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    (tree / "d").rename(tree / "e")
+    var_storer = make_var_storer(tree, tmp_path, "2026-01-01 00:02")
+    db_file = tmp_path / "test.db"
+    times = "SELECT file_path FROM FilePaths JOIN Times USING (file_id)"
+    with closing(connect_db(db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        var_storer.crud.track_moves = True
+        get_modified_files(var_storer, var_storer.CWD)
+        find_moves(var_storer)
+        # The scan and the move are one transaction, nothing of which is written yet
+        assert (str(tree / "d" / "sub" / "y.txt"),) in __rows(db_file, times)
+        assert __rows(db_file, "SELECT old_path FROM Moves") == set()
+        var_storer.crud.queue_files(var_storer.mod_times, time_ns())
+        var_storer.db_conn.commit()
+
+        assert __rows(db_file, "SELECT old_path, new_path, is_dir FROM Moves") == {
+            (str(tree / "d"), str(tree / "e"), 1)
+        }
+        assert {path for (path,) in __rows(db_file, times)} == {
+            str(tree / "e"),
+            str(tree / "e" / "sub"),
+            str(tree / "e" / "x.txt"),
+            str(tree / "e" / "sub" / "y.txt"),
+            str(tree / "e" / "bad.txt"),
+        }
+        # The retry now waits at the new path
+        pending = """
+            SELECT p.file_path FROM SyncState AS s JOIN FilePaths AS p USING (file_id)
+            WHERE s.synced = 0
+        """
+        assert __rows(db_file, pending) == {(str(tree / "e" / "bad.txt"),)}
+        assert __rows(db_file, "SELECT file_path FROM Queue") == {(str(tree / "e" / "bad.txt"),)}
+
+        var_storer.mod_times = [file for file, _ in var_storer.crud.get_queue()]
+        write_db_mod_files(var_storer)
+        sync(var_storer)
+        var_storer.db_conn.commit()
+
+    assert rclone_calls(calls) == [
+        ["moveto", "test:d", "test:e"],
+        ["sync", str(tree), "test:", "e/bad.txt"],
+    ]
+    assert __rows(db_file, pending) == set()
+    assert ("d",) not in __rows(db_file, "SELECT name FROM Folders")
+
+
+def test_hash_mismatch_isnt_moved(fake_rclone, monkeypatch, tree, tmp_path):
+    (tree / "a.txt").write_text("aaaa")
+    var_storer = make_var_storer(tree, tmp_path)
+    var_storer.hash_files = True
+    backup(var_storer)
+    # Uploaded once, which stores its hash
+    os.utime(tree / "a.txt", ns=(1, 1))
+    var_storer = make_var_storer(tree, tmp_path, "2026-01-01 00:01")
+    var_storer.hash_files = True
+    backup(var_storer)
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    # Same inode, size and modification time, but other contents
+    (tree / "a.txt").write_text("bbbb")
+    os.utime(tree / "a.txt", ns=(1, 1))
+    (tree / "a.txt").rename(tree / "b.txt")
+    var_storer = make_var_storer(tree, tmp_path, "2026-01-01 00:02")
+    var_storer.hash_files = True
+    backup(var_storer, moves=True)
+
+    assert sorted(rclone_calls(calls)) == [
+        ["delete", "test:", "a.txt"],
+        ["sync", str(tree), "test:", "b.txt"],
+    ]
+
+
+def test_failed_move_falls_back_to_upload(fake_rclone, monkeypatch, tree, tmp_path):
+    (tree / "a.txt").write_text("a")
+    backup(make_var_storer(tree, tmp_path))
+    (tree / "a.txt").rename(tree / "b.txt")
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "a.txt")
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    for run in range(MOVE_ATTEMPTS):
+        backup(make_var_storer(tree, tmp_path, f"2026-01-01 00:0{run + 1}"), moves=True)
+        assert rclone_calls(calls) == [["moveto", "test:a.txt", "test:b.txt"]]
+    db_file = tmp_path / "test.db"
+    assert __rows(db_file, "SELECT file_path FROM Queue") == {
+        (str(tree / "a.txt"),),
+        (str(tree / "b.txt"),),
+    }
+
+    monkeypatch.delenv("FAKE_RCLONE_FAIL_GLOB")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:09"), moves=True)
+    assert sorted(rclone_calls(calls)) == [
+        ["delete", "test:", "a.txt"],
+        ["sync", str(tree), "test:", "b.txt"],
+    ]
+    assert __rows(db_file, "SELECT * FROM Moves") == set()
+    assert __rows(db_file, "SELECT * FROM Queue") == set()
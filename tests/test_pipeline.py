@@ -0,0 +1,63 @@
+"""
+A pipelined run leaves the same run log and database as a phased run of the same changes
+"""
+
+import sqlite3
+from contextlib import closing
+from shutil import rmtree
+
+from backup_run import backup, backup_pipelined, make_var_storer
+from synth_tree import churn, make_tree
+
+RUN = "2026-01-01 00:01"
+
+
+def __state(tmp) -> dict[str, list[tuple]]:
+    """
+    The rows a run writes, by table, with paths in place of ids
+    """
+    with closing(sqlite3.connect(tmp / "test.db")) as db_conn:
+        return {
+            table: sorted(db_conn.execute(query).fetchall())
+            for table, query in {
+                "Log": """
+                    SELECT l.date, p.file_path, l.synced
+                    FROM Log AS l JOIN FilePaths AS p ON p.file_id = l.file_id;
+                    """,
+                "SyncState": """
+                    SELECT p.file_path, s.synced, s.attempts, s.last_error
+                    FROM SyncState AS s JOIN FilePaths AS p ON p.file_id = s.file_id;
+                    """,
+                "Queue": "SELECT file_path, modification_time, size, inode, is_dir FROM Queue;",
+                "Times": """
+                    SELECT p.file_path, t.modification_time, t.size, t.inode, t.is_dir
+                    FROM Times AS t JOIN FilePaths AS p ON p.file_id = t.file_id;
+                    """,
+            }.items()
+        }
+
+
+def test_same_as_phased(fake_rclone, monkeypatch, tree, tmp_path):
+    make_tree(tree, 300, 2, 3, "fixed:1024", seed=3)
+    for i in range(5):
+        (tree / "dir_0" / f"bad_{i}.dat").write_bytes(b"bad")
+    phased, pipelined = tmp_path / "phased", tmp_path / "pipelined"
+    for tmp in (phased, pipelined):
+        tmp.mkdir()
+        backup(make_var_storer(tree, tmp))
+
+    churn(tree, 30, seed=4)
+    rmtree(tree / "dir_1" / "dir_0")
+    for i in range(5):
+        (tree / "dir_0" / f"bad_{i}.dat").write_bytes(b"changed")
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "*bad_*")
+
+    for tmp, run in ((phased, backup), (pipelined, backup_pipelined)):
+        var_storer = make_var_storer(tree, tmp, RUN)
+        var_storer.upload_workers = 4
+        var_storer.scan_workers = 4
+        run(var_storer)
+
+    assert (pipelined / "run.log").read_text() == (phased / "run.log").read_text()
+    assert "Fails 5" in (phased / "run.log").read_text()
+    assert __state(pipelined) == __state(phased)
@@ -0,0 +1,89 @@
+"""
+The rcd backend against a real rclone with a local directory as the remote,
+skipped where rclone isn't installed
+"""
+
+from pathlib import Path
+from shutil import which
+from time import monotonic, sleep
+
+import pytest
+
+from backup_run import make_var_storer
+from helpers import get_file_entry
+from rcd_ops import RcdBackend, RcdError
+
+pytestmark = pytest.mark.skipif(which("rclone") is None, reason="needs rclone")
+
+
+@pytest.fixture
+def remote(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    return remote
+
+
+@pytest.fixture
+def backend(tree, tmp_path, remote):
+    var_storer = make_var_storer(tree, tmp_path)
+    var_storer.REMOTE_DIR = str(remote)
+    with RcdBackend(var_storer, 30) as backend:
+        yield backend
+
+
+def test_copy_move_and_list(tree, remote, backend):
+    (tree / "dir").mkdir()
+    (tree / "dir" / "file.txt").write_text("contents")
+    backend.sync_file(get_file_entry(tree / "dir" / "file.txt"))
+    assert (remote / "dir" / "file.txt").read_text() == "contents"
+
+    backend.move("dir/file.txt", "dir/moved.txt", False)
+    assert [entry["Name"] for entry in backend.list("dir")] == ["moved.txt"]
+    assert [entry["Name"] for entry in backend.list(dirs_only=True)] == ["dir"]
+
+
+def test_deletions(tree, remote, backend):
+    (remote / "gone.txt").write_text("old")
+    (remote / "gone_dir" / "sub").mkdir(parents=True)
+    (remote / "gone_dir" / "sub" / "file.txt").write_text("old")
+
+    backend.sync_file(get_file_entry(tree / "gone.txt"))
+    backend.sync_file(get_file_entry(tree / "gone_dir")._replace(is_dir=True))
+    assert list(remote.iterdir()) == []
+
+    # Not on the remote either, which rc answers with 404
+    backend.sync_file(get_file_entry(tree / "never_synced.txt"))
+    with pytest.raises(RcdError) as e:
+        backend.move("missing.txt", "elsewhere.txt", False)
+    assert e.value.status == 404
+
+
+def test_reconnects_after_a_failed_call(backend):
+    backend.call("rc/noop", {})
+    backend.connections.conn.sock.close()
+    with pytest.raises(OSError):
+        backend.call("rc/noop", {})
+    assert backend.call("rc/noop", {"answer": 42}) == {"answer": 42}
+    assert len(backend.all_connections) == 1
+
+
+def test_timed_out_copy_is_stopped(tree, tmp_path, remote):
+    var_storer = make_var_storer(tree, tmp_path)
+    var_storer.REMOTE_DIR = str(remote)
+    var_storer.rclone_flags = ["--bwlimit", "10k"]
+    (tree / "large.bin").write_bytes(b"x" * 2**20)
+
+    with RcdBackend(var_storer, 30) as backend:
+        with pytest.raises(TimeoutError):
+            backend.sync_file(get_file_entry(tree / "large.bin"), 0.5)
+        job_ids = backend.call("job/list", {})["jobids"]
+        deadline = monotonic() + 10
+        while not all(backend.call("job/status", {"jobid": job})["finished"] for job in job_ids):
+            assert monotonic() < deadline
+            sleep(0.05)
+        assert not (remote / "large.bin").exists()
+        socket_dir = backend.socket_dir
+
+    assert backend.all_connections == []
+    assert backend.proc.poll() is not None
+    assert not Path(socket_dir).exists()
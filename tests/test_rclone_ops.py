@@ -0,0 +1,198 @@
+"""
+Batched rclone copy calls report each file of the batch from rclone's JSON log,
+deleted files are deleted with as few calls as possible, and runs which can't
+reach the remote queue their files and back off checking it
+"""
+
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from backup_run import backup, make_var_storer, rclone_calls
+import rclone_ops
+from db_ops import Crud, connect_db, get_connectivity, get_count_or_setup_db
+from helpers import get_file_entry
+from lane_ops import UploadTimeouts
+from rclone_ops import __sync_batch, in_backoff, record_connection
+
+
+@pytest.fixture
+def var_storer(fake_rclone, tree, tmp_path):
+    var_storer = make_var_storer(tree, tmp_path, batch_size=10)
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        var_storer.upload_timeouts = UploadTimeouts(var_storer)
+        yield var_storer
+
+
+def __files(tree, *names):
+    for name in names:
+        (tree / name).write_bytes(name.encode())
+    return [get_file_entry(tree / name) for name in names]
+
+
+def __sync(var_storer, batch) -> dict[str, bool]:
+    results = [(file.path.name, synced) for file, synced in __sync_batch(var_storer, batch)]
+    # Every file is reported exactly once
+    assert sorted(name for name, _ in results) == sorted(file.path.name for file in batch)
+    return dict(results)
+
+
+def test_copied(var_storer, tree):
+    batch = __files(tree, "a.txt", "b.txt", "c.txt")
+    assert __sync(var_storer, batch) == {"a.txt": True, "b.txt": True, "c.txt": True}
+    assert not var_storer.err_log.exists()
+
+
+def test_partial_failure(var_storer, tree, monkeypatch):
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "bad_*")
+    batch = __files(tree, "good_1.txt", "bad_1.txt", "good_2.txt", "bad_2.txt")
+    assert __sync(var_storer, batch) == {
+        "good_1.txt": True,
+        "bad_1.txt": False,
+        "good_2.txt": True,
+        "bad_2.txt": False,
+    }
+    errors = var_storer.err_log.read_text(encoding="utf-8")
+    assert "bad_1.txt: Failed to copy" in errors
+    assert "exited with 1" in errors
+
+
+def test_up_to_date(var_storer, tree, monkeypatch):
+    monkeypatch.setenv("FAKE_RCLONE_UNCHANGED_GLOB", "same_*")
+    batch = __files(tree, "same_1.txt", "new.txt", "same_2.txt")
+    # rclone doesn't log files it skips, so they synced if it succeeded
+    assert __sync(var_storer, batch) == {"same_1.txt": True, "new.txt": True, "same_2.txt": True}
+
+
+def test_up_to_date_with_failure(var_storer, tree, monkeypatch):
+    monkeypatch.setenv("FAKE_RCLONE_UNCHANGED_GLOB", "same_*")
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "bad_*")
+    batch = __files(tree, "same_1.txt", "bad_1.txt", "new.txt")
+    # Without a log line or success of the whole call a file can't be told apart from one
+    # rclone gave up on, so it's retried
+    assert __sync(var_storer, batch) == {"same_1.txt": False, "bad_1.txt": False, "new.txt": True}
+
+
+def test_sync_records_results(fake_rclone, monkeypatch, tree, tmp_path):
+    (tree / "sub").mkdir()
+    names = [f"file_{i}.txt" for i in range(25)] + ["sub/bad.txt", "bad.txt"]
+    __files(tree, *names)
+    backup(make_var_storer(tree, tmp_path))
+
+    for name in names:
+        (tree / name).write_bytes(b"changed")
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "*bad.txt")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01", batch_size=10))
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        state = dict(
+            db_conn.execute(
+                """
+                SELECT p.file_path, s.synced
+                FROM SyncState AS s
+                JOIN FilePaths AS p ON p.file_id = s.file_id;
+                """
+            )
+        )
+        queue = {path for (path,) in db_conn.execute("SELECT file_path FROM Queue")}
+
+    for name in names:
+        path = str(tree / name)
+        assert state[path] == (not name.endswith("bad.txt"))
+        assert (path in queue) == name.endswith("bad.txt")
+
+
+def test_deletions_collapsed(fake_rclone, monkeypatch, tree, tmp_path):
+    for path in ("d/sub/x.txt", "d/sub/y.txt", "d/z.txt", "gone/w.txt", "e/keep.txt"):
+        (tree / path).parent.mkdir(parents=True, exist_ok=True)
+        (tree / path).write_text(path)
+    (tree / "loose.txt").write_text("loose")
+    (tree / "e" / "loose.txt").write_text("loose")
+    backup(make_var_storer(tree, tmp_path))
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+    # Already deleted from the remote
+    monkeypatch.setenv("FAKE_RCLONE_GONE_GLOB", "gone")
+
+    for path in ("d/sub/x.txt", "d/sub/y.txt", "d/z.txt", "gone/w.txt", "loose.txt", "e/loose.txt"):
+        (tree / path).unlink()
+    for path in ("d/sub", "d", "gone"):
+        (tree / path).rmdir()
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01"))
+
+    assert sorted(rclone_calls(calls)) == [
+        ["delete", "test:", "e/loose.txt", "loose.txt"],
+        ["purge", "test:d"],
+        ["purge", "test:gone"],
+    ]
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        # The files within a deleted folder are covered by the folder's row
+        assert db_conn.execute(
+            "SELECT file_path, synced FROM FilePaths JOIN SyncState USING (file_id) ORDER BY file_path"
+        ).fetchall() == [
+            (str(tree / path), 1) for path in ("d", "e/loose.txt", "gone", "loose.txt")
+        ]
+        assert db_conn.execute(
+            "SELECT file_path FROM FilePaths JOIN Times USING (file_id) ORDER BY file_path"
+        ).fetchall() == [(str(tree / "e"),), (str(tree / "e" / "keep.txt"),)]
+        folders = {name for (name,) in db_conn.execute("SELECT name FROM Folders")}
+        assert not folders & {"d", "sub", "gone"}
+
+
+def __queue(db_file) -> set[str]:
+    with closing(sqlite3.connect(db_file)) as db_conn:
+        return {path for (path,) in db_conn.execute("SELECT file_path FROM Queue")}
+
+
+def test_offline_runs_queue_files(fake_rclone, monkeypatch, tree, tmp_path):
+    (a, b), db_file = __files(tree, "a.txt", "b.txt"), tmp_path / "test.db"
+    backup(make_var_storer(tree, tmp_path))
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+    monkeypatch.setenv("FAKE_RCLONE_OFFLINE", "1")
+
+    a.path.write_text("changed")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:01"), check_connection=True)
+    assert rclone_calls(calls) == [["lsd", "test:"]]
+    assert __queue(db_file) == {str(a.path)}
+
+    # The check is skipped while backing off, but the scan still queues
+    b.path.write_text("changed")
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:02"), check_connection=True)
+    assert rclone_calls(calls) == []
+    assert __queue(db_file) == {str(a.path), str(b.path)}
+    assert (tmp_path / "run.log").read_text().splitlines()[-2:] == [
+        "# Remote Connect Failed  #",
+        "# Connect Check Skipped  #",
+    ]
+
+    # Back online after the backoff, everything queued is uploaded
+    monkeypatch.delenv("FAKE_RCLONE_OFFLINE")
+    with closing(connect_db(db_file)) as db_conn:
+        db_conn.execute("UPDATE Connectivity SET retry_after = 0")
+        db_conn.commit()
+    backup(make_var_storer(tree, tmp_path, "2026-01-01 00:03"), check_connection=True)
+    assert sorted(call for call in rclone_calls(calls) if call[0] != "lsd") == [
+        ["sync", str(tree), "test:", "a.txt"],
+        ["sync", str(tree), "test:", "b.txt"],
+    ]
+    assert __queue(db_file) == set()
+    with closing(connect_db(db_file)) as db_conn:
+        assert db_conn.execute("SELECT failures, retry_after FROM Connectivity").fetchone() == (0, 0)
+
+
+def test_offline_backoff_doubles(var_storer, monkeypatch):
+    monkeypatch.setattr(rclone_ops, "time_ns", lambda: 0)
+    backoffs = []
+    for _ in range(7):
+        record_connection(var_storer, False)
+        backoffs.append(get_connectivity(var_storer)[1] // 1_000_000_000)
+    assert backoffs == [900, 1800, 3600, 7200, 14400, 21600, 21600]
+    assert in_backoff(var_storer)
+
+    record_connection(var_storer, True)
+    assert get_connectivity(var_storer) == (0, 0)
+    assert not in_backoff(var_storer)
@@ -0,0 +1,181 @@
+"""
+A config file's roots each back up with their own filter, database and logs,
+sharing the upload workers and bandwidth
+"""
+
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from backup_run import backup
+from filter_ops import FILTER_FILE
+from helpers import VariableStorer
+from roots_ops import Root, RootsConfig, parse_bwlimit, read_config, run_roots
+
+
+@pytest.mark.parametrize(
+    "bwlimit, rate",
+    [
+        ("off", 0),
+        (512, 512 * 2**10),
+        ("512", 512 * 2**10),
+        ("100b", 100),
+        ("1.5k", 1536),
+        (" 10M ", 10 * 2**20),
+        ("2G", 2 * 2**30),
+    ],
+)
+def test_parse_bwlimit(bwlimit, rate):
+    assert parse_bwlimit(bwlimit) == rate
+
+
+@pytest.mark.parametrize("bwlimit", ["10x", "-1", "10MB", ""])
+def test_parse_bwlimit_invalid(bwlimit):
+    with pytest.raises(ValueError):
+        parse_bwlimit(bwlimit)
+
+
+def __config(tmp_path, text: str) -> Path:
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir(exist_ok=True)
+    config_file = tmp_path / "roots.toml"
+    config_file.write_text(text)
+    return config_file
+
+
+def test_read_config(tmp_path):
+    (tmp_path / "b.filter").write_text("- *.tmp\n")
+    config = read_config(
+        __config(
+            tmp_path,
+            """
+            bwlimit = "8M"
+            upload_workers = 6
+            parallel = 3
+
+            [[root]]
+            name = "a"
+            local = "a"
+            remote = "remote_a:"
+
+            [[root]]
+            name = "b-2"
+            local = "b"
+            remote = "remote_b:backup"
+            filter = "b.filter"
+            exclude = ["*.log"]
+            """,
+        )
+    )
+    assert config == RootsConfig(
+        [
+            Root("a", str(tmp_path / "a"), "remote_a:", FILTER_FILE, ()),
+            Root("b-2", str(tmp_path / "b"), "remote_b:backup", tmp_path / "b.filter", ("*.log",)),
+        ],
+        8 * 2**20,
+        6,
+        2,
+    )
+
+
+@pytest.mark.parametrize(
+    "text, error",
+    [
+        ("", "No \\[\\[root\\]\\] tables"),
+        ('[[root]]\nname = "a"\nlocal = "a"\nremote = "r:"\n' * 2, "unique"),
+        ('[[root]]\nname = "a b"\nlocal = "a"\nremote = "r:"\n', "unique"),
+        ('[[root]]\nname = "c"\nlocal = "c"\nremote = "r:"\n', "Local directory"),
+        ('[[root]]\nname = "a"\nlocal = "a"\nremote = "r:"\nfilter = "missing.txt"\n', "Filter file"),
+        ('upload_workers = 0\n[[root]]\nname = "a"\nlocal = "a"\nremote = "r:"\n', "at least 1"),
+    ],
+)
+def test_read_config_invalid(tmp_path, text, error):
+    with pytest.raises(ValueError, match=error):
+        read_config(__config(tmp_path, text))
+
+
+def test_root_names():
+    start = datetime.now()
+    date = f"{start.year % 100}_{start.month:02}"
+    src_dir = Path(__file__).resolve().parent.parent / "src"
+
+    default = VariableStorer(False, Path("."))
+    root = VariableStorer(False, Path("."), Root("photos", "/photos", "p:", FILTER_FILE, ()))
+    assert default.db_file == src_dir / "RCloneBackupScript.db"
+    assert root.db_file == src_dir / "RCloneBackupScript_photos.db"
+    assert default.run_log == src_dir / "logs" / f"{date}_run.log"
+    assert root.run_log == src_dir / "logs" / f"{date}_photos_run.log"
+    assert root.err_log == src_dir / "logs" / f"{date}_photos_error.log"
+    # Each root only excludes its own database's WAL and shared memory files
+    assert root.path_filter.excluded("RCloneBackupScript_photos.db-wal", False)
+    assert not root.path_filter.excluded("RCloneBackupScript.db-wal", False)
+    assert root.LOCAL_DIR == "/photos" and root.REMOTE_DIR == "p:"
+
+
+def test_two_roots(fake_rclone, monkeypatch, tmp_path):
+    (tmp_path / "b.filter").write_text("- *.tmp\n")
+    config = read_config(
+        __config(
+            tmp_path,
+            """
+            bwlimit = "4M"
+            upload_workers = 8
+
+            [[root]]
+            name = "a"
+            local = "a"
+            remote = "remote_a:"
+
+            [[root]]
+            name = "b"
+            local = "b"
+            remote = "remote_b:"
+            filter = "b.filter"
+            exclude = ["*.log"]
+            """,
+        )
+    )
+    for name in ("a/x.txt", "a/x.tmp", "a/x.log", "b/y.txt", "b/y.tmp", "b/y.log"):
+        (tmp_path / name).write_text(name)
+    calls = tmp_path / "calls.jsonl"
+    shares = {}
+
+    def run(root: Root, upload_workers: int):
+        var_storer = VariableStorer(False, Path(root.local_dir), root)
+        shares[root.name] = upload_workers
+        # Same names as the script's, kept out of src/
+        for name in ("db_file", "run_log", "err_log"):
+            setattr(var_storer, name, tmp_path / getattr(var_storer, name).name)
+        var_storer.upload_workers = upload_workers
+        backup(var_storer)
+
+    run_roots(config, run)
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+    for name in ("a/x.txt", "a/x.tmp", "a/x.log", "b/y.txt", "b/y.tmp", "b/y.log"):
+        (tmp_path / name).write_text("changed")
+    run_roots(config, run)
+
+    assert shares == {"a": 4, "b": 4}
+    with open(calls, encoding="utf-8") as lines:
+        args = [json.loads(line)["args"] for line in lines]
+    # 4 MiB over the 8 uploads
+    assert all(call[call.index("--bwlimit") + 1] == "512k" for call in args)
+    synced = sorted((call[2], call[call.index("--include") + 1]) for call in args)
+    # The default filter file doesn't exclude *.tmp or *.log
+    assert synced == [
+        ("remote_a:", "x.log"),
+        ("remote_a:", "x.tmp"),
+        ("remote_a:", "x.txt"),
+        ("remote_b:", "y.txt"),
+    ]
+
+    for name, paths in (("a", ["a/x.log", "a/x.tmp", "a/x.txt"]), ("b", ["b/y.txt"])):
+        with closing(sqlite3.connect(tmp_path / f"RCloneBackupScript_{name}.db")) as db_conn:
+            assert db_conn.execute(
+                "SELECT file_path, synced FROM FilePaths JOIN SyncState USING (file_id) ORDER BY file_path"
+            ).fetchall() == [(str(tmp_path / path), 1) for path in paths]
+        assert next(tmp_path.glob(f"*_{name}_run.log")).read_text()
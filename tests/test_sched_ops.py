@@ -0,0 +1,37 @@
+"""
+Files are picked from the queue and synced in rank order
+"""
+
+import inspect
+from contextlib import closing
+from pathlib import Path
+from time import time_ns
+
+from backup_run import make_var_storer
+from db_ops import Crud, connect_db, get_count_or_setup_db
+from helpers import FileEntry, VariableStorer
+from main import main
+from sched_ops import schedule
+
+
+def test_small_files_first_without_history(tree, tmp_path):
+    var_storer = make_var_storer(tree, tmp_path)
+    queued = time_ns() - 3600 * 1_000_000_000
+    large = FileEntry(Path(tree / "a_large.iso"), 1, 4 * 2**30, 1, False)
+    small = [FileEntry(Path(tree / f"b_small_{i}.txt"), 1, 1024, 2 + i, False) for i in range(3)]
+
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        var_storer.crud = Crud(var_storer.db_conn)
+        get_count_or_setup_db(var_storer)
+        picked = schedule(var_storer, [(large, queued)] + [(file, queued) for file in small])
+
+    # The large file sorts first by path, but a time budget cut should leave it
+    assert picked[-1] == large
+    assert set(picked[:-1]) == set(small)
+
+
+
+def test_budget_seconds_default(tree):
+    # Same default as --budget-seconds
+    assert inspect.signature(main).parameters["BUDGET_SECONDS"].default == 3600
+    assert VariableStorer(False, tree).budget_seconds == 3600
@@ -0,0 +1,115 @@
+"""
+The shards of a full backup cover every path exactly once, and an interrupted
+full backup continues with only its unfinished shards
+"""
+
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+
+from backup_run import backup, make_var_storer, rclone_calls
+from filter_ops import FILTER_FILE, PathFilter
+from full_backup import __sync_shards
+from shard_ops import plan_shards, size_tree_from_scan
+
+# Sizes of the files of the tree, kB. Names like "a*" only match themselves once escaped
+TREE = {
+    "a*/s1/f1": 1,
+    "a*/s1/f2": 1,
+    "a*/s1/f3": 1,
+    "a*/s2/f1": 1,
+    "a*/s2/f2": 1,
+    "a*/s2/f3": 1,
+    "a*/rest1": 1,
+    "a*/rest2": 1,
+    "ab/f1": 1,
+    "ab/f2": 1,
+    "c[1]/f1": 1,
+    "c[1]/f2": 1,
+    "d,{e}/f1": 1,
+    "top.txt": 1,
+    ".hidden/f1": 1,
+}
+# Only on the remote, deleted by the shard that covers them
+REMOTE_ONLY = ["a*/gone/f", "a*/s1/deep/f", "ab/new/f", "newtop/f", "gone.txt"]
+
+
+def __make_tree(tree: Path):
+    for rel_path, size in TREE.items():
+        (tree / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (tree / rel_path).write_bytes(b"x" * size * 1000)
+
+
+def __included(path_filter: PathFilter, rel_path: str) -> bool:
+    parts = rel_path.split("/")
+    # rclone doesn't list excluded directories
+    for i in range(1, len(parts)):
+        if path_filter.excluded("/".join(parts[:i]), True):
+            return False
+    return not path_filter.excluded(rel_path, False)
+
+
+@pytest.mark.parametrize("shards", [1, 2, 4, 7])
+def test_shards_cover_tree_once(tree, tmp_path, shards):
+    __make_tree(tree)
+    var_storer = make_var_storer(tree, tmp_path)
+    size_tree = size_tree_from_scan(var_storer, tree)
+    assert size_tree.size == 14000
+    plan = plan_shards(size_tree, shards)
+    assert len(plan) <= shards
+    assert sum(size for size, _ in plan) == size_tree.size
+
+    filters = []
+    for i, (_, rules) in enumerate(plan):
+        # Built like full_backup.py builds it
+        filter_file = tmp_path / f"shard_{i}.txt"
+        filter_file.write_text(f"{FILTER_FILE.read_text()}\n{rules}\n- **\n")
+        filters.append(PathFilter.from_file(filter_file))
+
+    for rel_path in list(TREE) + REMOTE_ONLY:
+        covering = [i for i, path_filter in enumerate(filters) if __included(path_filter, rel_path)]
+        assert len(covering) == (0 if rel_path.startswith(".") else 1), rel_path
+
+
+def test_remainder_shards_escape_names(tree, tmp_path):
+    __make_tree(tree)
+    plan = plan_shards(size_tree_from_scan(make_var_storer(tree, tmp_path), tree), 4)
+    rules = "\n".join(rules for _, rules in plan).splitlines()
+    # a* is split into its subdirectories and the files directly in it
+    assert "+ /a\\*/s1/**" in rules and "+ /a\\*/s2/**" in rules
+    assert "- /a\\*/s1/**" in rules and "+ /a\\*/**" in rules
+    assert "+ /c\\[1\\]/**" in rules or "- /c\\[1\\]/**" in rules
+
+
+def test_interrupted_full_backup_resumes(fake_rclone, monkeypatch, tree, tmp_path):
+    for name in ("dir_0", "dir_1", "dir_2", "dir_3"):
+        for i in range(4):
+            (tree / name).mkdir(exist_ok=True)
+            (tree / name / f"f{i}").write_bytes(b"x" * 1000)
+    backup(make_var_storer(tree, tmp_path))
+    calls = tmp_path / "calls.jsonl"
+    monkeypatch.setenv("FAKE_RCLONE_CALLS", str(calls))
+
+    def includes():
+        return sorted(rule for call in rclone_calls(calls) for rule in call if rule.startswith("+ "))
+
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_GLOB", "/dir_1/*")
+    assert not __sync_shards(make_var_storer(tree, tmp_path), 2, 4, False, False)
+    assert includes() == ["+ /**", "+ /dir_0/**", "+ /dir_1/**", "+ /dir_2/**", "+ /dir_3/**"]
+
+    monkeypatch.delenv("FAKE_RCLONE_FAIL_GLOB")
+    assert __sync_shards(make_var_storer(tree, tmp_path), 2, 4, False, False)
+    assert includes() == ["+ /dir_1/**"]
+
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        assert db_conn.execute("SELECT finished IS NOT NULL FROM FullBackups").fetchall() == [(1,)]
+        # Only the failed shard was synced twice
+        assert db_conn.execute(
+            "SELECT attempts FROM FullBackupShards WHERE finished IS NOT NULL ORDER BY attempts"
+        ).fetchall() == [(1,), (1,), (1,), (2,)]
+
+    # A finished full backup isn't resumed, the next one syncs everything
+    assert __sync_shards(make_var_storer(tree, tmp_path), 2, 4, False, False)
+    assert len(includes()) == 5
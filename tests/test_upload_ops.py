@@ -0,0 +1,122 @@
+"""
+Concurrent uploads adapt how many run at once, and their results are all
+recorded by the calling thread
+"""
+
+import re
+import sqlite3
+from contextlib import closing
+from threading import Lock
+
+import pytest
+
+import upload_ops
+from backup_run import backup, make_var_storer
+from helpers import FileEntry
+from upload_ops import UploadPool
+
+
+@pytest.fixture
+def var_storer(tree, tmp_path):
+    return make_var_storer(tree, tmp_path)
+
+
+def test_counts_match_db(fake_rclone, monkeypatch, tree, tmp_path):
+    names = [f"dir_{i % 4}/file_{i}.txt" for i in range(100)]
+    for name in names:
+        (tree / name).parent.mkdir(exist_ok=True)
+        (tree / name).write_text(name)
+    backup(make_var_storer(tree, tmp_path))
+    for name in names:
+        (tree / name).write_text("changed")
+
+    monkeypatch.setenv("FAKE_RCLONE_FAIL_RATE", "0.2")
+    var_storer = make_var_storer(tree, tmp_path, "2026-01-01 00:01")
+    var_storer.upload_workers = 8
+    backup(var_storer)
+
+    lines = (tmp_path / "run.log").read_text().splitlines()
+    files, fails = map(int, re.fullmatch(r"# Files (\d+) +Fails (\d+) *#", lines[-1]).groups())
+    with closing(sqlite3.connect(tmp_path / "test.db")) as db_conn:
+        logged = dict(
+            db_conn.execute(
+                "SELECT synced, COUNT(*) FROM Log WHERE date = '2026-01-01 00:01' GROUP BY synced"
+            )
+        )
+        pending = db_conn.execute("SELECT COUNT(*) FROM SyncState WHERE synced = 0").fetchone()[0]
+        queued = db_conn.execute("SELECT COUNT(*) FROM Queue").fetchone()[0]
+        files_synced = db_conn.execute(
+            "SELECT files_synced FROM Runs WHERE date = '2026-01-01 00:01'"
+        ).fetchone()[0]
+
+    assert files == 100 and 0 < fails < 100
+    assert logged == {0: fails, 1: files - fails}
+    assert pending == queued == fails
+    assert files_synced == files - fails
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Time the upload pools see, which only moves when the test moves it
+    """
+    clock = [0.0]
+    monkeypatch.setattr(upload_ops, "monotonic", lambda: clock[0])
+    return clock
+
+
+def __run(pool: UploadPool, results: list[bool], clock: list[float], seconds: float = 1) -> list[int]:
+    """
+    Runs a job per result and gives the limit after each. Uploads scale perfectly,
+    a file takes seconds divided by the uploads running at once
+    """
+    running, most = [0], [0]
+    lock = Lock()
+    file = FileEntry(None, 0, 1000, 0, False)
+
+    def job(synced: bool):
+        def upload():
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            yield file, synced
+            with lock:
+                running[0] -= 1
+
+        return upload
+
+    limits = []
+    # The time of each file passes before it's recorded
+    clock[0] += seconds / pool.limit
+    for _ in pool.run(job(synced) for synced in results):
+        limits.append(pool.limit)
+        clock[0] += seconds / pool.limit
+    assert most[0] <= pool.max_workers
+    return limits
+
+
+def test_limit_grows_while_throughput_improves(var_storer, clock):
+    limits = __run(UploadPool(var_storer, 4), [True] * 40, clock)
+    # A window is twice the limit's files
+    assert limits[:12] == [1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4]
+    assert set(limits[12:]) == {4}
+
+
+def test_limit_halved_on_failure(var_storer, clock):
+    limits = __run(UploadPool(var_storer, 8), [True] * 30 + [False] + [True] * 30, clock)
+    # Files finish in any order, so the failure is somewhere around the 31st
+    failed = next(i for i in range(1, len(limits)) if limits[i] < limits[i - 1])
+    assert limits[failed - 1] >= 5 and limits[failed] == limits[failed - 1] // 2
+    # Grows back from the halved limit after its window
+    halved = limits[failed]
+    assert limits[failed : failed + 2 * halved] == [halved] * 2 * halved
+    assert limits[failed + 2 * halved] == halved + 1
+
+
+def test_limit_shrinks_when_throughput_drops(var_storer, clock):
+    pool = UploadPool(var_storer, 4)
+    __run(pool, [True] * 20, clock)
+    assert pool.limit == 4
+
+    # The remote slows down: uploads take ten times as long
+    assert __run(pool, [True] * 8, clock, seconds=10)[-1] == 3
@@ -0,0 +1,112 @@
+"""
+The watch daemon turns inotify events into dirty directories for the journal,
+and asks for a full scan whenever events may have been lost
+"""
+
+from contextlib import closing
+from os import close
+from pathlib import Path
+from struct import pack
+from time import time_ns
+
+import pytest
+
+from backup_run import make_var_storer
+from db_ops import clear_journal, connect_db, get_count_or_setup_db, get_journal, start_watch_state
+from watch_ops import (
+    EVENT_FORMAT,
+    IN_CREATE,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    Watcher,
+)
+
+
+def __event(wd: int, mask: int, name: str = "") -> bytes:
+    """
+    An event as read from the inotify descriptor, its name padded with NULs
+    """
+    name_bytes = name.encode()
+    if name_bytes:
+        name_bytes += b"\0" * (16 - len(name_bytes) % 16)
+    return pack(EVENT_FORMAT, wd, mask, 0, len(name_bytes)) + name_bytes
+
+
+@pytest.fixture
+def watcher(tree, tmp_path):
+    var_storer = make_var_storer(tree, tmp_path)
+    # The database lives in the watched tree, like the script's does in PDrive
+    var_storer.db_file = tree / "test.db"
+    with closing(connect_db(var_storer.db_file)) as var_storer.db_conn:
+        get_count_or_setup_db(var_storer)
+        start_watch_state(var_storer, 1)
+        # A full scan since the daemon started, so the journal is trusted
+        clear_journal(var_storer, time_ns(), full_scan=True)
+        var_storer.db_conn.commit()
+        watcher = Watcher(var_storer, tree)
+        yield watcher
+        close(watcher.fd)
+
+
+def __wd(watcher: Watcher, path: Path) -> int:
+    return next(wd for wd, watched in watcher.watches.items() if watched == path)
+
+
+def test_file_event_journals_its_directory(watcher, tree):
+    (tree / "sub").mkdir()
+    watcher.add_tree(tree / "sub")
+    watcher.handle_events(__event(__wd(watcher, tree / "sub"), IN_MODIFY, "file.txt"))
+    assert watcher.flush()
+    assert get_journal(watcher.var_storer) == [(tree / "sub", False)]
+
+
+def test_overflow_falls_back_to_full_scan(watcher, tree):
+    watcher.handle_events(
+        __event(__wd(watcher, tree), IN_MODIFY, "file.txt") + __event(-1, IN_Q_OVERFLOW)
+    )
+    assert watcher.overflowed
+    assert watcher.flush()
+    assert get_journal(watcher.var_storer) is None
+
+    # Until a full scan started after the overflow
+    clear_journal(watcher.var_storer, time_ns(), full_scan=True)
+    assert get_journal(watcher.var_storer) == []
+
+
+def test_stale_heartbeat_falls_back_to_full_scan(watcher, tree):
+    watcher.handle_events(__event(__wd(watcher, tree), IN_MODIFY, "file.txt"))
+    assert watcher.flush()
+    assert get_journal(watcher.var_storer) == [(tree, False)]
+
+    watcher.var_storer.db_conn.execute(
+        "UPDATE WatchState SET heartbeat = heartbeat - ?",
+        ((watcher.var_storer.watch_timeout + 1) * 1_000_000_000,),
+    )
+    assert get_journal(watcher.var_storer) is None
+
+
+@pytest.mark.parametrize("mask", [IN_CREATE, IN_MOVED_TO])
+def test_new_directory_is_walked_and_watched(watcher, tree, mask):
+    # Created before its watch was added, so nothing reported these
+    (tree / "new" / "sub").mkdir(parents=True)
+    (tree / "new" / "sub" / "file.txt").write_text("file")
+    (tree / "new" / "node_modules").mkdir()
+
+    watcher.handle_events(__event(__wd(watcher, tree), mask | IN_ISDIR, "new"))
+    assert watcher.dirty == {tree: False, tree / "new": True}
+    assert {tree / "new", tree / "new" / "sub"} <= set(watcher.watches.values())
+    assert tree / "new" / "node_modules" not in watcher.watches.values()
+
+
+def test_own_database_writes_ignored(watcher, tree):
+    wd = __wd(watcher, tree)
+    watcher.handle_events(
+        b"".join(__event(wd, IN_MODIFY, name) for name in ("test.db", "test.db-wal", "test.db-shm"))
+    )
+    assert watcher.dirty == {}
+
+    # Another database's files aren't ours
+    watcher.handle_events(__event(wd, IN_MODIFY, "other.db-wal"))
+    assert watcher.dirty == {tree: False}